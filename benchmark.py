@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmark.py used to time the grant pipeline against local stand-ins
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+from ldap_mysql_granter import auto_grant_config
+from ldap_mysql_granter import grant_journal
+from ldap_mysql_granter import import_schema_config
+from ldap_mysql_granter import import_schema_tool
+from ldap_mysql_granter import mysql_backup_tool
+from ldap_mysql_granter import mysql_grants_generator
+from ldap_mysql_granter import mysql_query_tool
+import argparse
+import contextlib
+import datetime
+import logging
+import os
+import pprint
+import shutil
+import tempfile
+import time
+logger = logging.getLogger(__name__)
+BENCH_YAML = "integration_test.yaml"
+
+
+class FakeMysqlCursor(object):
+    """a stand-in for a MySQLdb cursor that waits latency seconds per query"""
+
+    def __init__(self, latency, userRows=()):
+        self._latency = latency
+        self._userRows = userRows
+        self._lastQuery = None
+
+    def close(self):
+        pass
+
+    def execute(self, query, qArgs=None):
+        time.sleep(self._latency)
+        self._lastQuery = query
+
+    def nextset(self):
+        """every statement of a batch succeeds within the one round trip"""
+        return None
+
+    def fetchall(self):
+        results = tuple()
+        if self._lastQuery == "SELECT VERSION()":
+            results = tuple([{'VERSION()': '5.6.40'}])
+        elif self._lastQuery == "SELECT * FROM mysql.user":
+            results = self._userRows
+        return results
+
+
+class FakeMysqlConnection(object):
+    """a stand-in for a MySQLdb connection to a server latency seconds away holding userRows accounts"""
+
+    def __init__(self, latency, userRows=()):
+        self._latency = latency
+        self._userRows = userRows
+
+    def close(self):
+        pass
+
+    def autocommit(self, val):
+        pass
+
+    def commit(self):
+        time.sleep(self._latency)
+
+    def rollback(self):
+        time.sleep(self._latency)
+
+    def cursor(self, curType=None):
+        return FakeMysqlCursor(self._latency, self._userRows)
+
+    def literal(self, value):
+        return "'%s'" % value
+
+
+@contextlib.contextmanager
+def localMysqlStandIn(latency, userRows=()):
+    """routes connections, backups and emails to local stand-ins, journals are still fsync'd to a temp dir"""
+    unmockedConnect = mysql_query_tool.MySQLdb.connect
+    unmockedSaveSnapshot = mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot
+    unmockedOpenJournal = mysql_backup_tool.MysqlBackupTool.openJournal
+    unmockedSendEmail = mysql_grants_generator.sendEmailNotifications
+    journalPath = tempfile.mkdtemp(prefix="benchJournal")
+    mysql_query_tool.MySQLdb.connect = lambda *args, **kwargs: FakeMysqlConnection(latency, userRows)
+    mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot = lambda *args, **kwargs: None
+    mysql_backup_tool.MysqlBackupTool.openJournal = lambda self, backupName, cluster: grant_journal.GrantJournal(
+        os.path.join(journalPath, backupName, cluster, grant_journal.JOURNAL_FILE))
+    mysql_grants_generator.sendEmailNotifications = lambda *args, **kwargs: None
+    try:
+        yield
+    finally:
+        mysql_query_tool.MySQLdb.connect = unmockedConnect
+        mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot = unmockedSaveSnapshot
+        mysql_backup_tool.MysqlBackupTool.openJournal = unmockedOpenJournal
+        mysql_grants_generator.sendEmailNotifications = unmockedSendEmail
+        shutil.rmtree(journalPath)
+
+
+def makeBenchGrantDict(clusterCount, userCount):
+    grantDict = {}
+    for clusterIndex in range(clusterCount):
+        cluster = "cluster%d" % clusterIndex
+        grantDict[cluster] = {}
+        for userIndex in range(userCount):
+            userAtHost = "user%d@%%" % userIndex
+            grantDict[cluster][userAtHost] = [{'db_table': '*.*',
+                                               'privileges': ['SELECT']},
+                                              {'db_table': 'aDB.aTable',
+                                               'privileges': ['SELECT', 'INSERT']}]
+    return grantDict
+
+
+def timeIt(func, *args):
+    startTime = time.time()
+    func(*args)
+    return time.time() - startTime
+
+
+def benchGrantAccess(args):
+    """times the serial grantAccess against the concurrent one with and without batching"""
+    autoGrantConfig = auto_grant_config.AutoGrantConfig(BENCH_YAML)
+    grantDict = makeBenchGrantDict(args.clusters, args.users)
+    latency = args.latency_ms / 1000.0
+    echoOnly = False
+    logPasswords = False
+    destructive = False
+    passwordReset = False
+    with localMysqlStandIn(latency):
+        serialTime = timeIt(mysql_grants_generator.grantAccess, autoGrantConfig, grantDict,
+                            echoOnly, logPasswords, destructive, passwordReset, 1, 1,
+                            None, None, None, 1)
+        concurrentTime = timeIt(mysql_grants_generator.grantAccess, autoGrantConfig, grantDict,
+                                echoOnly, logPasswords, destructive, passwordReset,
+                                args.workers, args.cluster_concurrency, args.max_in_flight,
+                                None, None, 1)
+        batchedTime = timeIt(mysql_grants_generator.grantAccess, autoGrantConfig, grantDict,
+                             echoOnly, logPasswords, destructive, passwordReset,
+                             args.workers, args.cluster_concurrency, args.max_in_flight,
+                             None, None, args.batch_size)
+    print("%d clusters x %d users at %.1fms latency" % (args.clusters, args.users, args.latency_ms))
+    print("  serial:     %8.2fs" % serialTime)
+    print("  concurrent: %8.2fs (workers=%d cluster-concurrency=%d max-in-flight=%s) %.1fx" %
+          (concurrentTime, args.workers, args.cluster_concurrency, args.max_in_flight,
+           serialTime / max(concurrentTime, 0.000001)))
+    print("  batched:    %8.2fs (batch-size=%d) %.1fx" %
+          (batchedTime, args.batch_size, serialTime / max(batchedTime, 0.000001)))
+
+
+def benchDropUsers(args):
+    """times a destructive run removing the stale accounts one by one and in DROP USER chunks"""
+    autoGrantConfig = auto_grant_config.AutoGrantConfig(BENCH_YAML)
+    grantDict = makeBenchGrantDict(args.clusters, args.users)
+    userRows = tuple({'User': "user%d" % x, 'Host': '%'} for x in range(args.accounts))
+    latency = args.latency_ms / 1000.0
+    echoOnly = False
+    logPasswords = False
+    destructive = True
+    passwordReset = False
+    allMysqlUsers = set(x['User'] + '@' + x['Host'] for x in userRows)
+    findTime = timeIt(mysql_grants_generator.findUsersToDrop, autoGrantConfig, allMysqlUsers,
+                      grantDict.values()[0].keys())
+    with localMysqlStandIn(latency, userRows):
+        singleTime = timeIt(mysql_grants_generator.grantAccess, autoGrantConfig, grantDict,
+                            echoOnly, logPasswords, destructive, passwordReset,
+                            args.workers, args.cluster_concurrency, args.max_in_flight,
+                            None, None, 1, None, 1)
+        chunkedTime = timeIt(mysql_grants_generator.grantAccess, autoGrantConfig, grantDict,
+                             echoOnly, logPasswords, destructive, passwordReset,
+                             args.workers, args.cluster_concurrency, args.max_in_flight,
+                             None, None, args.batch_size, None, args.drop_chunk_size)
+    print("%d clusters x %d accounts keeping %d users at %.1fms latency" %
+          (args.clusters, args.accounts, args.users, args.latency_ms))
+    print("  findUsersToDrop: %8.2fs" % findTime)
+    print("  one by one:      %8.2fs" % singleTime)
+    print("  chunked:         %8.2fs (drop-chunk-size=%d batch-size=%d) %.1fx" %
+          (chunkedTime, args.drop_chunk_size, args.batch_size, singleTime / max(chunkedTime, 0.000001)))
+
+
+def benchBackupCatalog(args):
+    """times the startup pruning and backup lookups over hourly backups of every cluster"""
+    backupPath = tempfile.mkdtemp(prefix="benchBackup")
+    try:
+        backupTool = mysql_backup_tool.MysqlBackupTool(True, False, backupPath)
+        firstTime = datetime.datetime(2015, 1, 1)
+        backupNames = [(firstTime + datetime.timedelta(hours=x)).strftime(mysql_backup_tool.BACKUP_DIR_FMT)
+                       for x in range(args.backups)]
+        clusters = ["cluster%d" % x for x in range(args.clusters)]
+        for backupName in backupNames:
+            for cluster in clusters:
+                os.makedirs(os.path.join(backupPath, backupName, cluster))
+        scanTime = timeIt(backupTool.loadCatalog)
+        keptName = backupNames[-1]
+        # the older half of the backups is pruned
+        pruneName = backupNames[len(backupNames) // 2]
+        pruneTime = timeIt(backupTool.pruneBefore, pruneName)
+        prunedCount = len([x for x in backupNames if x < pruneName])
+        leftList = sorted(os.listdir(backupPath))
+        if [x for x in leftList if x < pruneName] or pruneName not in leftList:
+            raise Exception("pruning before %s left %s" % (pruneName, leftList[:3]))
+        startTime = time.time()
+        for cluster in clusters:
+            backupTool.getNearestBackup(cluster, keptName)
+        lookupTime = time.time() - startTime
+        lastTime = timeIt(backupTool.getLastBackup)
+    finally:
+        shutil.rmtree(backupPath)
+    print("%d hourly backups x %d clusters" % (args.backups, args.clusters))
+    print("  rebuild catalog:     %8.4fs" % scanTime)
+    print("  prune with catalog:  %8.4fs for %d backups" % (pruneTime, prunedCount))
+    print("  getNearestBackup:    %8.4fs for every cluster" % lookupTime)
+    print("  getLastBackup:       %8.4fs" % lastTime)
+
+
+def benchImportSchema(args):
+    """times the serial schema import against the scheduled one, each import takes --import-ms"""
+    importSeconds = args.import_ms / 1000.0
+    mysqlSchemas = []
+    for schemaIndex in range(args.schemas):
+        # every fifth schema loads into the database of the one before it
+        dstIndex = schemaIndex - 1 if 0 < schemaIndex and schemaIndex % 5 == 0 else schemaIndex
+        mysqlSchemas.append({"dbhost%d" % (schemaIndex % args.clusters): [{"db%d" % schemaIndex: "db%d" % dstIndex}]})
+    importSchemaConfig = import_schema_config.ImportSchemaConfig()
+    importSchemaConfig.overrideYamlDictForTests({'mysql_schemas': mysqlSchemas})
+
+    def fakePipe(*pipeArgs, **pipeKwargs):
+        time.sleep(importSeconds)
+        return {'bytes': 0, 'rows': 0, 'seconds': importSeconds}
+    unmockedPipe = mysql_backup_tool.MysqlBackupTool.pipeMySQLDump
+    backupPath = tempfile.mkdtemp(prefix="benchImport")
+    timeList = []
+    with localMysqlStandIn(args.latency_ms / 1000.0):
+        mysql_backup_tool.MysqlBackupTool.pipeMySQLDump = fakePipe
+        try:
+            for workers, hostConcurrency in [(1, 1), (args.workers, args.host_concurrency)]:
+                schemaImportTool = import_schema_tool.SchemaImportTool(False, False, backupPath, "root", "", True,
+                                                                       None, workers, hostConcurrency)
+                schemaImportTool.remoteMysqlUser = "root"
+                schemaImportTool.remoteMysqlPass = ""
+                timeList.append(timeIt(schemaImportTool.importSchema, importSchemaConfig))
+        finally:
+            mysql_backup_tool.MysqlBackupTool.pipeMySQLDump = unmockedPipe
+            shutil.rmtree(backupPath)
+    serialTime, scheduledTime = timeList
+    print("%d schemas from %d hosts at %.0fms each" % (args.schemas, args.clusters, args.import_ms))
+    print("  serial:     %6.2fs" % serialTime)
+    print("  scheduled:  %6.2fs (workers=%d host-concurrency=%d) %.1fx" %
+          (scheduledTime, args.workers, args.host_concurrency, serialTime / max(scheduledTime, 0.000001)))
+
+
+def makeBenchConfigDict(userCount, groupCount, clusterCount, groupsPerUser, tablesPerGroup=1):
+    """
+    every group is granted on a few clusters and every user is in groupsPerUser groups
+    groups share tablesPerGroup tables out of a pool so their grants overlap
+    """
+    privilegeList = ['SELECT', 'INSERT', 'UPDATE', 'DELETE', 'ALTER']
+    grantsMap = {}
+    for clusterIndex in range(clusterCount):
+        grantsMap["cluster%d" % clusterIndex] = {}
+    for groupIndex in range(groupCount):
+        group = "group%d" % groupIndex
+        sharedGrants = {'*.*': ['SELECT']}
+        for tableIndex in range(tablesPerGroup):
+            dbTable = "db%d.*" % ((groupIndex + tableIndex * 37) % 100)
+            sharedGrants[dbTable] = privilegeList[:1 + (groupIndex + tableIndex) % len(privilegeList)]
+        for clusterIndex in set([groupIndex % clusterCount, (groupIndex * 7) % clusterCount]):
+            grantsMap["cluster%d" % clusterIndex][group] = {
+                '%': sharedGrants,
+                "host%d" % (groupIndex % 3): {"db%d.*" % groupIndex: ['SELECT']}}
+    groupDict = {}
+    for userIndex in range(userCount):
+        for groupOffset in range(groupsPerUser):
+            group = "group%d" % ((userIndex + groupOffset * 101) % groupCount)
+            groupDict.setdefault(group, []).append("user%d" % userIndex)
+    yamlDict = {'mysql_user_filter': ["^root@.*", "^repl@.*"],
+                'group_to_grants_map': grantsMap}
+    return yamlDict, groupDict
+
+
+def benchConfigExpansion(args):
+    """times loading the config and expanding groups into users and grants"""
+    yamlDict, groupDict = makeBenchConfigDict(args.users, args.groups, args.clusters,
+                                              args.groups_per_user, args.tables_per_group)
+    autoGrantConfig = auto_grant_config.AutoGrantConfig(BENCH_YAML)
+    loadTime = timeIt(autoGrantConfig.overrideYamlDictForTests, yamlDict)
+    startTime = time.time()
+    userDict = mysql_grants_generator.makeUserDict(autoGrantConfig, groupDict)
+    userTime = time.time() - startTime
+    startTime = time.time()
+    grantDict = mysql_grants_generator.makeGrantDict(autoGrantConfig, userDict)
+    grantTime = time.time() - startTime
+    print("%d users x %d groups x %d clusters with %d groups per user and %d tables per group" %
+          (args.users, args.groups, args.clusters, args.groups_per_user, args.tables_per_group))
+    print("  load config:    %8.2fs" % loadTime)
+    print("  makeUserDict:   %8.2fs %d user@hosts" % (userTime, len(userDict)))
+    print("  makeGrantDict:  %8.2fs %d user@host grants" %
+          (grantTime, sum(len(x) for x in grantDict.values())))
+
+
+def main():
+    """Arg parsing and logger setup"""
+    retCode = 0
+    logLevels = {"DEBUG": logging.DEBUG,
+                 "INFO": logging.INFO,
+                 "WARN": logging.WARNING,
+                 "ERROR": logging.ERROR,
+                 "CRITICAL": logging.CRITICAL}
+    benchDict = {"GRANT_ACCESS": benchGrantAccess,
+                 "CONFIG_EXPANSION": benchConfigExpansion,
+                 "DROP_USERS": benchDropUsers,
+                 "BACKUP_CATALOG": benchBackupCatalog,
+                 "IMPORT_SCHEMA": benchImportSchema}
+    parser = argparse.ArgumentParser(
+        description='A tool to time the grant pipeline')
+    parser.add_argument('-l', '--log-level', type=str, default="CRITICAL",
+                        choices=["DEBUG", "INFO", "WARN", "ERROR", "CRITICAL"],
+                        help="the log level")
+    parser.add_argument('-b', '--bench', type=str, required=True,
+                        choices=sorted(benchDict.keys()),
+                        help="the benchmark to run")
+    parser.add_argument('--clusters', type=int, default=20,
+                        help="the number of clusters to simulate")
+    parser.add_argument('--users', type=int, default=20,
+                        help="the number of users per cluster")
+    parser.add_argument('--accounts', type=int, default=10000,
+                        help="the number of accounts on each stand-in server")
+    parser.add_argument('--backups', type=int, default=720,
+                        help="the number of hourly backups kept on disk")
+    parser.add_argument('--schemas', type=int, default=60,
+                        help="the number of mysql_schemas entries to import")
+    parser.add_argument('--import-ms', type=float, default=200.0,
+                        help="the simulated time each schema import takes")
+    parser.add_argument('--host-concurrency', type=int, default=import_schema_tool.DEFAULT_HOST_CONCURRENCY,
+                        help="the most schemas imported at once from one host")
+    parser.add_argument('--groups', type=int, default=500,
+                        help="the number of groups in the config")
+    parser.add_argument('--groups-per-user', type=int, default=3,
+                        help="the number of groups each user is in")
+    parser.add_argument('--tables-per-group', type=int, default=1,
+                        help="the number of shared tables each group is granted")
+    parser.add_argument('--latency-ms', type=float, default=2.0,
+                        help="the simulated round trip to each stand-in server")
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help="the number of clusters to reconcile at once")
+    parser.add_argument('--cluster-concurrency', type=int, default=4,
+                        help="the number of connections per cluster")
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help="the most users being applied at once")
+    parser.add_argument('--batch-size', type=int, default=mysql_grants_generator.DEFAULT_BATCH_SIZE,
+                        help="the statements sent in one round trip by the batched run")
+    parser.add_argument('--drop-chunk-size', type=int, default=mysql_grants_generator.DEFAULT_DROP_CHUNK_SIZE,
+                        help="the accounts removed by each DROP USER of the chunked run")
+    args = parser.parse_args()
+    if args.log_level.upper() in logLevels.keys():
+        logging.basicConfig(level=logLevels[args.log_level.upper()])
+    else:
+        logging.basicConfig(level=logging.INFO)
+        logger.warn("Unknown logLevel=%s retaining level at INFO",
+                    args.log_level)
+    logger.info(pprint.pformat(args))
+    benchDict[args.bench](args)
+    logger.info("done.")
+    return retCode
+
+if __name__ == "__main__":
+    """Entry point if being run as a script"""
+    main()
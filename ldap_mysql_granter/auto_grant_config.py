@@ -10,9 +10,13 @@ auto_grant_config is a module to read the integration_test.yaml file
 
 import getpass
 import logging
+import privilege_mask
 import re
 import yaml_config
 logger = logging.getLogger(__name__)
+REGEX_METACHARACTERS = frozenset(".^$*+?{}[]\\|()")
+DEFAULT_LDAP_PAGE_SIZE = 500
+DEFAULT_LDAP_CACHE_TTL = 3600
 
 
 class InvalidConfigException(Exception):
@@ -32,38 +36,74 @@ class AutoGrantConfig(yaml_config.YamlConfig):
         super(AutoGrantConfig, self).__init__(yamlFile)
         if self._yamlDict is None:
             raise MissingConfigException("Missing config\nYou can run mysql_grants_generator --init to generate one")
+        self._buildIndexes()
+
+    def overrideYamlDictForTests(self, _yamlDict):
+        super(AutoGrantConfig, self).overrideYamlDictForTests(_yamlDict)
+        self._buildIndexes()
+
+    def _buildIndexes(self):
+        """
+        compiles group_to_grants_map once so the accessors are lookups
+        and converts every privilege list to a privilege_mask so bad names are reported once
+        NOTE: the yaml dict must not be changed afterwards without reloading it
+        """
+        self._groupHostsIndex = {}
+        self._clusterGroupsIndex = {}
+        self._grantIndex = {}
+        mappingValue = self._yamlDict.get('group_to_grants_map') or {}
+        for cluster in mappingValue.keys():
+            clusterValue = mappingValue[cluster] or {}
+            self._clusterGroupsIndex[cluster] = frozenset(clusterValue.keys())
+            for group in clusterValue.keys():
+                groupValue = clusterValue[group] or {}
+                self._groupHostsIndex.setdefault(group, set()).update(groupValue.keys())
+                for host in groupValue.keys():
+                    hostValue = groupValue[host] or {}
+                    for dbTable in hostValue:
+                        privilege_mask.toMask(hostValue[dbTable], dbTable)
+                    self._grantIndex[(cluster, group, host)] = tuple(
+                        (dbTable, hostValue[dbTable]) for dbTable in hostValue)
+        self._buildUserFilter()
+
+    def _buildUserFilter(self):
+        """compiles mysql_user_filter into an exact match set and one anchored regex"""
+        self._userFilteredCache = {}
+        self._userFilterLiterals = set()
+        self._userFilterRegex = None
+        userFilter = self._yamlDict.get('mysql_user_filter') or []
+        patternList = []
+        for userPattern in userFilter:
+            if REGEX_METACHARACTERS.isdisjoint(userPattern):
+                self._userFilterLiterals.add(userPattern)
+            else:
+                patternList.append(userPattern)
+        if 0 < len(patternList):
+            self._userFilterRegex = re.compile("|".join("(?:%s)\\Z" % x for x in patternList))
 
     def getDbClusters(self):
         """returns all the keys of the group_to_grants_map"""
         dbClusters = sorted(self._yamlDict['group_to_grants_map'].keys())
         return dbClusters
 
+    def getGroupsForCluster(self, cluster):
+        """returns the groups granted anything on the cluster"""
+        return self._clusterGroupsIndex.get(cluster, frozenset())
+
     def getHostsForGroup(self, group):
-        hosts = []
-        clusters = self._yamlDict['group_to_grants_map'].keys()
-        for cluster in clusters:
-            clusterValue = self._yamlDict['group_to_grants_map'][cluster]
-            if group in clusterValue:
-                hosts += clusterValue[group].keys()
-        return set(hosts)
+        return set(self._groupHostsIndex.get(group, ()))
 
     def getGrantList(self, user, cluster, group):
         """returns all the unique mappings for group on the given cluster"""
-        grantList = []
-        try:
-            host = user.split('@')[1].strip("'")
-            mappingValue = self._yamlDict['group_to_grants_map']
-            clusterValue = mappingValue[cluster]
-            groupValue = clusterValue[group]
-            hostValue = groupValue[host]
-            for db_table in hostValue:
-                privileges = hostValue[db_table]
-                grantList += [{'db_table': db_table,
-                               'privileges': privileges}]
-        except KeyError:
+        host = user.split('@')[1].strip("'")
+        grantTuple = self._grantIndex.get((cluster, group, host))
+        if grantTuple is None:
             logger.debug("config missing for user=%s cluster=%s group=%s",
                          user, cluster, group)
-        return grantList
+            return []
+        # fresh dicts as callers merge privileges into them
+        return [{'db_table': dbTable, 'privileges': privileges}
+                for dbTable, privileges in grantTuple]
 
     def getCustomMysqlGroups(self):
         """returns all of the groups in override_groups"""
@@ -75,18 +115,16 @@ class AutoGrantConfig(yaml_config.YamlConfig):
         return customGroups
 
     def getMysqlUserFiltered(self, user):
-        """returns whether a user matches filtered regex
+        """returns whether the whole user matches a regex
            in mysql_user_filter"""
-        userFiltered = False
-        if 'mysql_user_filter' in self._yamlDict:
-            userFilter = self._yamlDict['mysql_user_filter']
-            if userFilter is not None:
-                for userPattern in userFilter:
-                    matches = re.search(userPattern, user)
-                    if matches is not None and user in matches.group():
-                        logger.debug("FILTER %s", user)
-                        userFiltered = True
-                        break
+        userFiltered = self._userFilteredCache.get(user)
+        if userFiltered is None:
+            userFiltered = user in self._userFilterLiterals
+            if not userFiltered and self._userFilterRegex is not None:
+                userFiltered = self._userFilterRegex.match(user) is not None
+            if userFiltered:
+                logger.debug("FILTER %s", user)
+            self._userFilteredCache[user] = userFiltered
         return userFiltered
 
     def getUserToEmailMap(self):
@@ -139,6 +177,37 @@ class AutoGrantConfig(yaml_config.YamlConfig):
             logger.warning("ldap_min_gid not numeric defaulting to %s", minGid)
         return minGid
 
+    def getLdapPageSize(self):
+        """returns the ldap_page_size listed in the yaml file, 0 disables paging"""
+        pageSize = DEFAULT_LDAP_PAGE_SIZE
+        try:
+            pageSize = int(self._yamlDict['ldap_page_size'])
+        except KeyError:
+            logger.debug("ldap_page_size not found defaulting to %s", pageSize)
+        except ValueError:
+            logger.warning("ldap_page_size not numeric defaulting to %s", pageSize)
+        return pageSize
+
+    def getLdapCacheTtl(self):
+        """returns the seconds --ldap-cache may reuse groups without asking ldap"""
+        ttl = DEFAULT_LDAP_CACHE_TTL
+        try:
+            ttl = int(self._yamlDict['ldap_cache_ttl'])
+        except KeyError:
+            logger.debug("ldap_cache_ttl not found defaulting to %s", ttl)
+        except ValueError:
+            logger.warning("ldap_cache_ttl not numeric defaulting to %s", ttl)
+        return ttl
+
+    def getLdapGidOrdering(self):
+        """returns True if the ldap server can filter gidNumber>=ldap_min_gid itself"""
+        gidOrdering = False
+        try:
+            gidOrdering = self._yamlDict['ldap_gid_ordering'] is True
+        except KeyError:
+            logger.debug("ldap_gid_ordering not found the ldap_min_gid is checked client side")
+        return gidOrdering
+
     def getEmail(self):
         return self._yamlDict['gmail_auth']['username']
 
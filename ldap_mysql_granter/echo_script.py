@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+echo_script is a module to collect the echoed statements of a run per cluster
+ so they are applied by one mysql session per cluster rather than one per statement
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import logging
+import os
+import threading
+logger = logging.getLogger(__name__)
+ECHO_FORMAT_CMD = 'cmd'
+ECHO_FORMAT_SQL = 'sql'
+ECHO_FORMATS = [ECHO_FORMAT_CMD, ECHO_FORMAT_SQL]
+SCRIPT_FILE_MODE = 0600
+PREAMBLE_FILE = "preamble.sh"
+HEREDOC_MARKER = "EOF_SQL"
+
+
+def quoteLiteral(value):
+    """returns value as a single quoted sql string literal"""
+    return "'%s'" % str(value).replace("\\", "\\\\").replace("'", "\\'")
+
+
+def toSqlStatement(query, qArgs):
+    """renders a query and its args as one ; terminated statement"""
+    sql = query
+    if qArgs is not None:
+        sql = query % tuple(quoteLiteral(x) for x in qArgs)
+    if not sql.rstrip().endswith(";"):
+        sql += ";"
+    return sql
+
+
+class EchoScript(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clusters = {}
+
+    def _getCluster(self, cluster):
+        if cluster not in self._clusters:
+            self._clusters[cluster] = {'client': None, 'preamble': [], 'statements': []}
+        return self._clusters[cluster]
+
+    def addPreamble(self, cluster, command):
+        """commands such as mysqldump that must run before any statement of cluster"""
+        with self._lock:
+            self._getCluster(cluster)['preamble'].append(command)
+
+    def addStatement(self, cluster, client, sql):
+        """
+        :param client: the mysql command line without -e that reaches cluster
+        :param sql: a ; terminated statement
+        """
+        with self._lock:
+            clusterDict = self._getCluster(cluster)
+            clusterDict['client'] = client
+            clusterDict['statements'].append(sql)
+
+    def getClusters(self):
+        return sorted(self._clusters.keys())
+
+    def getPreamble(self):
+        """returns the preamble commands of every cluster in cluster order"""
+        preamble = []
+        for cluster in self.getClusters():
+            preamble.extend(self._clusters[cluster]['preamble'])
+        return preamble
+
+    def getStatements(self, cluster):
+        return list(self._getCluster(cluster)['statements'])
+
+    def getSql(self, cluster):
+        """returns the sql script of cluster headed by a -- cluster: comment"""
+        lines = ["-- cluster: %s" % cluster]
+        lines.extend(self._clusters[cluster]['statements'])
+        return "\n".join(lines) + "\n"
+
+    def write(self, stream):
+        """
+        writes one shell script, the preamble runs first and stops the script if it fails
+        then each cluster's statements are fed to a single mysql client
+        """
+        stream.write("set -e\n")
+        for command in self.getPreamble():
+            stream.write(command + "\n")
+        for cluster in self.getClusters():
+            clusterDict = self._clusters[cluster]
+            if 0 < len(clusterDict['statements']):
+                stream.write("%s <<'%s'\n" % (clusterDict['client'], HEREDOC_MARKER))
+                stream.write(self.getSql(cluster))
+                stream.write(HEREDOC_MARKER + "\n")
+
+    def writeDir(self, scriptDir):
+        """
+        writes scriptDir/preamble.sh and a scriptDir/<cluster>.sql per cluster
+        readable only by the owner as statements may hold new passwords
+        """
+        if not os.path.exists(scriptDir):
+            os.makedirs(scriptDir)
+        fileList = [(PREAMBLE_FILE, "".join(x + "\n" for x in ["set -e"] + self.getPreamble()))]
+        for cluster in self.getClusters():
+            if 0 < len(self._clusters[cluster]['statements']):
+                fileList.append((cluster + ".sql", self.getSql(cluster)))
+        for fileName, contents in fileList:
+            fd = os.open(os.path.join(scriptDir, fileName), os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         SCRIPT_FILE_MODE)
+            with os.fdopen(fd, 'w') as f:
+                f.write(contents)
+        logger.info("wrote the preamble and %d cluster scripts to %s", len(fileList) - 1, scriptDir)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+grant_journal is a module to write ahead the statements a run changes grants with
+ each with the statements that undo it so a run is reverted by replaying only its own inverses
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import json
+import logging
+import os
+import threading
+import uuid
+logger = logging.getLogger(__name__)
+JOURNAL_FILE = "journal.jsonl"
+JOURNAL_VERSION = 1
+# the journal holds password hashes
+JOURNAL_FILE_MODE = 0600
+
+
+class GrantJournalException(Exception):
+    pass
+
+
+class GrantJournal(object):
+
+    def __init__(self, journalFile):
+        """the file is only created once the first statement is appended"""
+        self._journalFile = journalFile
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = 0
+        self._writers = 0
+        # a retry or re-run appends to the same file so groups are told apart by the journal that wrote them
+        self._attempt = uuid.uuid4().hex
+        # writer: the group its next entries are appended to
+        self._groups = {}
+
+    def getJournalFile(self):
+        return self._journalFile
+
+    def _open(self):
+        journalDir = os.path.dirname(self._journalFile)
+        if journalDir and not os.path.exists(journalDir):
+            try:
+                os.makedirs(journalDir)
+            except OSError:
+                if not os.path.isdir(journalDir):
+                    raise
+        fd = os.open(self._journalFile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, JOURNAL_FILE_MODE)
+        self._file = os.fdopen(fd, 'a')
+        if os.fstat(fd).st_size == 0:
+            self._file.write(json.dumps({'version': JOURNAL_VERSION}) + "\n")
+
+    def addWriter(self):
+        """returns an id for a connection appending to the journal so its groups are told apart"""
+        with self._lock:
+            self._writers += 1
+            return self._writers
+
+    def append(self, users, accessLevel, query, qArgs, inverseList, writer=None):
+        """
+        records a statement before it runs, call sync before sending it to the server
+        :param users: the user@hosts the statement changes
+        :param inverseList: [(accessLevel, query, qArgs)] that undo it or None when it can not be undone
+        """
+        with self._lock:
+            entry = {'users': list(users),
+                     'statement': [accessLevel, query, qArgs],
+                     'inverse': inverseList,
+                     'group': [self._attempt, writer, self._groups.get(writer, 0)]}
+            if self._file is None:
+                self._open()
+            # without sort_keys json uses its c encoder
+            self._file.write(json.dumps(entry, separators=(',', ':')) + "\n")
+            self._unsynced += 1
+
+    def sync(self, writer=None):
+        """
+        makes the appended statements durable, one fsync covers a whole batch
+        the entries writer appended since its last sync form a group that is about to be sent
+        """
+        with self._lock:
+            self._groups[writer] = self._groups.get(writer, 0) + 1
+            if self._file is not None and 0 < self._unsynced:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+
+    def sent(self, writer=None):
+        """
+        records that the group writer synced last has run
+        it is not synced as losing it to a crash only lets undo tolerate more missing grants
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps({'sent': [self._attempt, writer, self._groups.get(writer, 0) - 1]},
+                                           separators=(',', ':')) + "\n")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+
+def readJournal(journalFile):
+    """
+    returns the entries appended to journalFile or None when there is no journal
+    a last line cut short by a crash was never synced so its statement never ran and it is skipped
+    each entry's 'sent' is False when its statement may not have run e.g. its batch failed
+    or the run stopped before it finished
+    """
+    if not os.path.exists(journalFile):
+        return None
+    entryList = []
+    sentGroups = set()
+    with open(journalFile) as f:
+        lineList = f.read().split("\n")
+    header = json.loads(lineList[0])
+    if header.get('version') != JOURNAL_VERSION:
+        raise GrantJournalException("unsupported journal version %s in %s expected %s" %
+                                    (header.get('version'), journalFile, JOURNAL_VERSION))
+    for i, line in enumerate(lineList[1:]):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            if i + 2 < len(lineList) and lineList[i + 2].strip():
+                raise GrantJournalException("%s is corrupt at line %d" % (journalFile, i + 2))
+            logger.warning("skipping the torn last entry of %s", journalFile)
+            continue
+        if 'sent' in entry:
+            sentGroups.add(tuple(entry['sent']))
+        else:
+            entryList.append(entry)
+    for i, entry in enumerate(entryList):
+        if 'group' in entry:
+            entry['sent'] = tuple(entry['group']) in sentGroups
+        else:
+            # without groups only the last statement may not have run
+            entry['sent'] = i + 1 < len(entryList)
+    return entryList
+
+
+def getInverseList(entryList, userList=None):
+    """
+    returns the (accessLevel, query, qArgs) undoing entryList newest first
+    :param userList: only the entries changing accounts of these user names are undone
+    """
+    inverseList = []
+    for entry in reversed(entryList):
+        if userList is not None and not any(x.rsplit('@', 1)[0] in userList for x in entry['users']):
+            continue
+        if entry['inverse'] is None:
+            logger.warning("%s can not be undone", entry['statement'][1])
+            continue
+        for accessLevel, query, qArgs in entry['inverse']:
+            if qArgs is not None:
+                qArgs = tuple(qArgs)
+            inverseList.append((accessLevel, query, qArgs))
+    return inverseList
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+grant_plan is a module to save the statements a run would execute
+ so they can be applied later without querying ldap and every cluster again
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+logger = logging.getLogger(__name__)
+PLAN_VERSION = 1
+PLAN_FILE_MODE = 0600
+# how a planned statement is applied, a CREATE USER goes through createUser so a leftover account is recreated
+STEP_QUERY = "query"
+STEP_CREATE_USER = "create_user"
+
+
+class PlanException(Exception):
+    pass
+
+
+class GrantPlan(object):
+
+    def __init__(self, options=None):
+        """
+        options is a dict of the arguments the plan was made with
+        e.g. {'destructive': False, 'accessLevel': 2}
+        """
+        self._options = options
+        if self._options is None:
+            self._options = {}
+        self._created = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        self._clusters = {}
+        self._newUsers = {}
+        self._defaultCluster = None
+        self._runHash = None
+
+    def _getCluster(self, cluster):
+        if cluster not in self._clusters:
+            self._clusters[cluster] = {'fingerprint': None, 'statements': []}
+        return self._clusters[cluster]
+
+    def getOption(self, name, default=None):
+        return self._options.get(name, default)
+
+    def getCreated(self):
+        return self._created
+
+    def setFingerprint(self, cluster, fingerprint):
+        """the digest of the server state the statements were computed from"""
+        self._getCluster(cluster)['fingerprint'] = fingerprint
+
+    def getFingerprint(self, cluster):
+        return self._getCluster(cluster)['fingerprint']
+
+    def setInputHashes(self, cluster, clusterInputHash, userInputHashDict):
+        """the state_store digests of what the cluster was planned from"""
+        self._getCluster(cluster)['inputs'] = {'cluster': clusterInputHash,
+                                               'users': userInputHashDict}
+
+    def getInputHashes(self, cluster):
+        """returns (clusterInputHash, userInputHashDict) or (None, None)"""
+        inputs = self._getCluster(cluster).get('inputs')
+        if inputs is None:
+            return None, None
+        return inputs['cluster'], inputs['users']
+
+    def setRunHash(self, runHash):
+        """the state_store.hashRunInputs digest the plan was made from"""
+        self._runHash = runHash
+
+    def getRunHash(self):
+        """returns the digest checkpoints of applying the plan are kept under"""
+        if self._runHash is None:
+            # plans saved before run hashes are identified by their contents
+            return hashlib.sha1(json.dumps(self._clusters, sort_keys=True)).hexdigest()
+        return self._runHash
+
+    def clearStatements(self, cluster):
+        """forgets what was recorded for cluster so a retried cluster is not recorded twice"""
+        self._getCluster(cluster)['statements'] = []
+
+    def removeCluster(self, cluster):
+        """a cluster that could not be planned is left out of the plan"""
+        self._clusters.pop(cluster, None)
+
+    def addStatement(self, cluster, accessLevel, query, qArgs, step=STEP_QUERY):
+        if qArgs is not None:
+            qArgs = list(qArgs)
+        statement = [accessLevel, query, qArgs]
+        if step != STEP_QUERY:
+            statement.append(step)
+        self._getCluster(cluster)['statements'].append(statement)
+
+    def getStatements(self, cluster):
+        """returns a list of (accessLevel, query, qArgs) tuples"""
+        return [x[1:] for x in self.getSteps(cluster)]
+
+    def getSteps(self, cluster):
+        """returns a list of (step, accessLevel, query, qArgs) tuples"""
+        steps = []
+        for statement in self._getCluster(cluster)['statements']:
+            accessLevel, query, qArgs = statement[:3]
+            if qArgs is not None:
+                qArgs = tuple(qArgs)
+            step = STEP_QUERY
+            if 3 < len(statement):
+                step = statement[3]
+            steps.append((step, accessLevel, query, qArgs))
+        return steps
+
+    def getClusters(self):
+        return sorted(self._clusters.keys())
+
+    def getStatementCount(self):
+        return sum(len(x['statements']) for x in self._clusters.values())
+
+    def setDefaultCluster(self, defaultCluster):
+        self._defaultCluster = defaultCluster
+
+    def getDefaultCluster(self):
+        return self._defaultCluster
+
+    def setNewUsers(self, newUsers):
+        """newUsers must only hold json serializable values"""
+        self._newUsers = newUsers
+
+    def getNewUsers(self):
+        return self._newUsers
+
+    def toDict(self):
+        return {'version': PLAN_VERSION,
+                'created': self._created,
+                'options': self._options,
+                'default_cluster': self._defaultCluster,
+                'clusters': self._clusters,
+                'new_users': self._newUsers,
+                'run_hash': self._runHash}
+
+    def save(self, planFile):
+        """writes the plan readable only by the owner as it holds new passwords"""
+        planDir = os.path.dirname(planFile)
+        if 0 < len(planDir) and not os.path.exists(planDir):
+            os.makedirs(planDir)
+        fd = os.open(planFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, PLAN_FILE_MODE)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.toDict(), f, sort_keys=True, separators=(',', ':'))
+        logger.info("saved plan of %d statements on %d clusters to %s",
+                    self.getStatementCount(), len(self._clusters), planFile)
+
+    @classmethod
+    def fromDict(cls, planDict):
+        version = planDict.get('version')
+        if version != PLAN_VERSION:
+            raise PlanException("unsupported plan version %s expected %s" % (version, PLAN_VERSION))
+        grantPlan = cls(planDict['options'])
+        grantPlan._created = planDict['created']
+        grantPlan._clusters = planDict['clusters']
+        grantPlan._newUsers = planDict['new_users']
+        grantPlan._defaultCluster = planDict['default_cluster']
+        grantPlan._runHash = planDict.get('run_hash')
+        return grantPlan
+
+    @classmethod
+    def load(cls, planFile):
+        try:
+            with open(planFile) as f:
+                planDict = json.load(f)
+        except (IOError, ValueError) as e:
+            raise PlanException("could not read plan %s: %s" % (planFile, e))
+        return cls.fromDict(planDict)
@@ -15,34 +15,90 @@ import mysql_query_tool
 import os
 import pprint
 import sys
+import threading
+import time
+import util
 logger = logging.getLogger(__name__)
 DEFAULT_SCHEMA_DIR = os.path.join(os.path.expanduser("~"), 'mysqlschemas')
 BACKUP_DIR_FMT = '%Y%m%d-%H%M%S'
+DEFAULT_IMPORT_WORKERS = 4
+DEFAULT_HOST_CONCURRENCY = 2
+
+
+class SchemaImportException(Exception):
+    pass
+
+
+def getImportLanes(mysqlSchemasToImport):
+    """
+    returns [[(cluster, dbTableSrc, dbTableDst)]] the mysql_schemas entries in config order
+    grouped by destination and by source, the entries of a lane load the same database
+    or dump to the same file so run one after another
+    """
+    laneList = []
+    # ('dst', dbTableDst) or ('src', cluster, dbTableSrc): [(config index, entry)]
+    keyLaneDict = {}
+    index = 0
+    for entry in mysqlSchemasToImport:
+        cluster = entry.keys()[0]
+        for dbTableEntry in entry[cluster]:
+            dbTableSrc = dbTableEntry.keys()[0]
+            dbTableDst = dbTableEntry[dbTableSrc]
+            keys = [('dst', dbTableDst), ('src', cluster, dbTableSrc)]
+            lane = None
+            for key in keys:
+                other = keyLaneDict.get(key)
+                if other is None or other is lane:
+                    continue
+                if lane is None:
+                    lane = other
+                    continue
+                # the entry joins two lanes so they become one kept in config order
+                lane.extend(other)
+                lane.sort()
+                laneList = [x for x in laneList if x is not other]
+                for otherKey in [x for x, y in keyLaneDict.items() if y is other]:
+                    keyLaneDict[otherKey] = lane
+            if lane is None:
+                lane = []
+                laneList.append(lane)
+            lane.append((index, (cluster, dbTableSrc, dbTableDst)))
+            for key in keys:
+                keyLaneDict[key] = lane
+            index += 1
+    return [[x[1] for x in lane] for lane in laneList]
 
 
 class SchemaImportTool(object):
 
-    def __init__(self, echoOnly, logPasswords, backupPath, localMysqlUser, localMysqlPass):
+    def __init__(self, echoOnly, logPasswords, backupPath, localMysqlUser, localMysqlPass, stream=False,
+                 archiveCompression=None, workers=DEFAULT_IMPORT_WORKERS, hostConcurrency=DEFAULT_HOST_CONCURRENCY):
+        """
+        with stream each dump is piped into the local mysql as it is read rather than written to a file first
+        and with an archiveCompression it is also kept under backupPath compressed with it,
+        without stream the dump file itself is written compressed with it
+        up to workers entries are imported at once and at most hostConcurrency of them from one host
+        """
         self.backupPath = backupPath
+        self.stream = stream
+        self.archiveCompression = archiveCompression
+        self.workers = max(workers, 1)
+        self.hostConcurrency = max(hostConcurrency, 1)
         self.echoOnly = echoOnly
         self.logPasswords = logPasswords
         self.localMysqlCluster = "localhost"
         self.localMysqlUser = localMysqlUser
         self.localMysqlPass = localMysqlPass
         self.myDotCnf = my_dot_cnf.MyDotCnf()
-        self.mysqlBackupTool = mysql_backup_tool.MysqlBackupTool(self.echoOnly, self.logPasswords, self.backupPath)
+        # the dumps are only kept to be restored locally so they are not compressed
+        self.mysqlBackupTool = mysql_backup_tool.MysqlBackupTool(self.echoOnly, self.logPasswords, self.backupPath,
+                                                                 mysql_backup_tool.COMPRESSION_NONE, self.workers)
 
     def importUsers(self, importSchemaConfig):
         mysqlUsersToImport = importSchemaConfig.getMysqlUsers()
         if mysqlUsersToImport:
             logger.info("import users", mysqlUsersToImport)
-            localMysql = mysql_query_tool.MysqlQueryTool(self.localMysqlCluster,
-                                                         self.localMysqlUser,
-                                                         self.localMysqlPass,
-                                                         mysql_query_tool.QAL_ALL,
-                                                         mysql_query_tool.QAL_READ if self.echoOnly else mysql_query_tool.QAL_ALL,
-                                                         self.logPasswords,
-                                                         "mysql")
+            localMysql = self.makeLocalMysql()
             for cluster in mysqlUsersToImport.keys():
                 remoteMysql = mysql_query_tool.MysqlQueryTool(cluster,
                                                               self.remoteMysqlUser,
@@ -65,31 +121,120 @@ class SchemaImportTool(object):
                                               userGrantDict[dbTable],
                                               dbTable)
 
+    def makeLocalMysql(self):
+        return mysql_query_tool.MysqlQueryTool(self.localMysqlCluster,
+                                               self.localMysqlUser,
+                                               self.localMysqlPass,
+                                               mysql_query_tool.QAL_ALL,
+                                               mysql_query_tool.QAL_READ if self.echoOnly else mysql_query_tool.QAL_ALL,
+                                               self.logPasswords,
+                                               "mysql")
+
     def importSchema(self, importSchemaConfig):
-        extraArgs = ["--single-transaction", "--no-data"]
+        """
+        imports the mysql_schemas entries using up to workers threads each with its own local connection
+        entries sharing a destination or a source keep their config order, a failed entry skips the rest of its lane
+        """
         backupName = self.mysqlBackupTool.getCurrentTimeBackup()
-        mysqlSchemasToImport = importSchemaConfig.getMysqlSchemas()
-        localMysql = mysql_query_tool.MysqlQueryTool(self.localMysqlCluster,
-                                                     self.localMysqlUser,
-                                                     self.localMysqlPass,
-                                                     mysql_query_tool.QAL_ALL,
-                                                     mysql_query_tool.QAL_READ if self.echoOnly else mysql_query_tool.QAL_ALL,
-                                                     self.logPasswords,
-                                                     "mysql")
-        for entry in mysqlSchemasToImport:
-            cluster = entry.keys()[0]
-            dbTableList = entry[cluster]
-            for dbTableEntry in dbTableList:
-                dbTableSrc = dbTableEntry.keys()[0]
-                dbTableDst = dbTableEntry[dbTableSrc]
-                dbSrc = dbTableSrc
-                tableSrc = None
-                if '.' in dbTableSrc:
-                    dbSrc, tableSrc = dbTableSrc.split(".")
-                localMysql.createDatabase(dbTableDst)
-                dumpFile = self.mysqlBackupTool.getBackupSQLFile(backupName, cluster, dbSrc, tableSrc)
-                self.mysqlBackupTool.performMySQLDump(cluster, self.remoteMysqlUser, self.remoteMysqlPass, dbTableSrc, dumpFile, extraArgs)
-                self.mysqlBackupTool.restoreFromMySQLDump(self.localMysqlCluster, self.localMysqlUser, self.localMysqlPass, dbTableDst, dumpFile)
+        laneList = getImportLanes(importSchemaConfig.getMysqlSchemas())
+        entryCount = sum(len(x) for x in laneList)
+        # a worker only takes an entry once its host has a free slot so no worker waits on a busy host
+        hostRunningDict = dict((entry[0], 0) for lane in laneList for entry in lane)
+        # the next entry of each lane, None once the lane is running, finished or failed
+        laneNextList = [0] * len(laneList)
+        laneCondition = threading.Condition()
+        # (cluster, dbTableSrc, dbTableDst): (stats, exception, seconds)
+        resultDict = {}
+        progressDict = {'done': 0, 'left': len(laneList)}
+
+        def takeEntry():
+            """returns (laneIndex, nextIndex) of the first lane whose next entry's host is free or None when done"""
+            with laneCondition:
+                while 0 < progressDict['left']:
+                    for laneIndex, nextIndex in enumerate(laneNextList):
+                        if nextIndex is None:
+                            continue
+                        entry = laneList[laneIndex][nextIndex]
+                        if hostRunningDict[entry[0]] < self.hostConcurrency:
+                            hostRunningDict[entry[0]] += 1
+                            laneNextList[laneIndex] = None
+                            return laneIndex, nextIndex
+                    laneCondition.wait(0.5)
+                return None
+
+        def finishEntry(laneIndex, nextIndex, failed):
+            with laneCondition:
+                hostRunningDict[laneList[laneIndex][nextIndex][0]] -= 1
+                progressDict['done'] += 1
+                if failed or nextIndex + 1 == len(laneList[laneIndex]):
+                    # a failed entry skips the rest of its lane
+                    progressDict['left'] -= 1
+                else:
+                    laneNextList[laneIndex] = nextIndex + 1
+                laneCondition.notify_all()
+
+        def importWorker(workerIndex):
+            localMysql = self.makeLocalMysql()
+            try:
+                while True:
+                    taken = takeEntry()
+                    if taken is None:
+                        return
+                    laneIndex, nextIndex = taken
+                    entry = laneList[laneIndex][nextIndex]
+                    cluster, dbTableSrc, dbTableDst = entry
+                    startTime = time.time()
+                    try:
+                        stats = self.importEntry(localMysql, backupName, cluster, dbTableSrc, dbTableDst)
+                        resultDict[entry] = (stats, None, time.time() - startTime)
+                    except Exception as e:
+                        logger.error("%s:%s into %s failed with exception:%s", cluster, dbTableSrc, dbTableDst, e)
+                        resultDict[entry] = (None, e, time.time() - startTime)
+                    finishEntry(laneIndex, nextIndex, resultDict[entry][1] is not None)
+                    with laneCondition:
+                        logger.info("[%d/%d] %s:%s into %s %s in %.2fs, %d running",
+                                    progressDict['done'], entryCount, cluster, dbTableSrc, dbTableDst,
+                                    "FAILED" if resultDict[entry][1] is not None else "done",
+                                    resultDict[entry][2], sum(hostRunningDict.values()))
+            finally:
+                localMysql.closeConnection()
+        workers = min(self.workers, len(laneList))
+        if self.echoOnly is True:
+            # echoed commands keep the config order of each lane and the lanes follow each other
+            workers = 1
+        util.runInWorkerPool(range(workers), workers, importWorker)
+        entryList = [x for lane in laneList for x in lane]
+        logImportTimings(entryList, resultDict)
+        errorList = ["%s:%s into %s: %s" % (x + (resultDict[x][1],)) for x in entryList
+                     if x in resultDict and resultDict[x][1] is not None]
+        if 0 < len(errorList):
+            raise SchemaImportException("\n".join(errorList))
+
+    def importEntry(self, localMysql, backupName, cluster, dbTableSrc, dbTableDst):
+        """imports dbTableSrc of cluster into dbTableDst, returns the stats of a streamed import or None"""
+        extraArgs = ["--single-transaction", "--no-data"]
+        dbSrc = dbTableSrc
+        tableSrc = None
+        if '.' in dbTableSrc:
+            dbSrc, tableSrc = dbTableSrc.split(".")
+        localMysql.createDatabase(dbTableDst)
+        stats = None
+        if self.stream:
+            archiveFile = None
+            if self.archiveCompression is not None:
+                archiveFile = self.mysqlBackupTool.getBackupSQLFile(backupName, cluster, dbSrc, tableSrc,
+                                                                    self.archiveCompression)
+            stats = self.mysqlBackupTool.pipeMySQLDump(cluster, self.remoteMysqlUser, self.remoteMysqlPass,
+                                                       dbTableSrc, self.localMysqlCluster, self.localMysqlUser,
+                                                       self.localMysqlPass, dbTableDst, extraArgs, archiveFile)
+            if stats is not None:
+                logImportStats(cluster, dbTableSrc, dbTableDst, stats)
+        else:
+            dumpFile = self.mysqlBackupTool.getBackupSQLFile(backupName, cluster, dbSrc, tableSrc,
+                                                             self.archiveCompression)
+            self.mysqlBackupTool.performMySQLDump(cluster, self.remoteMysqlUser, self.remoteMysqlPass, dbTableSrc, dumpFile, extraArgs)
+            self.mysqlBackupTool.restoreFromMySQLDump(self.localMysqlCluster, self.localMysqlUser, self.localMysqlPass, dbTableDst, dumpFile)
+        return stats
 
     def start(self, yamlConf):
         importSchemaConfig = import_schema_config.ImportSchemaConfig(yamlConf)
@@ -105,6 +250,32 @@ class SchemaImportTool(object):
         self.importSchema(importSchemaConfig)
 
 
+def logImportStats(cluster, dbTableSrc, dbTableDst, stats):
+    """logs the bytes and rows per second a streamed import ran at"""
+    seconds = max(stats['seconds'], 0.001)
+    logger.info("imported %s:%s into %s %d bytes %d rows in %.2fs (%.2f MB/s %.0f rows/s)",
+                cluster, dbTableSrc, dbTableDst, stats['bytes'], stats['rows'], stats['seconds'],
+                stats['bytes'] / seconds / (1 << 20), stats['rows'] / seconds)
+
+
+def logImportTimings(entryList, resultDict):
+    """logs how long each entry took sorted from slowest to fastest, entries skipped after a failure last"""
+    logger.info("import timing summary:")
+    for entry in sorted(entryList, key=lambda x: resultDict.get(x, (None, None, -1))[2], reverse=True):
+        cluster, dbTableSrc, dbTableDst = entry
+        if entry not in resultDict:
+            logger.info("  %-20s %-30s %-20s %8s %14s %12s %s", cluster, dbTableSrc, dbTableDst,
+                        "-", "-", "-", "SKIPPED")
+            continue
+        stats, error, seconds = resultDict[entry]
+        byteCount = rowCount = "-"
+        if stats is not None:
+            byteCount = "%d bytes" % stats['bytes']
+            rowCount = "%d rows" % stats['rows']
+        logger.info("  %-20s %-30s %-20s %8.2fs %14s %12s %s", cluster, dbTableSrc, dbTableDst, seconds,
+                    byteCount, rowCount, "FAILED" if error is not None else "ok")
+
+
 def main(args=None):
     """Arg parsing and logger setup"""
     retCode = 0
@@ -132,6 +303,16 @@ def main(args=None):
                         help="useful if you want to pipe the output to mysql tool")
     parser.add_argument('-y', '--yaml-conf', type=str, default=None,
                         help="the yaml configuration path")
+    parser.add_argument('-s', '--stream', action='store_true', default=False,
+                        help="pipe each mysqldump straight into the local mysql without a dump file")
+    parser.add_argument('-a', '--archive', type=str, default=None,
+                        choices=mysql_backup_tool.COMPRESSIONS,
+                        help="compress the dumps kept under the backup path with this, "
+                             "with --stream each dump is also kept")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_IMPORT_WORKERS,
+                        help="the number of schemas imported at once")
+    parser.add_argument('--host-concurrency', type=int, default=DEFAULT_HOST_CONCURRENCY,
+                        help="the most schemas imported at once from one host")
     parsedArgs = parser.parse_args(args)
     assert (parsedArgs.backup_path is not '/'), "must not be the root directory"
     logger.info(pprint.pformat(parsedArgs))
@@ -142,7 +323,9 @@ def main(args=None):
         logger.warn("Unknown logLevel=%s retaining level at INFO",
                     parsedArgs.log_level)
     logger.info(pprint.pformat(parsedArgs))
-    schemaImportTool = SchemaImportTool(parsedArgs.echo_only, parsedArgs.log_passwords, parsedArgs.backup_path, parsedArgs.username, parsedArgs.password)
+    schemaImportTool = SchemaImportTool(parsedArgs.echo_only, parsedArgs.log_passwords, parsedArgs.backup_path, parsedArgs.username, parsedArgs.password,
+                                        parsedArgs.stream, parsedArgs.archive, parsedArgs.workers,
+                                        parsedArgs.host_concurrency)
     schemaImportTool.start(parsedArgs.yaml_conf)
     logger.info("Done!")
     return retCode
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+ldap_cache is a module to keep the ldap groups on disk between runs
+ so only groups whose modifyTimestamp or entryCSN moved are fetched again
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+logger = logging.getLogger(__name__)
+CACHE_VERSION = 1
+CACHE_FILE_MODE = 0600
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), 'mysqlgrants_ldap_cache')
+DEFAULT_CACHE_TTL = 3600
+STAMP_ATTRIBUTES = ['modifyTimestamp', 'entryCSN']
+CACHE_ATTRIBUTES = ['cn', 'gidNumber', 'memberUid'] + STAMP_ATTRIBUTES
+CACHE_MODE_USE = 'use'
+CACHE_MODE_REFRESH = 'refresh'
+CACHE_MODES = [CACHE_MODE_USE, CACHE_MODE_REFRESH]
+# refetch everything when more than this fraction of the groups changed
+FULL_FETCH_RATIO = 0.5
+
+
+def getStamp(attrs):
+    """returns the change markers of an entry, None when the server exposes neither"""
+    stamp = [attrs.get(x, [None])[0] for x in STAMP_ATTRIBUTES]
+    if stamp == [None] * len(STAMP_ATTRIBUTES):
+        return None
+    return stamp
+
+
+class LdapGroupCache(object):
+
+    def __init__(self, ldapUrl, groupDesc, ttl=DEFAULT_CACHE_TTL, cacheDir=DEFAULT_CACHE_DIR):
+        self._ldapUrl = ldapUrl
+        self._groupDesc = groupDesc
+        self._ttl = ttl
+        cacheKey = hashlib.sha1(ldapUrl + "\n" + groupDesc).hexdigest()
+        self._cacheFile = os.path.join(cacheDir, cacheKey + ".json")
+
+    def getCacheFile(self):
+        return self._cacheFile
+
+    def _load(self):
+        try:
+            with open(self._cacheFile) as f:
+                cacheDict = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.debug("no usable ldap cache at %s: %s", self._cacheFile, e)
+            return None
+        if cacheDict.get('version') != CACHE_VERSION:
+            return None
+        return cacheDict
+
+    def _save(self, cacheDict):
+        """writes to a temp file and renames it so readers never see half a cache"""
+        cacheDir = os.path.dirname(self._cacheFile)
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        tmpFile = self._cacheFile + ".tmp"
+        fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, CACHE_FILE_MODE)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cacheDict, f, sort_keys=True, separators=(',', ':'))
+        os.rename(tmpFile, self._cacheFile)
+
+    def getGroupEntries(self, connect, minGid, gidOrdering, pageSize, mode=CACHE_MODE_USE):
+        """
+        returns {dn: attrs} of every posixGroup under the group desc
+        :param connect: returns an ldap_query_tool.LdapQueryTool, only called when ldap is needed
+        :param mode: CACHE_MODE_USE trusts a cache younger than the ttl
+                     CACHE_MODE_REFRESH always asks ldap what changed
+        """
+        now = time.time()
+        queryKey = [minGid, gidOrdering]
+        cacheDict = self._load()
+        if cacheDict is not None and cacheDict['query'] != queryKey:
+            logger.info("ldap cache %s was made with another query, refetching", self._cacheFile)
+            cacheDict = None
+        if cacheDict is not None and mode == CACHE_MODE_USE and now - cacheDict['fetched'] < self._ttl:
+            logger.info("using %d cached ldap groups from %s", len(cacheDict['groups']), self._cacheFile)
+            return cacheDict['groups']
+        ldapQueryTool = connect()
+        groupDict = None
+        if cacheDict is not None:
+            groupDict = self._refreshChanged(ldapQueryTool, cacheDict['groups'], minGid,
+                                             gidOrdering, pageSize)
+        if groupDict is None:
+            groupDict = dict(ldapQueryTool.iterGroups(self._groupDesc, minGid, None, None,
+                                                      gidOrdering, pageSize, CACHE_ATTRIBUTES))
+            logger.info("fetched %d ldap groups into %s", len(groupDict), self._cacheFile)
+        self._save({'version': CACHE_VERSION,
+                    'url': self._ldapUrl,
+                    'desc': self._groupDesc,
+                    'query': queryKey,
+                    'fetched': now,
+                    'groups': groupDict})
+        return groupDict
+
+    def _refreshChanged(self, ldapQueryTool, cachedGroups, minGid, gidOrdering, pageSize):
+        """returns the cached groups with the changed ones refetched or None to refetch everything"""
+        stampDict = dict(ldapQueryTool.iterGroups(self._groupDesc, minGid, None, None,
+                                                  gidOrdering, pageSize, STAMP_ATTRIBUTES))
+        changedList = []
+        for dn in stampDict.keys():
+            stamp = getStamp(stampDict[dn])
+            if stamp is None:
+                logger.info("ldap groups have no %s, refetching", " or ".join(STAMP_ATTRIBUTES))
+                return None
+            if dn not in cachedGroups or stamp != getStamp(cachedGroups[dn]):
+                changedList.append(dn)
+        if FULL_FETCH_RATIO * len(stampDict) < len(changedList):
+            return None
+        groupDict = {}
+        for dn in stampDict.keys():
+            if dn in cachedGroups:
+                groupDict[dn] = cachedGroups[dn]
+        for dn in changedList:
+            attrs = ldapQueryTool.queryEntry(dn, CACHE_ATTRIBUTES)
+            if attrs is None:
+                groupDict.pop(dn, None)
+            else:
+                groupDict[dn] = attrs
+        logger.info("refreshed %d changed and dropped %d removed of %d ldap groups", len(changedList),
+                    len(set(cachedGroups.keys()) - set(stampDict.keys())), len(groupDict))
+        return groupDict
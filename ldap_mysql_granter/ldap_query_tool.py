@@ -6,18 +6,60 @@ ldap_query_tool tool to do ldap search queries
  author:   Nicholas Flink <nicholas@sproutsocial.com>
 """
 import argparse
+import json
 import logging
 import ldap
+import ldap.filter
+import ldif
 import pprint
 import sys
+from ldap.controls import SimplePagedResultsControl
 
 logger = logging.getLogger(__name__)
+GROUP_ATTRIBUTES = ['cn', 'gidNumber', 'memberUid']
+# mysql <= 5.6 user names are truncated to this many characters
+MAX_MYSQL_USER_LENGTH = 16
+DEFAULT_PAGE_SIZE = 500
 
 
 class InvalidConfigException(Exception):
     pass
 
 
+def makeGroupFilter(minGid=None, groupList=None, userList=None, gidOrdering=False):
+    """
+    builds a filter matching the posixGroups a run needs
+    :param minGid: skip groups below this gidNumber, needs gidOrdering
+    :param groupList: only match groups with one of these cn
+    :param userList: only match groups with one of these memberUid
+    :param gidOrdering: the server schema has an ORDERING rule for gidNumber
+                        nis.schema does not so the gid is checked client side
+    :returns: a filter like (&(objectClass=posixGroup)(gidNumber>=20000))
+    """
+    termList = ["(objectClass=posixGroup)"]
+    if minGid is not None and 0 < minGid and gidOrdering:
+        termList.append("(gidNumber>=%d)" % minGid)
+    if groupList is not None:
+        termList.append(_makeOrFilter("cn", [ldap.filter.escape_filter_chars(x) for x in groupList]))
+    if userList is not None:
+        memberList = []
+        for user in userList:
+            member = ldap.filter.escape_filter_chars(user)
+            if MAX_MYSQL_USER_LENGTH <= len(user):
+                # a truncated name still matches the full ldap uid
+                member += "*"
+            memberList.append(member)
+        termList.append(_makeOrFilter("memberUid", memberList))
+    return "(&%s)" % "".join(termList)
+
+
+def _makeOrFilter(attribute, valueList):
+    """valueList must already be escaped, an empty list matches nothing"""
+    if 0 == len(valueList):
+        return "(!(objectClass=*))"
+    return "(|%s)" % "".join("(%s=%s)" % (attribute, x) for x in sorted(set(valueList)))
+
+
 class LdapQueryTool(object):
 
     def __init__(self, ldapUrl, usernameBase, password):
@@ -26,23 +68,92 @@ class LdapQueryTool(object):
         self._connection.protocol_version = ldap.VERSION3
         self._connection.simple_bind_s(usernameBase, password)
 
-    def queryLDAP(self, base, searchFilter=None):
+    def iterLDAP(self, base, searchFilter=None, attrList=None, pageSize=None):
+        """
+        yields (dn, attrs) as each page of results arrives
+        :param attrList: limits the attributes returned, None returns them all
+        :param pageSize: the entries per page using the simple paged results control
+                         None or 0 fetches everything in one search
+        """
         baseDN = base
         searchScope = ldap.SCOPE_SUBTREE
-        rawResult = None
-        resultDict = {}
-        if searchFilter is not None:
+        if searchFilter is None:
+            searchFilter = "(objectClass=*)"
+        if pageSize is None or pageSize <= 0:
             rawResult = self._connection.search_st(baseDN, searchScope,
                                                    searchFilter,
+                                                   attrlist=attrList,
                                                    timeout=self._timeout)
-        else:
-            rawResult = self._connection.search_st(baseDN, searchScope,
-                                                   timeout=self._timeout)
-        for resultTuple in rawResult:
-            resultType, resultData = resultTuple
-            resultDict[resultType] = resultData
+            for dn, attrs in rawResult:
+                yield dn, attrs
+            return
+        pageControl = SimplePagedResultsControl(True, size=pageSize, cookie='')
+        respControlClasses = {SimplePagedResultsControl.controlType: SimplePagedResultsControl}
+        pageCount = 0
+        while True:
+            msgId = self._connection.search_ext(baseDN, searchScope, searchFilter,
+                                                attrlist=attrList,
+                                                serverctrls=[pageControl],
+                                                timeout=self._timeout)
+            resultType, resultData, msgId, serverControls = self._connection.result3(
+                msgId, timeout=self._timeout, resp_ctrl_classes=respControlClasses)
+            pageCount += 1
+            for dn, attrs in resultData:
+                # search continuation references have no dn
+                if dn is not None:
+                    yield dn, attrs
+            cookie = None
+            for serverControl in serverControls:
+                if serverControl.controlType == SimplePagedResultsControl.controlType:
+                    cookie = serverControl.cookie
+            if not cookie:
+                break
+            pageControl.cookie = cookie
+        logger.debug("read %d pages of %d entries from %s", pageCount, pageSize, baseDN)
+
+    def queryLDAP(self, base, searchFilter=None, attrList=None, pageSize=None):
+        """returns every matching entry as {dn: attrs}"""
+        resultDict = {}
+        for dn, attrs in self.iterLDAP(base, searchFilter, attrList, pageSize):
+            resultDict[dn] = attrs
         return resultDict
 
+    def queryEntry(self, dn, attrList=None):
+        """returns the attrs of a single entry or None if it no longer exists"""
+        try:
+            rawResult = self._connection.search_st(dn, ldap.SCOPE_BASE,
+                                                   attrlist=attrList,
+                                                   timeout=self._timeout)
+        except ldap.NO_SUCH_OBJECT:
+            return None
+        for resultDn, attrs in rawResult:
+            return attrs
+        return None
+
+    def iterGroups(self, base, minGid=None, groupList=None, userList=None, gidOrdering=False,
+                   pageSize=DEFAULT_PAGE_SIZE, attrList=GROUP_ATTRIBUTES):
+        """yields (dn, attrs) with only the cn, gidNumber and memberUid of the matching posixGroups"""
+        searchFilter = makeGroupFilter(minGid, groupList, userList, gidOrdering)
+        logger.debug("querying %s with %s", base, searchFilter)
+        return self.iterLDAP(base, searchFilter, attrList, pageSize)
+
+    def queryGroups(self, base, minGid=None, groupList=None, userList=None, gidOrdering=False,
+                    pageSize=DEFAULT_PAGE_SIZE):
+        return dict(self.iterGroups(base, minGid, groupList, userList, gidOrdering, pageSize))
+
+
+def writeLdif(entries, output):
+    ldifWriter = ldif.LDIFWriter(output)
+    for dn, attrs in entries:
+        ldifWriter.unparse(dn, attrs)
+        output.flush()
+
+
+def writeJsonLines(entries, output):
+    for dn, attrs in entries:
+        output.write(json.dumps({'dn': dn, 'attributes': attrs}, sort_keys=True) + "\n")
+        output.flush()
+
 
 def main(args=None):
     """Arg parsing and logger setup"""
@@ -52,6 +163,8 @@ def main(args=None):
                  "WARN": logging.WARNING,
                  "ERROR": logging.ERROR,
                  "CRITICAL": logging.CRITICAL}
+    outputDict = {"ldif": writeLdif,
+                  "jsonl": writeJsonLines}
     parser = argparse.ArgumentParser(
         description='A tool to perform mysql queries')
     parser.add_argument('-l', '--log-level', type=str, default="INFO",
@@ -67,6 +180,11 @@ def main(args=None):
                         help="the base of the ldap query")
     parser.add_argument('-f', '--filter', type=str,
                         help="a string to filter results")
+    parser.add_argument('--page-size', type=int, default=None,
+                        help="fetch the results in pages of this many entries")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        choices=sorted(outputDict.keys()),
+                        help="stream each entry as it arrives instead of printing a dict at the end")
     parsedArgs = parser.parse_args(args)
     if parsedArgs.log_level.upper() in logLevels.keys():
         logging.basicConfig(level=logLevels[parsedArgs.log_level.upper()])
@@ -76,8 +194,15 @@ def main(args=None):
                     parsedArgs.log_level)
     logger.info(pprint.pformat(parsedArgs))
     ldapQueryTool = LdapQueryTool(parsedArgs.endpoint, parsedArgs.username, parsedArgs.password)
-    ldapQueryDict = ldapQueryTool.queryLDAP(parsedArgs.base, parsedArgs.filter)
-    pprint.pprint(ldapQueryDict)
+    if parsedArgs.output is not None:
+        entries = ldapQueryTool.iterLDAP(parsedArgs.base, parsedArgs.filter, None, parsedArgs.page_size)
+        outputDict[parsedArgs.output](entries, sys.stdout)
+    elif parsedArgs.page_size is not None:
+        ldapQueryDict = ldapQueryTool.queryLDAP(parsedArgs.base, parsedArgs.filter, None, parsedArgs.page_size)
+        pprint.pprint(ldapQueryDict)
+    else:
+        ldapQueryDict = ldapQueryTool.queryLDAP(parsedArgs.base, parsedArgs.filter)
+        pprint.pprint(ldapQueryDict)
     logger.info("Done!")
     return retCode
 
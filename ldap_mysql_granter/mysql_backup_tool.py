@@ -7,33 +7,185 @@ mysql_grants_generator is a program to automate the generation of mysql grants
 """
 
 import argparse
+import bisect
+import bz2
+import contextlib
 import datetime
+import errno
+import grant_journal
+import gzip
+import hashlib
+import json
 import logging
 import os
 import pprint
+import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import util
+import zlib
 logger = logging.getLogger(__name__)
 DEFAULT_BACKUP_DIR = os.path.join(os.path.expanduser("~"), 'mysqlbackup')
 BACKUP_DIR_FMT = '%Y%m%d-%H%M%S'
+COMPRESSION_NONE = 'none'
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_BZIP2 = 'bzip2'
+COMPRESSIONS = [COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_BZIP2]
+COMPRESSION_SUFFIXES = {COMPRESSION_NONE: "",
+                        COMPRESSION_GZIP: ".gz",
+                        COMPRESSION_BZIP2: ".bz2"}
+# the shell equivalents of the in process compression used by echoed commands
+COMPRESS_CMDS = {COMPRESSION_GZIP: "gzip", COMPRESSION_BZIP2: "bzip2"}
+DECOMPRESS_CMDS = {COMPRESSION_GZIP: "gunzip -c", COMPRESSION_BZIP2: "bunzip2 -c"}
+DEFAULT_COMPRESSION = COMPRESSION_GZIP
+DEFAULT_DUMP_WORKERS = 4
+STREAM_CHUNK_SIZE = 1 << 16
+GRANT_SNAPSHOT_FILE = "grants.jsonl"
+GRANT_SNAPSHOT_VERSION = 1
+BACKUP_FILE_MODE = 0600
+# dumps and snapshots are stored once under BLOB_DIR by the sha1 of their contents
+# each backup directory only holds a manifest of the blobs it is made of
+BLOB_DIR = "blobs"
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+# lists the backups of each cluster in order so lookups and pruning never walk the tree
+CATALOG_FILE = "catalog.json"
+CATALOG_VERSION = 1
+BACKUP_NAME_RE = re.compile(r"^\d{8}-\d{6}$")
+# the escapes a mysql option file reads back, the backslash is escaped first
+OPTION_ESCAPES = [("\\", "\\\\"), ("\n", "\\n"), ("\r", "\\r"), ("\t", "\\t"), ("\b", "\\b")]
+# each extended INSERT mysqldump writes starts one row and every separator after it another
+ROW_MARKERS = ["INSERT INTO `", "),("]
 
 
 class MysqlDumpException(Exception):
     pass
 
 
+class GrantSnapshotException(Exception):
+    pass
+
+
 class MysqlRestoreException(Exception):
     pass
 
 
+class OptionFileException(Exception):
+    pass
+
+
+def getCompression(dumpFile):
+    """returns the compression a dump file is written with from its suffix"""
+    for compression in COMPRESSIONS:
+        suffix = COMPRESSION_SUFFIXES[compression]
+        if 0 < len(suffix) and dumpFile.endswith(suffix):
+            return compression
+    return COMPRESSION_NONE
+
+
+def openDumpFile(dumpFile, mode, compression):
+    if compression == COMPRESSION_GZIP:
+        return gzip.open(dumpFile, mode)
+    if compression == COMPRESSION_BZIP2:
+        return bz2.BZ2File(dumpFile, mode)
+    return open(dumpFile, mode)
+
+
+def quoteOption(value):
+    """
+    returns value quoted for a mysql option file, which has no escape for a quote
+    so the value is enclosed in the quote it does not hold
+    """
+    for char, escape in OPTION_ESCAPES:
+        value = value.replace(char, escape)
+    if '"' not in value:
+        return '"%s"' % value
+    if "'" not in value:
+        return "'%s'" % value
+    raise OptionFileException("a mysql option file can not hold a value with both ' and \"")
+
+
+@contextlib.contextmanager
+def defaultsExtraFile(username, password):
+    """yields an option file readable only by the owner holding the credentials
+       so they never show up in the process list
+    """
+    fd, defaultsFile = tempfile.mkstemp(prefix="mysqlbackup", suffix=".cnf")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write("[client]\nuser=%s\npassword=%s\n" % (quoteOption(username), quoteOption(password)))
+        yield defaultsFile
+    finally:
+        os.remove(defaultsFile)
+
+
+def makeDirs(path):
+    """creates path unless it exists, dump workers may race to create the same one"""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def getManifestName(database, table=None):
+    """returns the name a dump of database or one of its tables is listed under in a manifest"""
+    if table is not None:
+        return database + "." + table + ".sql"
+    return database + ".sql"
+
+
+class DumpRowCounter(object):
+
+    def __init__(self):
+        """
+        counts the rows of a dump as it streams past in chunks, the count is approximate
+        as a value holding one of the ROW_MARKERS is counted as well
+        """
+        self.rows = 0
+        self._tails = dict((x, "") for x in ROW_MARKERS)
+
+    def update(self, chunk):
+        for marker in ROW_MARKERS:
+            data = self._tails[marker] + chunk
+            self.rows += data.count(marker)
+            # a marker split across two chunks is found once the next chunk is added
+            self._tails[marker] = data[-(len(marker) - 1):]
+
+
 class MysqlBackupTool(object):
 
-    def __init__(self, echoOnly, logPasswords, backupPath=DEFAULT_BACKUP_DIR):
+    def __init__(self, echoOnly, logPasswords, backupPath=DEFAULT_BACKUP_DIR,
+                 compression=DEFAULT_COMPRESSION, workers=DEFAULT_DUMP_WORKERS):
+        """
+        dumps are compressed in process with compression
+        and at most workers dumps run at once across every thread sharing the tool
+        """
         self._echoOnly = echoOnly
         self._backupPath = backupPath
         self._logPasswords = logPasswords
         self._backupTime = None
+        self._echoScript = None
+        self._compression = compression
+        self._workers = max(workers, 1)
+        self._dumpSemaphore = threading.BoundedSemaphore(self._workers)
+        self._manifestLock = threading.Lock()
+        self._catalog = None
+        self._catalogMtime = None
+
+    def setEchoScript(self, echoScript):
+        """echoed commands go to the preamble of an echo_script.EchoScript rather than stdout"""
+        self._echoScript = echoScript
+
+    def echo(self, host, command):
+        if self._echoScript is not None:
+            self._echoScript.addPreamble(host, command)
+        else:
+            util.echo(command)
 
     def setEchoOnly(self, echoOnly):
         self._echoOnly = echoOnly
@@ -41,70 +193,442 @@ class MysqlBackupTool(object):
     def setLogPasswords(self, logPasswords):
         self._logPasswords = logPasswords
 
-    def getBackupSQLFile(self, backupName, cluster, database, table=None):
+    def getBackupSQLFile(self, backupName, cluster, database, table=None, compression=None):
+        """returns where the dump is written with compression, the tool's own by default"""
+        if compression is None:
+            compression = self._compression
         backupPath = os.path.join(self._backupPath, backupName, cluster)
         archive = os.path.join(backupPath, database + ".sql")
         if table is not None:
             archive = os.path.join(backupPath, database + "." + table + ".sql")
-        return archive
+        return archive + COMPRESSION_SUFFIXES[compression]
+
+    def findBackupSQLFile(self, backupName, cluster, database, table=None):
+        """returns the dump whatever compression it was written with
+           or where the tool would write it when there is none
+        """
+        for compression in [self._compression] + COMPRESSIONS:
+            archive = self.getBackupSQLFile(backupName, cluster, database, table, compression)
+            if os.path.exists(archive):
+                return archive
+        return self.getBackupSQLFile(backupName, cluster, database, table)
+
+    def getGrantSnapshotFile(self, backupName, cluster, compression=None):
+        if compression is None:
+            compression = self._compression
+        return os.path.join(self._backupPath, backupName, cluster,
+                            GRANT_SNAPSHOT_FILE + COMPRESSION_SUFFIXES[compression])
+
+    def getBlobFile(self, digest, compression):
+        return os.path.join(self._backupPath, BLOB_DIR, digest[:2],
+                            digest + COMPRESSION_SUFFIXES[compression])
+
+    def findBlobFile(self, digest):
+        """returns the blob stored for digest whatever compression it was written with or None"""
+        for compression in [self._compression] + COMPRESSIONS:
+            blobFile = self.getBlobFile(digest, compression)
+            if os.path.exists(blobFile):
+                return blobFile
+        return None
+
+    def storeBlob(self, tmpFile, digest, compression):
+        """moves tmpFile into the blob store unless a blob with the same contents is already there"""
+        blobFile = self.getBlobFile(digest, compression)
+        makeDirs(os.path.dirname(blobFile))
+        if os.path.exists(blobFile):
+            os.remove(tmpFile)
+        else:
+            os.rename(tmpFile, blobFile)
+        return blobFile
+
+    def getManifestFile(self, backupName, cluster):
+        return os.path.join(self._backupPath, backupName, cluster, MANIFEST_FILE)
+
+    def readManifest(self, backupName, cluster):
+        """returns {name: {'blob': digest, 'compression': compression}} or None without a manifest"""
+        manifestFile = self.getManifestFile(backupName, cluster)
+        if not os.path.exists(manifestFile):
+            return None
+        with open(manifestFile) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            raise GrantSnapshotException("unsupported manifest version %s in %s expected %s" %
+                                         (manifest.get('version'), manifestFile, MANIFEST_VERSION))
+        return manifest['files']
+
+    def addToManifest(self, backupName, cluster, name, digest, compression):
+        """records that name of the backup is the blob digest, the manifest is replaced atomically"""
+        manifestFile = self.getManifestFile(backupName, cluster)
+        with self._manifestLock:
+            fileDict = self.readManifest(backupName, cluster) or {}
+            fileDict[name] = {'blob': digest, 'compression': compression}
+            makeDirs(os.path.dirname(manifestFile))
+            tmpFile = manifestFile + ".tmp"
+            fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, BACKUP_FILE_MODE)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'cluster': cluster, 'files': fileDict},
+                          f, sort_keys=True, indent=1)
+            os.rename(tmpFile, manifestFile)
+            self.recordBackup(backupName, cluster)
+
+    def findManifestBlob(self, backupName, cluster, name):
+        """returns the blob file the manifest of the backup lists for name or None"""
+        fileDict = self.readManifest(backupName, cluster)
+        if fileDict is None or name not in fileDict:
+            return None
+        blobFile = self.getBlobFile(fileDict[name]['blob'], fileDict[name]['compression'])
+        if not os.path.exists(blobFile):
+            logger.error("%s of %s on %s is missing its blob %s", name, backupName, cluster, blobFile)
+            return None
+        return blobFile
+
+    def getGrantSnapshotDigest(self, snapshot):
+        """the snapshot's fingerprint already covers every row it was read from"""
+        return hashlib.sha1("%d\0%s" % (GRANT_SNAPSHOT_VERSION, snapshot.getFingerprint())).hexdigest()
+
+    def saveGrantSnapshot(self, backupName, cluster, snapshot):
+        """
+        stores the account records of a mysql_query_tool.GrantSnapshot as a blob of a version header
+        then one json line per account, readable only by the owner as it holds password hashes
+        grants that are unchanged since any kept backup are not written again
+        NOTE: it is written in echo mode too so echoed statements can be reverted
+        """
+        digest = self.getGrantSnapshotDigest(snapshot)
+        blobFile = self.findBlobFile(digest)
+        if blobFile is not None:
+            logger.info("the grants on %s are unchanged since %s was saved", cluster, blobFile)
+            self.addToManifest(backupName, cluster, GRANT_SNAPSHOT_FILE, digest, getCompression(blobFile))
+            return
+        recordList = snapshot.toRecords()
+        blobFile = self.getBlobFile(digest, self._compression)
+        makeDirs(os.path.dirname(blobFile))
+        tmpFile = "%s.%d.tmp" % (blobFile, os.getpid())
+        os.close(os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, BACKUP_FILE_MODE))
+        with openDumpFile(tmpFile, 'wb', self._compression) as f:
+            f.write(json.dumps({'version': GRANT_SNAPSHOT_VERSION,
+                                'accounts': len(recordList)}, sort_keys=True) + "\n")
+            for record in recordList:
+                f.write(json.dumps(record, sort_keys=True, separators=(',', ':')) + "\n")
+        self.storeBlob(tmpFile, digest, self._compression)
+        self.addToManifest(backupName, cluster, GRANT_SNAPSHOT_FILE, digest, self._compression)
+        logger.info("saved the grants of %d accounts on %s to %s", len(recordList), cluster, blobFile)
+
+    def hasGrantSnapshot(self, backupName, cluster):
+        """returns whether the run backupName already saved the grants of cluster, a retry must not replace them"""
+        fileDict = self.readManifest(backupName, cluster)
+        return fileDict is not None and GRANT_SNAPSHOT_FILE in fileDict
+
+    def loadGrantSnapshot(self, backupName, cluster):
+        """returns the account records saved by saveGrantSnapshot or None when there are none"""
+        snapshotFile = self.findManifestBlob(backupName, cluster, GRANT_SNAPSHOT_FILE)
+        if snapshotFile is None:
+            # backups made before the blob store hold the snapshot itself
+            for compression in [self._compression] + COMPRESSIONS:
+                snapshotFile = self.getGrantSnapshotFile(backupName, cluster, compression)
+                if os.path.exists(snapshotFile):
+                    break
+            else:
+                return None
+        with openDumpFile(snapshotFile, 'rb', getCompression(snapshotFile)) as f:
+            header = json.loads(f.readline())
+            if header.get('version') != GRANT_SNAPSHOT_VERSION:
+                raise GrantSnapshotException("unsupported grant snapshot version %s in %s expected %s" %
+                                             (header.get('version'), snapshotFile, GRANT_SNAPSHOT_VERSION))
+            recordList = [json.loads(line) for line in f if line.strip()]
+        if len(recordList) != header['accounts']:
+            raise GrantSnapshotException("%s holds %d of %d accounts" %
+                                         (snapshotFile, len(recordList), header['accounts']))
+        return recordList
+
+    def getJournalFile(self, backupName, cluster):
+        return os.path.join(self._backupPath, backupName, cluster, grant_journal.JOURNAL_FILE)
+
+    def openJournal(self, backupName, cluster):
+        """returns the grant_journal.GrantJournal the run backupName appends the statements it runs on cluster to"""
+        return grant_journal.GrantJournal(self.getJournalFile(backupName, cluster))
+
+    def loadJournal(self, backupName, cluster):
+        """returns the entries journaled by the run backupName on cluster or None without a journal"""
+        return grant_journal.readJournal(self.getJournalFile(backupName, cluster))
 
     def getDumpCmd(self, extraArgs, host, username, password, dbTable, dumpFile, realPassword):
         passwordStr = "--password=REDACTED"
         if realPassword:
             passwordStr = ("--password=%s" % password)
-        dumpCmd = ("mysqldump%s--host=%s --user=%s %s %s > %s"
-                   % (extraArgs, host, username, passwordStr, dbTable, dumpFile))
+        compression = getCompression(dumpFile)
+        compressCmd = ""
+        if compression in COMPRESS_CMDS:
+            compressCmd = " | " + COMPRESS_CMDS[compression]
+        dumpCmd = ("mysqldump%s--host=%s --user=%s %s %s%s > %s"
+                   % (extraArgs, host, username, passwordStr, dbTable, compressCmd, dumpFile))
         return dumpCmd
 
     def getRestoreCmd(self, host, username, password, database, dumpFile, realPassword):
         passwordStr = "--password=REDACTED"
         if realPassword:
             passwordStr = ("--password=%s" % password)
+        compression = getCompression(dumpFile)
+        if compression in DECOMPRESS_CMDS:
+            return ("%s %s | mysql --host=%s --user=%s %s %s"
+                    % (DECOMPRESS_CMDS[compression], dumpFile, host, username, passwordStr, database))
         restoreCmd = ("mysql --host=%s --user=%s %s %s < %s"
                       % (host, username, passwordStr, database, dumpFile))
         return restoreCmd
 
+    def getPipeCmd(self, extraArgs, srcHost, srcUser, srcPass, dbTable, dstHost, dstUser, dstPass,
+                   database, archiveFile, realPassword):
+        srcPassStr = "--password=REDACTED"
+        dstPassStr = "--password=REDACTED"
+        if realPassword:
+            srcPassStr = ("--password=%s" % srcPass)
+            dstPassStr = ("--password=%s" % dstPass)
+        teeCmd = ""
+        if archiveFile is not None:
+            compression = getCompression(archiveFile)
+            if compression in COMPRESS_CMDS:
+                teeCmd = " | tee >(%s > %s)" % (COMPRESS_CMDS[compression], archiveFile)
+            else:
+                teeCmd = " | tee %s" % archiveFile
+        return ("mysqldump%s--host=%s --user=%s %s %s%s | mysql --host=%s --user=%s %s %s"
+                % (extraArgs, srcHost, srcUser, srcPassStr, dbTable, teeCmd, dstHost, dstUser, dstPassStr, database))
+
+    def pipeMySQLDump(self, srcHost, srcUser, srcPass, dbTable, dstHost, dstUser, dstPass, database,
+                      extraArgList=[], archiveFile=None):
+        """
+        restores dbTable of srcHost into database on dstHost as it is dumped without a file in between
+        with an archiveFile the dump is also written to it compressed according to its suffix
+        returns {'bytes': bytes, 'rows': rows, 'seconds': seconds} or None when it is only echoed
+        """
+        extraArgs = ' '
+        if 0 < len(extraArgList):
+            extraArgs += " ".join(extraArgList) + ' '
+        pipeEcho = self.getPipeCmd(extraArgs, srcHost, srcUser, srcPass, dbTable, dstHost, dstUser, dstPass,
+                                   database, archiveFile, self._logPasswords)
+        if self._echoOnly is True:
+            self.echo(dstHost, pipeEcho)
+            return None
+        logger.info("running pipe: %s", pipeEcho)
+        if archiveFile is not None:
+            makeDirs(os.path.dirname(archiveFile))
+        with self._dumpSemaphore:
+            return self.streamPipe(srcHost, srcUser, srcPass, dbTable, dstHost, dstUser, dstPass, database,
+                                   extraArgList, archiveFile, pipeEcho)
+
+    def streamPipe(self, srcHost, srcUser, srcPass, dbTable, dstHost, dstUser, dstPass, database,
+                   extraArgList, archiveFile, pipeEcho):
+        """
+        copies mysqldump's stdout into mysql's stdin counting the bytes and rows on the way
+        the archive is written to a temp file renamed over archiveFile only once both succeeded
+        """
+        startTime = time.time()
+        counter = DumpRowCounter()
+        byteCount = 0
+        tmpFile = None
+        if archiveFile is not None:
+            tmpFile = archiveFile + ".tmp"
+        with defaultsExtraFile(srcUser, srcPass) as dumpDefaults, \
+                defaultsExtraFile(dstUser, dstPass) as restoreDefaults:
+            dumpArgs = (["mysqldump", "--defaults-extra-file=" + dumpDefaults] + list(extraArgList) +
+                        ["--host=" + srcHost] + dbTable.split())
+            restoreArgs = ["mysql", "--defaults-extra-file=" + restoreDefaults, "--host=" + dstHost, database]
+            with tempfile.TemporaryFile() as dumpErrFile, tempfile.TemporaryFile() as restoreErrFile:
+                restoreProc = subprocess.Popen(restoreArgs, stdin=subprocess.PIPE, stderr=restoreErrFile)
+                dumpProc = subprocess.Popen(dumpArgs, stdout=subprocess.PIPE, stderr=dumpErrFile)
+                copyError = None
+                archiveError = None
+                archive = None
+                completed = False
+                try:
+                    if tmpFile is not None:
+                        try:
+                            archive = openDumpFile(tmpFile, 'wb', getCompression(archiveFile))
+                        except IOError as e:
+                            archiveError = e
+                    while archiveError is None:
+                        chunk = dumpProc.stdout.read(STREAM_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        try:
+                            restoreProc.stdin.write(chunk)
+                        except IOError as e:
+                            # mysql stopped reading, its exit status and stderr say why
+                            copyError = e
+                            break
+                        if archive is not None:
+                            try:
+                                archive.write(chunk)
+                            except IOError as e:
+                                archiveError = e
+                                break
+                        byteCount += len(chunk)
+                        counter.update(chunk)
+                    completed = copyError is None and archiveError is None
+                finally:
+                    if archive is not None:
+                        try:
+                            archive.close()
+                        except IOError as e:
+                            archiveError = archiveError or e
+                            completed = False
+                    if not completed:
+                        dumpProc.kill()
+                        if copyError is None:
+                            # mysql is still reading so it must not run the rest of a cut short dump
+                            restoreProc.kill()
+                    try:
+                        restoreProc.stdin.close()
+                    except IOError:
+                        # mysql already exited and could not take what was buffered
+                        pass
+                dumpCode = dumpProc.wait()
+                restoreCode = restoreProc.wait()
+                if dumpCode != 0 or restoreCode != 0 or copyError is not None or archiveError is not None:
+                    if tmpFile is not None and os.path.exists(tmpFile):
+                        os.remove(tmpFile)
+                    if archiveError is not None:
+                        raise MysqlDumpException("could not write %s while performing %s: %s" %
+                                                 (archiveFile, pipeEcho, archiveError))
+                    if restoreCode != 0 or copyError is not None:
+                        restoreErrFile.seek(0)
+                        raise MysqlRestoreException("could not perform %s: %s" %
+                                                    (pipeEcho, restoreErrFile.read().strip() or copyError))
+                    dumpErrFile.seek(0)
+                    raise MysqlDumpException("could not perform %s: %s" % (pipeEcho, dumpErrFile.read().strip()))
+        if tmpFile is not None:
+            os.rename(tmpFile, archiveFile)
+        return {'bytes': byteCount, 'rows': counter.rows, 'seconds': time.time() - startTime}
+
     def performMySQLDump(self, host, username, password, dbTable, dumpFile, extraArgList=[]):
+        """
+        dumps dbTable into dumpFile compressed according to its suffix
+        returns the sha1 of the uncompressed dump or None when it is only echoed
+        """
         backupPath = os.path.dirname(dumpFile)
         if backupPath is not None:
             if not os.path.exists(backupPath):
-                os.makedirs(backupPath)
+                makeDirs(backupPath)
         extraArgs = ' '
         if 0 < len(extraArgList):
             extraArgs += " ".join(extraArgList) + ' '
-        dumpCmd = self.getDumpCmd(extraArgs, host, username, password, dbTable, dumpFile, True)
         dumpEcho = self.getDumpCmd(extraArgs, host, username, password, dbTable, dumpFile, self._logPasswords)
         if self._echoOnly is True:
-            print(dumpEcho)
-        else:
-            logger.info("running dump: %s", dumpEcho)
-            if subprocess.call(dumpCmd, shell=True) != 0:
-                raise MysqlDumpException("could not perform %s" % dumpEcho)
+            self.echo(host, dumpEcho)
+            return None
+        logger.info("running dump: %s", dumpEcho)
+        with self._dumpSemaphore:
+            return self.streamDump(host, username, password, dbTable, dumpFile, extraArgList, dumpEcho)
+
+    def streamDump(self, host, username, password, dbTable, dumpFile, extraArgList, dumpEcho):
+        """
+        streams mysqldump's stdout through the compressor into a temp file
+        which is renamed over dumpFile only once mysqldump succeeded
+        returns the sha1 of what mysqldump wrote
+        """
+        tmpFile = dumpFile + ".tmp"
+        digest = hashlib.sha1()
+        with defaultsExtraFile(username, password) as defaultsFile:
+            dumpArgs = (["mysqldump", "--defaults-extra-file=" + defaultsFile] + list(extraArgList) +
+                        ["--host=" + host] + dbTable.split())
+            with tempfile.TemporaryFile() as errFile:
+                proc = subprocess.Popen(dumpArgs, stdout=subprocess.PIPE, stderr=errFile)
+                try:
+                    with openDumpFile(tmpFile, 'wb', getCompression(dumpFile)) as f:
+                        while True:
+                            chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            digest.update(chunk)
+                            f.write(chunk)
+                except Exception:
+                    proc.kill()
+                    proc.wait()
+                    os.remove(tmpFile)
+                    raise
+                if proc.wait() != 0:
+                    os.remove(tmpFile)
+                    errFile.seek(0)
+                    raise MysqlDumpException("could not perform %s: %s" % (dumpEcho, errFile.read().strip()))
+        os.rename(tmpFile, dumpFile)
+        return digest.hexdigest()
 
     def restoreFromMySQLDump(self, host, username, password, database, dumpFile):
         """http://serverfault.com/questions/172950/
         backup-mysql-users-and-permissions"""
         if self._echoOnly is True or os.path.exists(dumpFile):
-            restoreCmd = self.getRestoreCmd(host, username, password, database, dumpFile, True)
             restoreEcho = self.getRestoreCmd(host, username, password, database, dumpFile, self._logPasswords)
             if self._echoOnly is True:
-                print(restoreEcho)
+                self.echo(host, restoreEcho)
             else:
                 logger.info("running restore: %s", restoreEcho)
-                if subprocess.call(restoreCmd, shell=True) != 0:
-                    raise MysqlRestoreException(
-                        "could not perform %s" % (restoreEcho))
+                self.streamRestore(host, username, password, database, dumpFile, restoreEcho)
         else:
             logger.error("cant restore from: %s no file exists", dumpFile)
 
+    def streamRestore(self, host, username, password, database, dumpFile, restoreEcho):
+        """decompresses dumpFile according to its suffix into mysql's stdin"""
+        with defaultsExtraFile(username, password) as defaultsFile:
+            restoreArgs = ["mysql", "--defaults-extra-file=" + defaultsFile, "--host=" + host, database]
+            with tempfile.TemporaryFile() as errFile:
+                proc = subprocess.Popen(restoreArgs, stdin=subprocess.PIPE, stderr=errFile)
+                copyError = None
+                readError = None
+                completed = False
+                f = None
+                try:
+                    try:
+                        f = openDumpFile(dumpFile, 'rb', getCompression(dumpFile))
+                    except IOError as e:
+                        readError = e
+                    while readError is None:
+                        try:
+                            chunk = f.read(STREAM_CHUNK_SIZE)
+                        except (IOError, EOFError, zlib.error) as e:
+                            # a corrupt or cut short gzip or bzip2 file
+                            readError = e
+                            break
+                        if not chunk:
+                            break
+                        try:
+                            proc.stdin.write(chunk)
+                        except IOError as e:
+                            # mysql stopped reading, its exit status and stderr say why
+                            copyError = e
+                            break
+                    completed = copyError is None and readError is None
+                finally:
+                    if f is not None:
+                        f.close()
+                    if not completed and copyError is None:
+                        # mysql is still reading so it must not run the rest of a cut short dump
+                        proc.kill()
+                    try:
+                        proc.stdin.close()
+                    except IOError:
+                        # mysql already exited and could not take what was buffered
+                        pass
+                returnCode = proc.wait()
+                if readError is not None:
+                    raise MysqlRestoreException("could not read %s while performing %s: %s" %
+                                                (dumpFile, restoreEcho, readError))
+                if returnCode != 0 or copyError is not None:
+                    errFile.seek(0)
+                    raise MysqlRestoreException("could not perform %s: %s" %
+                                                (restoreEcho, errFile.read().strip() or copyError))
+
     def performMySQLDumpList(self, cluster, username, password, backupName,
                              backupList, singleTransaction=True, schemaOnly=False):
-        for item in backupList:
-            extraArgs = []
-            if singleTransaction:
-                extraArgs.append("--single-transaction")
-            if schemaOnly:
-                extraArgs.append("--no-data")
+        """
+        dumps every item of backupList using up to workers mysqldumps at once
+        into the blob store, a dump identical to one already stored takes no space
+        """
+        # without the dump date unchanged databases dump to identical blobs
+        extraArgs = ["--skip-dump-date"]
+        if singleTransaction:
+            extraArgs.append("--single-transaction")
+        if schemaOnly:
+            extraArgs.append("--no-data")
+
+        def dumpItem(item):
             table = None
             db = item
             dbTable = db
@@ -112,7 +636,19 @@ class MysqlBackupTool(object):
                 db, table = item
                 dbTable = db + ' ' + table
             dumpFile = self.getBackupSQLFile(backupName, cluster, db, table)
-            self.performMySQLDump(cluster, username, password, dbTable, dumpFile, extraArgs)
+            digest = self.performMySQLDump(cluster, username, password, dbTable, dumpFile, extraArgs)
+            if digest is not None:
+                self.storeBlob(dumpFile, digest, self._compression)
+                self.addToManifest(backupName, cluster, getManifestName(db, table), digest, self._compression)
+        itemList = [tuple(x) if isinstance(x, list) else x for x in backupList]
+        workers = self._workers
+        if self._echoOnly is True:
+            # echoed commands keep the order of backupList
+            workers = 1
+        resultDict = util.runInWorkerPool(itemList, workers, dumpItem)
+        for item in itemList:
+            if resultDict[item][1] is not None:
+                raise resultDict[item][1]
 
     def restoreFromMySQLDumpList(self, cluster, username, password, restoreName, restoreList):
         for item in restoreList:
@@ -120,7 +656,9 @@ class MysqlBackupTool(object):
             db = item
             if isinstance(item, (list, tuple)):
                 db, table = item
-            dumpFile = self.getBackupSQLFile(restoreName, cluster, db, table)
+            dumpFile = self.findManifestBlob(restoreName, cluster, getManifestName(db, table))
+            if dumpFile is None:
+                dumpFile = self.findBackupSQLFile(restoreName, cluster, db, table)
             self.restoreFromMySQLDump(cluster, username, password, db, dumpFile)
 
     def getPruneBeforeFromTimeDelta(self, timeDelta):
@@ -129,15 +667,93 @@ class MysqlBackupTool(object):
         pruneBefore = aWeekAgo.strftime(BACKUP_DIR_FMT)
         return pruneBefore
 
-    def getLastBackup(self):
-        lastBackupDir = None
-        if os.path.exists(self._backupPath):
-            backupDirs = sorted(os.listdir(self._backupPath))
-            if 0 < len(backupDirs):
-                lastBackupDir = backupDirs[-1]
-        else:
+    def getCatalogFile(self):
+        return os.path.join(self._backupPath, CATALOG_FILE)
+
+    def scanCatalog(self):
+        """returns {cluster: sorted backup names} from a listing of the backup directories"""
+        clusterDict = {}
+        if os.path.isdir(self._backupPath):
+            for backupName in os.listdir(self._backupPath):
+                backupDir = os.path.join(self._backupPath, backupName)
+                if BACKUP_NAME_RE.match(backupName) is not None and os.path.isdir(backupDir):
+                    for cluster in os.listdir(backupDir):
+                        clusterDict.setdefault(cluster, []).append(backupName)
+        for nameList in clusterDict.values():
+            nameList.sort()
+        return clusterDict
+
+    def loadCatalog(self):
+        """
+        returns {cluster: sorted backup names} from the catalog
+        which is rebuilt from the backup directories when it is missing or unreadable
+        """
+        catalogFile = self.getCatalogFile()
+        try:
+            catalogMtime = os.stat(catalogFile).st_mtime
+        except OSError:
+            catalogMtime = None
+        if self._catalog is not None and catalogMtime is not None and catalogMtime == self._catalogMtime:
+            return self._catalog
+        clusterDict = None
+        if catalogMtime is not None:
+            try:
+                with open(catalogFile) as f:
+                    catalog = json.load(f)
+                if catalog.get('version') == CATALOG_VERSION:
+                    clusterDict = catalog['clusters']
+                else:
+                    logger.warning("unsupported catalog version %s in %s expected %s, rebuilding it",
+                                   catalog.get('version'), catalogFile, CATALOG_VERSION)
+            except ValueError:
+                logger.warning("%s is unreadable, rebuilding it", catalogFile)
+        if clusterDict is None:
+            clusterDict = self.scanCatalog()
+            if os.path.isdir(self._backupPath):
+                self.writeCatalog(clusterDict)
+                return clusterDict
+        self._catalog = clusterDict
+        self._catalogMtime = catalogMtime
+        return clusterDict
+
+    def writeCatalog(self, clusterDict):
+        """replaces the catalog atomically"""
+        catalogFile = self.getCatalogFile()
+        tmpFile = "%s.%d.tmp" % (catalogFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump({'version': CATALOG_VERSION, 'clusters': clusterDict}, f, sort_keys=True)
+        os.rename(tmpFile, catalogFile)
+        self._catalog = clusterDict
+        self._catalogMtime = os.stat(catalogFile).st_mtime
+
+    def recordBackup(self, backupName, cluster):
+        """adds the backup of cluster to the catalog, callers hold the manifest lock"""
+        clusterDict = self.loadCatalog()
+        nameList = clusterDict.setdefault(cluster, [])
+        i = bisect.bisect_left(nameList, backupName)
+        if i == len(nameList) or nameList[i] != backupName:
+            nameList.insert(i, backupName)
+            self.writeCatalog(clusterDict)
+
+    def getLastBackup(self, cluster=None):
+        """returns the newest backup of cluster or of any cluster when it is None"""
+        if not os.path.exists(self._backupPath):
             logger.error("%s does not exist", self._backupPath)
-        return lastBackupDir
+            return None
+        with self._manifestLock:
+            clusterDict = self.loadCatalog()
+        if cluster is not None:
+            nameList = clusterDict.get(cluster, [])
+            return nameList[-1] if 0 < len(nameList) else None
+        lastList = [x[-1] for x in clusterDict.values() if 0 < len(x)]
+        return max(lastList) if 0 < len(lastList) else None
+
+    def getNearestBackup(self, cluster, backupName):
+        """returns the newest backup of cluster made at or before backupName or None"""
+        with self._manifestLock:
+            nameList = self.loadCatalog().get(cluster, [])
+        i = bisect.bisect_right(nameList, backupName)
+        return nameList[i - 1] if 0 < i else None
 
     def getCurrentTimeBackup(self):
         if self._backupTime is None:
@@ -146,26 +762,54 @@ class MysqlBackupTool(object):
         return currentTimeDir
 
     def pruneBefore(self, pruneDate):
-        while True:
-            dirsToPrune = []
-            for root, dirs, files in os.walk(self._backupPath):
-                if len(dirs) == 0 and len(files) == 0:
-                    dirsToPrune.append(root)
-                elif root == self._backupPath:
-                    for timeDir in dirs:
-                        try:
-                            datetime.datetime.strptime(timeDir, BACKUP_DIR_FMT)
-                            # convertable
-                            if timeDir < pruneDate:
-                                dirsToPrune.append(os.path.join(root, timeDir))
-                        except ValueError:
-                            # malformed directory name
-                            dirsToPrune.append(os.path.join(root, timeDir))
-            if len(dirsToPrune) == 0:
-                break
-            else:
-                for delDir in sorted(dirsToPrune, reverse=True):
-                    shutil.rmtree(delDir)
+        """
+        removes the backups made before pruneDate and malformed backup directories
+        in one listing of the backup path, then the blobs only they listed
+        """
+        if not os.path.isdir(self._backupPath):
+            return
+        with self._manifestLock:
+            clusterDict = self.loadCatalog()
+            prunedCount = 0
+            for backupName in os.listdir(self._backupPath):
+                if backupName == BLOB_DIR:
+                    continue
+                if BACKUP_NAME_RE.match(backupName) is None or backupName < pruneDate:
+                    backupDir = os.path.join(self._backupPath, backupName)
+                    if os.path.isdir(backupDir):
+                        shutil.rmtree(backupDir)
+                        prunedCount += 1
+            if 0 < prunedCount:
+                for nameList in clusterDict.values():
+                    # names sort by date so the pruned backups are a prefix
+                    del nameList[:bisect.bisect_left(nameList, pruneDate)]
+                for cluster in [x for x in clusterDict.keys() if 0 == len(clusterDict[x])]:
+                    del clusterDict[cluster]
+                self.writeCatalog(clusterDict)
+                logger.info("pruned %d backups made before %s", prunedCount, pruneDate)
+                self.pruneBlobs(clusterDict)
+
+    def pruneBlobs(self, clusterDict):
+        """removes the blobs that no manifest of the cataloged backups lists"""
+        blobPath = os.path.join(self._backupPath, BLOB_DIR)
+        if not os.path.isdir(blobPath):
+            return
+        keptBlobs = set()
+        for cluster, nameList in clusterDict.items():
+            for backupName in nameList:
+                fileDict = self.readManifest(backupName, cluster) or {}
+                for entry in fileDict.values():
+                    keptBlobs.add(os.path.basename(self.getBlobFile(entry['blob'], entry['compression'])))
+        prunedCount = 0
+        for prefix in os.listdir(blobPath):
+            prefixDir = os.path.join(blobPath, prefix)
+            for blobName in os.listdir(prefixDir):
+                if blobName not in keptBlobs and not blobName.endswith(".tmp"):
+                    os.remove(os.path.join(prefixDir, blobName))
+                    prunedCount += 1
+            if 0 == len(os.listdir(prefixDir)):
+                os.rmdir(prefixDir)
+        logger.info("pruned %d blobs, %d are kept", prunedCount, len(keptBlobs))
 
 
 def main(args=None):
@@ -198,6 +842,11 @@ def main(args=None):
                         help="prune before date in the form YYYYMMDD-hhmmss")
     parser.add_argument('-e', '--echo-only', action='store_true',
                         help="just print out the queries to run")
+    parser.add_argument('-z', '--compression', type=str, default=DEFAULT_COMPRESSION,
+                        choices=COMPRESSIONS,
+                        help="how the dumps are compressed")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_DUMP_WORKERS,
+                        help="the number of databases dumped at once")
     parsedArgs = parser.parse_args(args)
     assert (parsedArgs.backup_path is not '/'), "must not be the root directory"
     if parsedArgs.log_level.upper() in logLevels.keys():
@@ -207,7 +856,8 @@ def main(args=None):
         logger.warn("Unknown logLevel=%s retaining level at INFO",
                     parsedArgs.log_level)
     logger.info(pprint.pformat(parsedArgs))
-    mysqlBackupTool = MysqlBackupTool(parsedArgs.echo_only, parsedArgs.backup_path)
+    mysqlBackupTool = MysqlBackupTool(parsedArgs.echo_only, False, parsedArgs.backup_path,
+                                      parsedArgs.compression, parsedArgs.workers)
     if parsedArgs.prune_date is not None:
         mysqlBackupTool.pruneBefore(parsedArgs.prune_date)
     else:
@@ -11,14 +11,21 @@ import datetime
 import logging
 import os
 import pprint
+import echo_script
 import email_tool
 import random
 import string
 import sys
+import threading
+import time
 import auto_grant_config
+import grant_plan
+import ldap_cache
 import ldap_query_tool
 import mysql_backup_tool
 import mysql_query_tool
+import privilege_mask
+import state_store
 import util
 logger = logging.getLogger(__name__)
 
@@ -28,8 +35,15 @@ TEMPLATE_KEY = 'template'
 TEMPLATE_ACCESS = 'access'
 TEMPLATE_INVITE = 'invite'
 RET_MUTEX_ARGS = 10
+DEFAULT_WORKERS = 1
+DEFAULT_CLUSTER_CONCURRENCY = 1
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_DROP_CHUNK_SIZE = 100
+DEFAULT_RETENTION_DAYS = 30
+DEFAULT_RETRIES = 1
 
 _mysqlBackupTool = None
+_newUserLock = threading.Lock()
 
 
 class GrantException(Exception):
@@ -53,7 +67,8 @@ def makeGroupDict(autoGrantConfig, ldapGroupDict):
     """
     this is the ldap group processing
     :param autoGrantConfig: an instance of AutoGrantConfig
-    :param ldapGroupDict: a dict with the form:
+    :param ldapGroupDict: an iterable of (dn, attrs) as yielded by LdapQueryTool.iterLDAP
+                          or a dict with the form:
     {'cn=int_test_group,ou=groups,dc=nodomain': {'cn': ['int_test_group'],
                                                  'gidNumber': ['20000'],
                                                  'memberUid': ['int_test_user'],
@@ -65,23 +80,26 @@ def makeGroupDict(autoGrantConfig, ldapGroupDict):
     """
     groupDict = {}
     ldapMinGid = autoGrantConfig.getLdapMinGid()
+    ldapEntries = ldapGroupDict
+    if isinstance(ldapGroupDict, dict):
+        ldapEntries = ldapGroupDict.iteritems()
     # add groups from ldap
-    for key in ldapGroupDict.keys():
-        if 'gidNumber' in ldapGroupDict[key]:
-            for gid in ldapGroupDict[key]['gidNumber']:
+    for key, attrs in ldapEntries:
+        if 'gidNumber' in attrs:
+            for gid in attrs['gidNumber']:
                 if ldapMinGid <= int(gid):
-                    cnList = ldapGroupDict[key]['cn']
+                    cnList = attrs['cn']
                     for cn in cnList:
-                        if cn not in groupDict and 'memberUid' in ldapGroupDict[key]:
+                        if cn not in groupDict and 'memberUid' in attrs:
                             # Iterate over these and find any longer than 16 characters and truncate them.
                             # MySQL <= 5.6 has a maximum username length of 16.
-                            memberUid = ldapGroupDict[key]['memberUid']
+                            memberUid = attrs['memberUid']
                             for i in range(0, len(memberUid)):
                                 member = memberUid[i]
                                 if len(member) > 16:
                                     logger.warning("LDAP username %s is longer than 16 characters, truncating to %s", member, member[:16])
                                     memberUid[i] = member[:16]
-                            groupDict[cn] = ldapGroupDict[key]['memberUid']
+                            groupDict[cn] = attrs['memberUid']
     # add custom mysql groups from config
     customMysqlGroups = autoGrantConfig.getCustomMysqlGroups()
     if customMysqlGroups is not None:
@@ -96,6 +114,31 @@ def makeGroupDict(autoGrantConfig, ldapGroupDict):
     return groupDict
 
 
+def queryLdapGroups(autoGrantConfig, ldapQueryTool, userList=None, groupList=None):
+    """
+    fetches only the groups a run needs from ldap
+    :param userList: a comma delimited list of users, only their groups are fetched
+    :param groupList: a comma delimited list of groups, the members are looked up first
+                      then every group they belong to is fetched as grants span groups
+    :returns: an iterable of (dn, attrs) for makeGroupDict to consume as pages arrive
+    """
+    ldapGroupDesc = autoGrantConfig.getLdapGroupDesc()
+    minGid = autoGrantConfig.getLdapMinGid()
+    gidOrdering = autoGrantConfig.getLdapGidOrdering()
+    pageSize = autoGrantConfig.getLdapPageSize()
+    memberList = None
+    if userList is not None:
+        memberList = userList.split(",")
+    if groupList is not None:
+        namedGroups = ldapQueryTool.iterGroups(ldapGroupDesc, minGid, groupList.split(","),
+                                               None, gidOrdering, pageSize)
+        groupDict = makeGroupDict(autoGrantConfig, namedGroups)
+        memberList = []
+        for group in groupList.split(","):
+            memberList += groupDict.get(group, [])
+    return ldapQueryTool.iterGroups(ldapGroupDesc, minGid, None, memberList, gidOrdering, pageSize)
+
+
 def makeUserDict(autoGrantConfig, groupDict, userList=None):
     """
     this breaks out the groups by user
@@ -147,121 +190,486 @@ def makeGrantDict(autoGrantConfig, userDict, clusterList=None):
     for cluster in dbClusters:
         if clusterList is not None and cluster not in clusterList:
             continue
+        clusterGroups = autoGrantConfig.getGroupsForCluster(cluster)
         for user in userDict.keys():
+            # db_table: [order, privileges, merged privilege set], a merged db_table moves last
+            userGrants = {}
+            order = 0
             for group in userDict[user]:
+                if group not in clusterGroups:
+                    continue
                 grantList = autoGrantConfig.getGrantList(user, cluster, group)
                 for grant in grantList:
-                    if cluster not in grantDict:
-                        grantDict[cluster] = {}
-                    if user not in grantDict[cluster]:
-                        grantDict[cluster][user] = []
-                    for userGrant in grantDict[cluster][user]:
-                        if userGrant['db_table'] == grant['db_table']:
-                            grantDict[cluster][user].remove(userGrant)
-                            grant['privileges'] = list(set(userGrant['privileges'] + grant['privileges']))
-                            break
-                    grantDict[cluster][user].append(grant)
+                    userGrant = userGrants.get(grant['db_table'])
+                    if userGrant is None:
+                        userGrants[grant['db_table']] = [order, grant['privileges'], None]
+                    else:
+                        if userGrant[2] is None:
+                            userGrant[2] = set(userGrant[1])
+                        userGrant[2].update(grant['privileges'])
+                        userGrant[0] = order
+                    order += 1
+            if 0 < len(userGrants):
+                if cluster not in grantDict:
+                    grantDict[cluster] = {}
+                grantDict[cluster][user] = []
+                for dbTable in sorted(userGrants.keys(), key=lambda x: userGrants[x][0]):
+                    order, privileges, privilegeSet = userGrants[dbTable]
+                    if privilegeSet is not None:
+                        privileges = list(privilegeSet)
+                    grantDict[cluster][user].append({'db_table': dbTable,
+                                                     'privileges': privileges})
     return grantDict
 
 
-def grantAccess(autoGrantConfig, grantDict, echoOnly, logPasswords, destructive, passwordReset):
+def getAccessLevels(echoOnly, destructive, passwordReset):
+    """determine the (echoAccessLevel, queryAccessLevel) from echoOnly and destructive"""
+    echoAccessLevel = mysql_query_tool.QAL_READ_WRITE
+    if destructive or passwordReset:
+        echoAccessLevel = mysql_query_tool.QAL_READ_WRITE_DELETE
+    queryAccessLevel = echoAccessLevel
+    if echoOnly:
+        queryAccessLevel = mysql_query_tool.QAL_READ
+    return echoAccessLevel, queryAccessLevel
+
+
+def grantAccess(autoGrantConfig, grantDict, echoOnly, logPasswords, destructive, passwordReset,
+                workers=DEFAULT_WORKERS, clusterConcurrency=DEFAULT_CLUSTER_CONCURRENCY,
+                maxInFlight=None, grantPlan=None, stateStore=None, batchSize=DEFAULT_BATCH_SIZE,
+                echoScript=None, dropChunkSize=DEFAULT_DROP_CHUNK_SIZE, checkpointStore=None,
+                resume=False, retries=DEFAULT_RETRIES):
     """ This is the function that grants revokes and drops users
-        Before adding any additional logica we should consider splitting
-        this function to avoid it getting too unweildy
+        up to workers clusters are reconciled at once each on its own
+        connections, a failed cluster does not stop the others and is retried up to retries times
+        maxInFlight bounds the users being applied at once across all clusters
+        statements are sent batchSize at a time on each connection
+        users are dropped dropChunkSize accounts per DROP USER statement
+        if a grantPlan is given the echoed statements are recorded into it
+        if a stateStore is given unchanged clusters and users are skipped
+        if an echoScript is given echoed commands are collected into it rather than printed
+        with a checkpointStore the applied clusters and users are checkpointed under the
+        digest of grantDict and with resume those of an earlier run of it are skipped
         NOTE: if destructive is False Revokes and Drop Users will be omitted
     """
     newUserDict = {}
+    inFlightSemaphore = None
+    if maxInFlight is not None and 0 < maxInFlight:
+        inFlightSemaphore = threading.BoundedSemaphore(maxInFlight)
     mysqlBackupTool = _getMysqlBackupTool(echoOnly, logPasswords)
     backupName = mysqlBackupTool.getCurrentTimeBackup()
+    defaultCluster = grantDict.keys()[0]
+    checkpoint = None
+    clusterList = grantDict.keys()
+    if checkpointStore is not None:
+        runHash = state_store.hashRunInputs(grantDict, destructive, passwordReset)
+        checkpoint = state_store.RunCheckpoint(checkpointStore, runHash, resume)
+        if not resume and echoOnly is False:
+            checkpoint.startOver()
+        if grantPlan is not None:
+            grantPlan.setRunHash(runHash)
+        clusterList = [x for x in clusterList if not checkpoint.isClusterDone(x)]
+        if len(clusterList) < len(grantDict):
+            logger.info("skipping the %d clusters finished by run %s", len(grantDict) - len(clusterList), runHash)
+
+    def grantCluster(cluster):
+        return grantClusterAccess(autoGrantConfig, cluster, grantDict[cluster], newUserDict,
+                                  backupName, echoOnly, logPasswords, destructive,
+                                  passwordReset, clusterConcurrency, inFlightSemaphore,
+                                  grantPlan, stateStore, batchSize, echoScript, dropChunkSize,
+                                  checkpoint)
+    resultDict = util.runInWorkerPool(clusterList, workers, grantCluster, retries)
+    logClusterTimings(grantDict, resultDict)
+    failedClusters = set([x for x in clusterList if resultDict[x][1] is not None])
+    with _newUserLock:
+        for userAtHost in newUserDict.keys():
+            newUserDict[userAtHost][CLUSTERS_KEY] -= failedClusters
+    if grantPlan is not None:
+        for cluster in failedClusters:
+            grantPlan.removeCluster(cluster)
+        grantPlan.setDefaultCluster(defaultCluster)
+        grantPlan.setNewUsers(newUserDictToPlan(newUserDict))
+    if echoOnly is False:
+        sendEmailNotifications(autoGrantConfig, newUserDict, defaultCluster)
+    errorList = [str(resultDict[x][1]) for x in clusterList
+                 if resultDict[x][1] is not None]
+    if 0 < len(errorList):
+        raise GrantException("\n".join(errorList))
+
+
+def grantClusterAccess(autoGrantConfig, cluster, userGrantDict, newUserDict, backupName,
+                       echoOnly, logPasswords, destructive, passwordReset,
+                       clusterConcurrency=DEFAULT_CLUSTER_CONCURRENCY, inFlightSemaphore=None,
+                       grantPlan=None, stateStore=None, batchSize=DEFAULT_BATCH_SIZE, echoScript=None,
+                       dropChunkSize=DEFAULT_DROP_CHUNK_SIZE, checkpoint=None):
+    """ backs up and reconciles a single cluster
+        users are split between up to clusterConcurrency connections
+        which share one grant snapshot of the cluster
+        inFlightSemaphore is acquired around each user when shared between clusters
+        with a stateStore only users whose inputs or server grants changed are applied
+        and the backup is skipped when there is nothing to change
+        with a state_store.RunCheckpoint the users it holds for the cluster are skipped
+        and when not echoOnly each user is checkpointed once its statements were sent
+        returns {'users': applied, 'dropped': dropped, 'dropSeconds': seconds}
+    """
     grantUser = autoGrantConfig.getMysqlGrantsUsername()
     grantPass = autoGrantConfig.getMysqlGrantsPassword()
-    # determine access levels from echoOnly and destructive
-    echoAccessLevel = mysql_query_tool.QAL_READ_WRITE
-    if destructive or passwordReset:
-        echoAccessLevel = mysql_query_tool.QAL_READ_WRITE_DELETE
-    queryAccessLevel = echoAccessLevel
+    echoAccessLevel, queryAccessLevel = getAccessLevels(echoOnly, destructive, passwordReset)
+    mysqlBackupTool = _getMysqlBackupTool(echoOnly, logPasswords)
+    doneUsers = set()
+    if checkpoint is not None:
+        doneUsers = checkpoint.getDoneUsers(cluster)
     if echoOnly:
-        queryAccessLevel = mysql_query_tool.QAL_READ
-    defaultCluster = grantDict.keys()[0]
-    for cluster in grantDict.keys():
-        mysqlBackupTool.performMySQLDumpList(cluster, grantUser, grantPass, backupName, [("mysql", "user")])
-        logger.debug("backup saved")
-        mysqlConn = mysql_query_tool.MysqlQueryTool(cluster, grantUser,
-                                                    grantPass, echoAccessLevel,
-                                                    queryAccessLevel, logPasswords)
-        logger.debug("connection created")
-        for userAtHost in grantDict[cluster].keys():
-            logger.debug("working on %s", userAtHost)
-            userPart, hostPart = (x.strip("'") for x in userAtHost.split('@'))
-            mysqlConn.beginTransaction()
-            passwordHash = mysqlConn.getPasswordHash(userPart, hostPart)
-            userExists = (passwordHash is not None)
-            if passwordReset and userExists:
-                mysqlConn.dropUser(userAtHost)
-                userExists = False
-                passwordHash = None
-            if userExists:
-                logger.debug("CACHING PASSWORD HASH %s FOR %s ACCOUNT ON %s" % (passwordHash, userAtHost, cluster))
-                updateMysqlUser(newUserDict, userAtHost, mysqlConn, passwordHash, None)
-            else:
-                logger.debug("NEED TO CREATE USER: %s", userAtHost)
-                updateMysqlUser(newUserDict, userAtHost, mysqlConn, generateRandomPassword(), cluster)
-            grantDeltaDict = {}
-            try:
-                for grant in grantDict[cluster][userAtHost]:
-                    dbTable = grant['db_table']
-                    privileges = grant['privileges']
-                    grantDeltaDict = mysqlConn.getGrantDeltaDict(userAtHost, dbTable, privileges)
-                    if 0 < len(grantDeltaDict['grants']):
-                        mysqlConn.queryGrant(userAtHost,
-                                             grantDeltaDict['grants'],
-                                             dbTable)
-                    if 0 < len(grantDeltaDict['revokes']):
-                        mysqlConn.queryRevoke(userAtHost,
-                                              grantDeltaDict['revokes'],
-                                              dbTable)
-                        mysqlConn.queryFlushPrivileges()
-                mysqlConn.commitTransaction()
-            except Exception as e:
-                mysqlConn.rollbackTransaction()
-                message = e.message + ": An exception occured when trying to grant:[%s] and revoke:[%s] to %s on %s" % (",".join(grantDeltaDict['grants']), ",".join(grantDeltaDict['revokes']), userAtHost, cluster)
-                raise GrantException(message)
+        checkpoint = None
+    if grantPlan is not None:
+        # a retried cluster is recorded again from scratch
+        grantPlan.clearStatements(cluster)
+    journal = None
+    if not echoOnly:
+        # the connections of the cluster share its journal
+        journal = mysqlBackupTool.openJournal(backupName, cluster)
+
+    def recordStatement(accessLevel, query, qArgs):
+        step = grant_plan.STEP_QUERY
+        if query.startswith(mysql_query_tool.CREATE_USER_QUERY):
+            step = grant_plan.STEP_CREATE_USER
+        grantPlan.addStatement(cluster, accessLevel, query, qArgs, step)
+
+    def makeConnection():
+        conn = mysql_query_tool.MysqlQueryTool(cluster, grantUser, grantPass,
+                                               echoAccessLevel, queryAccessLevel,
+                                               logPasswords, '', batchSize)
+        if grantPlan is not None:
+            conn.setStatementRecorder(recordStatement)
+        conn.setEchoScript(echoScript)
+        conn.setJournal(journal)
+        return conn
+
+    def applyUser(conn, userAtHost):
+        if inFlightSemaphore is None:
+            grantUserAccess(conn, cluster, userAtHost, userGrantDict[userAtHost],
+                            newUserDict, passwordReset)
+        else:
+            with inFlightSemaphore:
+                grantUserAccess(conn, cluster, userAtHost, userGrantDict[userAtHost],
+                                newUserDict, passwordReset)
+
+    def applyUsers(conn, users):
+        """returns the users whose statements are still queued on conn"""
+        queuedUsers = []
+        try:
+            for userAtHost in users:
+                applyUser(conn, userAtHost)
+                queuedUsers.append(userAtHost)
+                checkpointSentUsers(checkpoint, cluster, conn, queuedUsers)
+        except GrantException:
+            # the users before the failing one are applied as they would be without batching
+            conn.flushStatements()
+            checkpointSentUsers(checkpoint, cluster, conn, queuedUsers)
+            raise
+        return queuedUsers
+    mysqlConn = makeConnection()
+    logger.debug("connection created")
+    try:
+        snapshot = mysqlConn.loadGrantSnapshot()
+        logger.debug("grant snapshot loaded")
+        userInputHashDict = dict((x, state_store.hashUserInputs(userGrantDict[x]))
+                                 for x in userGrantDict.keys())
+        clusterInputHash = state_store.hashClusterInputs(userInputHashDict, destructive)
+        if grantPlan is not None:
+            grantPlan.setFingerprint(cluster, snapshot.getFingerprint())
+            grantPlan.setInputHashes(cluster, clusterInputHash, userInputHashDict)
+        userList = userGrantDict.keys()
+        if 0 < len(doneUsers):
+            for userAtHost in doneUsers & set(userList):
+                passwordHash = snapshot.getPasswordHash(userAtHost)
+                if passwordHash is not None:
+                    # keep the hash so the user gets the same password on other clusters
+                    updateMysqlUser(newUserDict, userAtHost, mysqlConn, passwordHash, None)
+            userList = [x for x in userList if x not in doneUsers]
+            logger.info("skipping the %d users finished on %s", len(userGrantDict) - len(userList), cluster)
+        if stateStore is not None and not passwordReset:
+            changedUsers = set(stateStore.getChangedUsers(cluster, snapshot, userInputHashDict,
+                                                          clusterInputHash))
+            for userAtHost in userList:
+                passwordHash = snapshot.getPasswordHash(userAtHost)
+                if userAtHost not in changedUsers and passwordHash is not None:
+                    # keep the hash so the user gets the same password on other clusters
+                    updateMysqlUser(newUserDict, userAtHost, mysqlConn, passwordHash, None)
+            userList = [x for x in userList if x in changedUsers]
+            logger.info("%d of %d users changed on %s", len(userList), len(userGrantDict), cluster)
+        usersToDrop = []
         if destructive and not passwordReset:
             # remove non defined users
-            allMysqlUsers = mysqlConn.findAllUsers()
-            usersToDrop = findUsersToDrop(autoGrantConfig, allMysqlUsers,
-                                          grantDict[cluster].keys())
-            for userToDropWithHost in usersToDrop:
-                mysqlConn.dropUser(userToDropWithHost)
+            usersToDrop = findUsersToDrop(autoGrantConfig, mysqlConn.findAllUsers(),
+                                          userGrantDict.keys())
+        hasChanges = stateStore is None or 0 < len(userList) or 0 < len(usersToDrop)
+        if hasChanges and 0 == len(doneUsers) and not mysqlBackupTool.hasGrantSnapshot(backupName, cluster):
+            # the snapshot already read every account and privilege row so no dump is needed
+            # and unchanged grants are not written again, a retry keeps the backup taken before
+            # its first attempt changed anything, echoed runs are backed up too as the echoed
+            # script may be applied and then reverted
+            mysqlBackupTool.saveGrantSnapshot(backupName, cluster, snapshot)
+            logger.debug("backup saved")
+        queuedUsers = []
+        if clusterConcurrency <= 1 or len(userList) <= 1:
+            queuedUsers = applyUsers(mysqlConn, userList)
+        else:
+            chunkList = [userList[i::clusterConcurrency] for i in range(clusterConcurrency)]
+
+            def grantChunk(chunkIndex):
+                chunkConn = makeConnection()
+                chunkConn.setGrantSnapshot(snapshot)
+                try:
+                    chunkQueuedUsers = applyUsers(chunkConn, chunkList[chunkIndex])
+                    chunkConn.flushStatements()
+                    checkpointSentUsers(checkpoint, cluster, chunkConn, chunkQueuedUsers)
+                    if chunkConn.needsFlushPrivileges():
+                        mysqlConn.setNeedsFlushPrivileges()
+                except mysql_query_tool.StatementBatchException as e:
+                    raise GrantException(getBatchErrorMessage(e, cluster))
+                finally:
+                    chunkConn.closeConnection()
+            chunkResultDict = util.runInWorkerPool(range(len(chunkList)), clusterConcurrency, grantChunk)
+            errorList = [str(x[1]) for x in chunkResultDict.values() if x[1] is not None]
+            if 0 < len(errorList):
+                raise GrantException("\n".join(errorList))
+        mysqlConn.setStatementOwner(None)
+        dropStart = time.time()
+        mysqlConn.dropUsers(usersToDrop, dropChunkSize)
+        mysqlConn.finishStatements()
+        dropSeconds = time.time() - dropStart
+        checkpointSentUsers(checkpoint, cluster, mysqlConn, queuedUsers)
+        if checkpoint is not None:
+            checkpoint.saveCluster(cluster)
+        if stateStore is not None and echoOnly is False:
+            stateStore.saveClusterState(cluster, mysqlConn.loadGrantSnapshot(),
+                                        userInputHashDict, clusterInputHash)
+    except mysql_query_tool.StatementBatchException as e:
+        raise GrantException(getBatchErrorMessage(e, cluster))
+    finally:
         mysqlConn.closeConnection()
-    if echoOnly is False:
-        sendEmailNotifications(autoGrantConfig, newUserDict, defaultCluster)
+        if journal is not None:
+            journal.close()
+    return {'users': len(userList), 'dropped': len(usersToDrop), 'dropSeconds': dropSeconds}
+
+
+def checkpointSentUsers(checkpoint, cluster, mysqlConn, queuedUsers):
+    """checkpoints and empties queuedUsers once nothing queued on mysqlConn is left to send"""
+    if checkpoint is not None and 0 < len(queuedUsers) and mysqlConn.getPendingCount() == 0:
+        checkpoint.saveUsers(cluster, queuedUsers)
+        del queuedUsers[:]
+
+
+def getBatchErrorMessage(batchException, cluster):
+    return "%s: An exception occured when running [%s] for %s on %s" % (batchException.error, batchException.statement,
+                                                                        batchException.owner, cluster)
+
+
+def grantUserAccess(mysqlConn, cluster, userAtHost, grantList, newUserDict, passwordReset):
+    """creates the user if needed then applies the grant and revoke deltas
+       when mysqlConn batches the statements are queued under userAtHost
+       so a failing batch is still blamed on the user whose statement failed
+    """
+    logger.debug("working on %s", userAtHost)
+    userPart, hostPart = (x.strip("'") for x in userAtHost.split('@'))
+    mysqlConn.setStatementOwner(userAtHost)
+    mysqlConn.beginTransaction()
+    passwordHash = mysqlConn.getPasswordHash(userPart, hostPart)
+    userExists = (passwordHash is not None)
+    if passwordReset and userExists:
+        mysqlConn.dropUser(userAtHost)
+        userExists = False
+        passwordHash = None
+    if userExists:
+        logger.debug("CACHING PASSWORD HASH %s FOR %s ACCOUNT ON %s" % (passwordHash, userAtHost, cluster))
+        updateMysqlUser(newUserDict, userAtHost, mysqlConn, passwordHash, None)
+    else:
+        logger.debug("NEED TO CREATE USER: %s", userAtHost)
+        updateMysqlUser(newUserDict, userAtHost, mysqlConn, generateRandomPassword(), cluster)
+    grantDeltaDict = {'grants': 0, 'revokes': 0}
+    dbTable = "*.*"
+    try:
+        for grant in grantList:
+            dbTable = grant['db_table']
+            privileges = grant['privileges']
+            grantDeltaDict = mysqlConn.getGrantDeltaDict(userAtHost, dbTable, privileges)
+            if grantDeltaDict['grants']:
+                mysqlConn.queryGrant(userAtHost,
+                                     grantDeltaDict['grants'],
+                                     dbTable)
+            if grantDeltaDict['revokes']:
+                mysqlConn.queryRevoke(userAtHost,
+                                      grantDeltaDict['revokes'],
+                                      dbTable)
+        mysqlConn.commitTransaction()
+    except mysql_query_tool.StatementBatchException as e:
+        mysqlConn.rollbackTransaction()
+        raise GrantException(getBatchErrorMessage(e, cluster))
+    except Exception as e:
+        mysqlConn.rollbackTransaction()
+        message = str(e) + ": An exception occured when trying to grant:[%s] and revoke:[%s] to %s on %s" % (privilege_mask.render(grantDeltaDict['grants'], dbTable), privilege_mask.render(grantDeltaDict['revokes'], dbTable), userAtHost, cluster)
+        raise GrantException(message)
+
+
+def newUserDictToPlan(newUserDict):
+    """converts the cluster sets of newUserDict to lists so it can be saved"""
+    planNewUsers = {}
+    for userAtHost in newUserDict.keys():
+        planNewUsers[userAtHost] = dict(newUserDict[userAtHost])
+        planNewUsers[userAtHost][CLUSTERS_KEY] = sorted(newUserDict[userAtHost][CLUSTERS_KEY])
+    return planNewUsers
+
+
+def newUserDictFromPlan(planNewUsers):
+    newUserDict = {}
+    for userAtHost in planNewUsers.keys():
+        newUserDict[userAtHost] = dict(planNewUsers[userAtHost])
+        newUserDict[userAtHost][CLUSTERS_KEY] = set(planNewUsers[userAtHost][CLUSTERS_KEY])
+    return newUserDict
+
+
+def applyGrantPlan(autoGrantConfig, grantPlan, logPasswords, workers=DEFAULT_WORKERS, stateStore=None,
+                   batchSize=DEFAULT_BATCH_SIZE, checkpointStore=None, resume=False, retries=DEFAULT_RETRIES):
+    """ runs the statements saved in grantPlan without recomputing them batchSize at a time
+        a cluster is skipped with an error if its grants changed since the plan was made
+        and a failed cluster is retried up to retries times
+        with a stateStore the applied state of each cluster is saved for the next run
+        with a checkpointStore the users whose statements were sent are checkpointed under
+        the plan's run hash and with resume those of an earlier run are skipped
+    """
+    mysqlBackupTool = _getMysqlBackupTool(False, logPasswords)
+    backupName = mysqlBackupTool.getCurrentTimeBackup()
+    grantUser = autoGrantConfig.getMysqlGrantsUsername()
+    grantPass = autoGrantConfig.getMysqlGrantsPassword()
+    accessLevel = grantPlan.getOption('accessLevel', mysql_query_tool.QAL_READ_WRITE)
+    checkpoint = None
+    if checkpointStore is not None:
+        checkpoint = state_store.RunCheckpoint(checkpointStore, grantPlan.getRunHash(), resume)
+        if not resume:
+            checkpoint.startOver()
+
+    def applyCluster(cluster):
+        doneUsers = set()
+        if checkpoint is not None:
+            if checkpoint.isClusterDone(cluster):
+                logger.info("skipping %s finished by run %s", cluster, checkpoint.getRunHash())
+                return 0
+            doneUsers = checkpoint.getDoneUsers(cluster)
+        mysqlConn = mysql_query_tool.MysqlQueryTool(cluster, grantUser, grantPass,
+                                                    accessLevel, accessLevel,
+                                                    logPasswords, '', batchSize)
+        journal = mysqlBackupTool.openJournal(backupName, cluster)
+        mysqlConn.setJournal(journal)
+        try:
+            snapshot = mysqlConn.loadGrantSnapshot()
+            # the checkpointed users were changed by this plan so only an untouched cluster is compared
+            if 0 == len(doneUsers) and snapshot.getFingerprint() != grantPlan.getFingerprint(cluster):
+                raise GrantException("grants on %s changed since the plan was made on %s, make a new plan" %
+                                     (cluster, grantPlan.getCreated()))
+            steps = [x for x in grantPlan.getSteps(cluster) if getStatementOwner(x[3]) not in doneUsers]
+            if 0 < len(steps) and 0 == len(doneUsers) and not mysqlBackupTool.hasGrantSnapshot(backupName, cluster):
+                # a retry keeps the backup taken before its first attempt changed anything
+                mysqlBackupTool.saveGrantSnapshot(backupName, cluster, snapshot)
+            # the statements of several users may interleave so a user is only done after its last one
+            stepsLeftDict = {}
+            for x in steps:
+                owner = getStatementOwner(x[3])
+                stepsLeftDict[owner] = stepsLeftDict.get(owner, 0) + 1
+            queuedUsers = []
+            for step, statementAccessLevel, query, qArgs in steps:
+                owner = getStatementOwner(qArgs)
+                mysqlConn.setStatementOwner(owner)
+                if step == grant_plan.STEP_CREATE_USER:
+                    # createUser drops and recreates an account left over from e.g. a restore
+                    mysqlConn.createUser(owner, qArgs[2], "IDENTIFIED BY PASSWORD" in query)
+                else:
+                    mysqlConn.queryMySQL(statementAccessLevel, query, qArgs)
+                stepsLeftDict[owner] -= 1
+                if owner is not None and 0 == stepsLeftDict[owner]:
+                    queuedUsers.append(owner)
+                checkpointSentUsers(checkpoint, cluster, mysqlConn, queuedUsers)
+            mysqlConn.finishStatements()
+            checkpointSentUsers(checkpoint, cluster, mysqlConn, queuedUsers)
+            if checkpoint is not None:
+                checkpoint.saveCluster(cluster)
+            clusterInputHash, userInputHashDict = grantPlan.getInputHashes(cluster)
+            if stateStore is not None and clusterInputHash is not None:
+                stateStore.saveClusterState(cluster, mysqlConn.loadGrantSnapshot(),
+                                            userInputHashDict, clusterInputHash)
+        except mysql_query_tool.StatementBatchException as e:
+            raise GrantException(getBatchErrorMessage(e, cluster))
+        finally:
+            mysqlConn.closeConnection()
+            journal.close()
+        return len(steps)
+    clusterList = grantPlan.getClusters()
+    resultDict = util.runInWorkerPool(clusterList, workers, applyCluster, retries)
+    for cluster in clusterList:
+        result, error, seconds = resultDict[cluster]
+        if error is None:
+            logger.info("applied %d statements to %s in %.2fs", result, cluster, seconds)
+    newUserDict = newUserDictFromPlan(grantPlan.getNewUsers())
+    # only notify users on clusters the plan was applied to
+    failedClusters = set([x for x in clusterList if resultDict[x][1] is not None])
+    for userAtHost in newUserDict.keys():
+        newUserDict[userAtHost][CLUSTERS_KEY] -= failedClusters
+    if 0 < len(newUserDict):
+        sendEmailNotifications(autoGrantConfig, newUserDict, grantPlan.getDefaultCluster())
+    errorList = [str(resultDict[x][1]) for x in clusterList if resultDict[x][1] is not None]
+    if 0 < len(errorList):
+        raise GrantException("\n".join(errorList))
+
+
+def getStatementOwner(qArgs):
+    """returns the user@host a planned statement is applied for or None"""
+    if qArgs is not None and 2 <= len(qArgs):
+        return qArgs[0] + '@' + qArgs[1]
+    return None
+
+
+def logClusterTimings(grantDict, resultDict):
+    """logs how long each cluster took sorted from slowest to fastest"""
+    logger.info("cluster timing summary:")
+    for cluster in sorted(resultDict.keys(), key=lambda x: resultDict[x][2], reverse=True):
+        result, error, seconds = resultDict[cluster]
+        status = "ok"
+        if error is not None:
+            status = "FAILED"
+        dropped = ""
+        if result is not None and 0 < result['dropped']:
+            dropped = " %d dropped in %.2fs" % (result['dropped'], result['dropSeconds'])
+        logger.info("  %-40s %8.2fs %6d users %s%s", cluster, seconds,
+                    len(grantDict[cluster]), status, dropped)
 
 
 def findUsersToDrop(autoGrantConfig, allMysqlUsers, usersWithGrants):
+    """returns the sorted mysql users without grants that the mysql_user_filter does not keep"""
     usersToDrop = []
-    for mysqlUser in allMysqlUsers:
-        if mysqlUser in usersWithGrants:
-            continue
+    for mysqlUser in sorted(set(allMysqlUsers) - set(usersWithGrants)):
         if not autoGrantConfig.getMysqlUserFiltered(mysqlUser):
             usersToDrop.append(mysqlUser)
     return usersToDrop
 
 
 def updateMysqlUser(newUserDict, newUserWithHost, mysqlConn, password, cluster=None):
-    if newUserWithHost not in newUserDict:
-        newUserDict[newUserWithHost] = {CLUSTERS_KEY: set([]),
-                                        PASSWORD_KEY: password,
-                                        TEMPLATE_KEY: TEMPLATE_INVITE}
-        if cluster is None:
-            newUserDict[newUserWithHost][TEMPLATE_KEY] = TEMPLATE_ACCESS
-        else:
-            logger.info("New password invite for %s with password %s",
-                        newUserWithHost, password)
+    """records the user in newUserDict and creates it when a cluster is given
+       NOTE: newUserDict is shared by the cluster workers so guard it with _newUserLock
+    """
+    with _newUserLock:
+        if newUserWithHost not in newUserDict:
+            newUserDict[newUserWithHost] = {CLUSTERS_KEY: set([]),
+                                            PASSWORD_KEY: password,
+                                            TEMPLATE_KEY: TEMPLATE_INVITE}
+            if cluster is None:
+                newUserDict[newUserWithHost][TEMPLATE_KEY] = TEMPLATE_ACCESS
+            else:
+                logger.info("New password invite for %s with password %s",
+                            newUserWithHost, password)
+        if cluster is not None:
+            newUserDict[newUserWithHost][CLUSTERS_KEY] |= set([cluster])
+            useHash = newUserDict[newUserWithHost][TEMPLATE_KEY] == TEMPLATE_ACCESS
+            newPassword = newUserDict[newUserWithHost][PASSWORD_KEY]
     if cluster is not None:
-        newUserDict[newUserWithHost][CLUSTERS_KEY] |= set([cluster])
-        useHash = newUserDict[newUserWithHost][TEMPLATE_KEY] == TEMPLATE_ACCESS
-        newPassword = newUserDict[newUserWithHost][PASSWORD_KEY]
         mysqlConn.createUser(newUserWithHost, newPassword, useHash)
 
 
@@ -299,14 +707,92 @@ def generateRandomPassword():
     return randomPassword
 
 
+def revertClusterAccess(autoGrantConfig, cluster, restoreName, echoOnly, logPasswords, userList=None,
+                        echoScript=None, dropChunkSize=DEFAULT_DROP_CHUNK_SIZE):
+    """
+    brings cluster back to its grants as of the backup restoreName
+    the inverses journaled by the run restoreName are replayed when it has a journal
+    otherwise only the statements that differ from a bulk read of the live grants are run
+    clusters restoreName did not back up or journal are skipped
+    :param userList: a list of user names whose accounts are reverted, all of them when None
+    """
+    revertUser = autoGrantConfig.getMysqlRevertUsername()
+    revertPass = autoGrantConfig.getMysqlRevertPassword()
+    mysqlBackupTool = _getMysqlBackupTool(echoOnly, logPasswords)
+    echoAccessLevel = mysql_query_tool.QAL_ALL
+    queryAccessLevel = mysql_query_tool.QAL_ALL
+    if echoOnly:
+        # the live grants are still read to work out what to restore
+        queryAccessLevel = mysql_query_tool.QAL_READ
+    mysqlConn = mysql_query_tool.MysqlQueryTool(cluster, revertUser,
+                                                revertPass,
+                                                echoAccessLevel,
+                                                queryAccessLevel,
+                                                logPasswords)
+    mysqlConn.setEchoScript(echoScript)
+    try:
+        entryList = mysqlBackupTool.loadJournal(restoreName, cluster)
+        if entryList is not None:
+            # undo only what the run changed, newest statement first
+            logger.info("undoing the %d statements %s journaled on %s", len(entryList), restoreName, cluster)
+            mysqlConn.undoJournal(entryList, userList)
+            return
+        if mysqlBackupTool.getNearestBackup(cluster, restoreName) != restoreName:
+            # the run changed nothing here, an older backup would undo the run that saved it
+            logger.info("skipping %s, %s has no backup or journal of it", cluster, restoreName)
+            return
+        recordList = mysqlBackupTool.loadGrantSnapshot(restoreName, cluster)
+        if recordList is not None:
+            mysqlConn.restoreGrantSnapshot(mysql_query_tool.GrantSnapshot.fromRecords(recordList),
+                                           dropChunkSize, userList)
+        elif userList is not None:
+            raise GrantException("the %s backup of %s is a mysql.user dump which is only restored whole" %
+                                 (restoreName, cluster))
+        else:
+            # backups made before grant snapshots hold a mysqldump of mysql.user
+            mysqlBackupTool.restoreFromMySQLDumpList(cluster, revertUser,
+                                                     revertPass, restoreName,
+                                                     [("mysql", "user")])
+            mysqlConn.queryFlushPrivileges()
+    finally:
+        mysqlConn.closeConnection()
+
+
+def revertAccess(autoGrantConfig, restoreName, echoOnly, logPasswords, userList=None, clusterList=None,
+                 workers=DEFAULT_WORKERS, echoScript=None, dropChunkSize=DEFAULT_DROP_CHUNK_SIZE):
+    """
+    reverts up to workers clusters at once to the backup restoreName
+    :param clusterList: a list of the clusters to revert, all of them when None
+    """
+    mysqlBackupTool = _getMysqlBackupTool(echoOnly, logPasswords)
+    mysqlBackupTool.setEchoScript(echoScript)
+    revertList = [x for x in autoGrantConfig.getDbClusters() if clusterList is None or x in clusterList]
+
+    def revertCluster(cluster):
+        logger.info("reverting %s", cluster)
+        return revertClusterAccess(autoGrantConfig, cluster, restoreName, echoOnly, logPasswords,
+                                   userList, echoScript, dropChunkSize)
+    resultDict = util.runInWorkerPool(revertList, workers, revertCluster)
+    for cluster in revertList:
+        result, error, seconds = resultDict[cluster]
+        if error is None:
+            logger.info("reverted %s in %.2fs", cluster, seconds)
+    errorList = [str(resultDict[x][1]) for x in revertList if resultDict[x][1] is not None]
+    if 0 < len(errorList):
+        raise GrantException("\n".join(errorList))
+
+
 def start(autoGrantConfig, echoOnly, logPasswords, destructive, passwordReset, revert, userList, groupList,
-          clusterList):
+          clusterList, workers=DEFAULT_WORKERS, clusterConcurrency=DEFAULT_CLUSTER_CONCURRENCY,
+          maxInFlight=None, grantPlan=None, stateStore=None, ldapCacheMode=None,
+          batchSize=DEFAULT_BATCH_SIZE, echoScript=None, dropChunkSize=DEFAULT_DROP_CHUNK_SIZE,
+          retentionDays=DEFAULT_RETENTION_DAYS, checkpointStore=None, resume=False, retries=DEFAULT_RETRIES):
     restoreName = ''
     restorePath = ''
     mysqlBackupTool = _getMysqlBackupTool(echoOnly, logPasswords)
 
     pruneBeforeDate = mysqlBackupTool.getPruneBeforeFromTimeDelta(
-        datetime.timedelta(days=30))
+        datetime.timedelta(days=retentionDays))
     mysqlBackupTool.pruneBefore(pruneBeforeDate)
     if revert is not False:
         if revert is None:
@@ -319,24 +805,12 @@ def start(autoGrantConfig, echoOnly, logPasswords, destructive, passwordReset, r
         if restoreName is not None and 0 < len(restoreName):
             restorePath = os.path.join(backupDir, restoreName)
         if os.path.isdir(restorePath):
-            revertUser = autoGrantConfig.getMysqlRevertUsername()
-            revertPass = autoGrantConfig.getMysqlRevertPassword()
-            mysqlBackupTool = _getMysqlBackupTool(echoOnly, logPasswords)
-            for cluster in autoGrantConfig.getDbClusters():
-                logger.info("reverting %s", cluster)
-                echoAccessLevel = mysql_query_tool.QAL_ALL
-                queryAccessLevel = mysql_query_tool.QAL_ALL
-                if echoOnly:
-                    queryAccessLevel = mysql_query_tool.QAL_NONE
-                mysqlConn = mysql_query_tool.MysqlQueryTool(cluster, revertUser,
-                                                            revertPass,
-                                                            echoAccessLevel,
-                                                            queryAccessLevel,
-                                                            logPasswords)
-                mysqlBackupTool.restoreFromMySQLDumpList(cluster, revertUser,
-                                                         revertPass, restoreName,
-                                                         [("mysql", "user")])
-                mysqlConn.queryFlushPrivileges()
+            if clusterList is not None:
+                clusterList = clusterList.split(",")
+            if userList is not None:
+                userList = userList.split(",")
+            revertAccess(autoGrantConfig, restoreName, echoOnly, logPasswords, userList, clusterList,
+                         workers, echoScript, dropChunkSize)
         else:
             logger.error("No backup was found under %s", backupDir)
     else:
@@ -349,11 +823,18 @@ def start(autoGrantConfig, echoOnly, logPasswords, destructive, passwordReset, r
                            str(ldapUrl), str(ldapUsernameBase), str(ldapPassword),
                            "this will disable ldap integration")
         else:
-            ldapQueryTool = ldap_query_tool.LdapQueryTool(ldapUrl,
-                                                          ldapUsernameBase,
-                                                          ldapPassword)
-            ldapGroupDesc = autoGrantConfig.getLdapGroupDesc()
-            ldapGroupDict = ldapQueryTool.queryLDAP(ldapGroupDesc)
+            def connect():
+                return ldap_query_tool.LdapQueryTool(ldapUrl, ldapUsernameBase, ldapPassword)
+            if ldapCacheMode is not None:
+                # the cache holds every group so user and group lists are applied below
+                ldapGroupCache = ldap_cache.LdapGroupCache(ldapUrl, autoGrantConfig.getLdapGroupDesc(),
+                                                           autoGrantConfig.getLdapCacheTtl())
+                ldapGroupDict = ldapGroupCache.getGroupEntries(connect, autoGrantConfig.getLdapMinGid(),
+                                                               autoGrantConfig.getLdapGidOrdering(),
+                                                               autoGrantConfig.getLdapPageSize(),
+                                                               ldapCacheMode)
+            else:
+                ldapGroupDict = queryLdapGroups(autoGrantConfig, connect(), userList, groupList)
         groupDict = makeGroupDict(autoGrantConfig, ldapGroupDict)
         if userList is not None:
             userList = userList.split(",")
@@ -367,7 +848,25 @@ def start(autoGrantConfig, echoOnly, logPasswords, destructive, passwordReset, r
         logger.debug("userDict:\n"+pprint.pformat(userDict))
         grantDict = makeGrantDict(autoGrantConfig, userDict, clusterList)
         logger.debug("grantDict:\n"+pprint.pformat(grantDict))
-        grantAccess(autoGrantConfig, grantDict, echoOnly, logPasswords, destructive, passwordReset)
+        grantAccess(autoGrantConfig, grantDict, echoOnly, logPasswords, destructive, passwordReset,
+                    workers, clusterConcurrency, maxInFlight, grantPlan, stateStore, batchSize,
+                    echoScript, dropChunkSize, checkpointStore, resume, retries)
+
+
+def confirmRun(nonInteractive):
+    """asks whether the echoed commands should be run"""
+    userInput = "No"
+    if nonInteractive is True:
+        logger.info("The above commands will be run %s...",
+                    "non-interactively")
+        userInput = "Yes"
+    else:
+        userInput = util.askQuestion("Are you sure you would like to run the above commands:\n" +
+                                     "Type %s to continue %s to skip" %
+                                     ("[Yes]", "[Enter]"))
+    if userInput != "Yes":
+        logger.info("skipping...")
+    return userInput == "Yes"
 
 
 def init_config(nonInteractive):
@@ -413,17 +912,34 @@ def main(args=None):
                         help="the log level")
     parser.add_argument('-e', '--echo-only', action='store_true',
                         help="just print out the queries to run")
+    parser.add_argument('--echo-format', type=str, default=echo_script.ECHO_FORMAT_CMD,
+                        choices=echo_script.ECHO_FORMATS,
+                        help="cmd: a mysql -e command per statement, sql: one mysql session per cluster")
+    parser.add_argument('--echo-dir', type=str, default=None,
+                        help="with --echo-format=sql write preamble.sh and a cluster.sql per cluster here")
     parser.add_argument('--non-interactive', action='store_true', default=False,
                         help="just run without any prompting")
     parser.add_argument('-C', '--cluster-list', type=str,
                         help="a comma delimited list of clusters to filter by")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help="the number of clusters to reconcile at once")
+    parser.add_argument('--cluster-concurrency', type=int, default=DEFAULT_CLUSTER_CONCURRENCY,
+                        help="the number of connections applying users at once on each cluster")
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help="the most users being applied at once across all clusters")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="the statements sent to a cluster in one round trip, 1 sends them one by one")
+    parser.add_argument('--drop-chunk-size', type=int, default=DEFAULT_DROP_CHUNK_SIZE,
+                        help="the accounts removed by each DROP USER statement of a destructive run")
+    parser.add_argument('--retention-days', type=int, default=DEFAULT_RETENTION_DAYS,
+                        help="backups older than this many days are pruned")
     usrGrp.add_argument('-U', '--user-list', type=str,
                         help="a comma delimited list of users to filter by")
     usrGrp.add_argument('-G', '--group-list', type=str,
                         help="a comma delimited list of groups to filter by")
     dstGrp.add_argument('-r', '--revert', nargs='?', type=str,
                         required=False, default=False,
-                        help="restore using the latest backup")
+                        help="restore using the latest backup, scoped by --user-list and --cluster-list")
     dstGrp.add_argument('--destructive', action='store_true',
                         required=False, default=False,
                         help="drop users and revoke privileges")
@@ -433,6 +949,20 @@ def main(args=None):
     parser.add_argument('--log-passwords', action='store_true',
                         required=False, default=False,
                         help="useful if you want to pipe the -l CRITICAL output to mysql tool")
+    parser.add_argument('--plan', type=str, default=None,
+                        help="save the statements to run and the observed grants to this plan file")
+    parser.add_argument('--apply', type=str, default=None,
+                        help="run the statements of a plan file saved by --plan")
+    parser.add_argument('--ldap-cache', type=str, default=None, choices=ldap_cache.CACHE_MODES,
+                        help="use: reuse ldap groups cached within ldap_cache_ttl, refresh: only refetch changed groups")
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help="skip clusters and users unchanged since the last applied run")
+    parser.add_argument('--state-file', type=str, default=state_store.DEFAULT_STATE_FILE,
+                        help="where --incremental keeps the last applied state and runs keep their checkpoints")
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help="skip the clusters and users the last run with the same inputs finished")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help="the times a failed cluster is retried after the others")
     reqGrp.add_argument('-y', '--yaml-conf', type=str, required=False,
                         default=os.path.join(os.getcwd(), 'auto_grant.yaml'),
                         help="the yaml configuration path")
@@ -447,34 +977,92 @@ def main(args=None):
         logger.warn("Unknown logLevel=%s retaining level at INFO",
                     parsedArgs.log_level)
     logger.debug(pprint.pformat(parsedArgs))
-    if ((parsedArgs.destructive is True or parsedArgs.revert is not False) and
-            (parsedArgs.user_list is not None or parsedArgs.group_list is not None)):
+    if ((parsedArgs.destructive is True and
+            (parsedArgs.user_list is not None or parsedArgs.group_list is not None)) or
+            (parsedArgs.revert is not False and parsedArgs.group_list is not None)):
         print ("Can not use user arguments in combination with " +
-               "destructive arguments")
+               "destructive arguments, --revert only takes --user-list")
+        retCode = RET_MUTEX_ARGS
+    elif parsedArgs.resume is True and (parsedArgs.revert is not False or parsedArgs.plan is not None):
+        print ("Can not use --resume in combination with --revert or --plan")
+        retCode = RET_MUTEX_ARGS
+    elif ((parsedArgs.plan is not None or parsedArgs.apply is not None) and
+            (parsedArgs.revert is not False or parsedArgs.echo_only is True or
+             (parsedArgs.plan is not None and parsedArgs.apply is not None))):
+        print ("Can not use --plan or --apply in combination with " +
+               "each other, --revert or --echo-only")
         retCode = RET_MUTEX_ARGS
     else:
+        stateStore = None
+        checkpointStore = None
+        if not parsedArgs.init and (parsedArgs.incremental or parsedArgs.resume or
+                                    (parsedArgs.echo_only is False and parsedArgs.plan is None and
+                                     parsedArgs.revert is False)):
+            checkpointStore = state_store.GrantStateStore(parsedArgs.state_file)
+            if parsedArgs.incremental:
+                stateStore = checkpointStore
         if parsedArgs.init:
             init_config(parsedArgs.non_interactive)
+        elif parsedArgs.apply is not None:
+            autoGrantConfig = auto_grant_config.AutoGrantConfig(parsedArgs.yaml_conf)
+            grantPlan = grant_plan.GrantPlan.load(parsedArgs.apply)
+            logger.info("plan %s made on %s has %d statements on %d clusters",
+                        parsedArgs.apply, grantPlan.getCreated(),
+                        grantPlan.getStatementCount(), len(grantPlan.getClusters()))
+            if confirmRun(parsedArgs.non_interactive):
+                applyGrantPlan(autoGrantConfig, grantPlan, parsedArgs.log_passwords, parsedArgs.workers,
+                               stateStore, parsedArgs.batch_size, checkpointStore, parsedArgs.resume,
+                               parsedArgs.retries)
         else:
             autoGrantConfig = auto_grant_config.AutoGrantConfig(parsedArgs.yaml_conf)
-            start(autoGrantConfig, True, parsedArgs.log_passwords, parsedArgs.destructive, parsedArgs.password_reset, parsedArgs.revert,
-                  parsedArgs.user_list, parsedArgs.group_list, parsedArgs.cluster_list)
-            if(parsedArgs.echo_only is False):
-                userInput = "No"
-                if parsedArgs.non_interactive is True:
-                    logger.info("The above commands will be run %s...",
-                                "non-interactively")
-                    userInput = "Yes"
+            echoScript = None
+            if parsedArgs.echo_format == echo_script.ECHO_FORMAT_SQL:
+                echoScript = echo_script.EchoScript()
+            grantPlan = None
+            if parsedArgs.revert is False and (parsedArgs.plan is not None or parsedArgs.echo_only is False):
+                echoAccessLevel, queryAccessLevel = getAccessLevels(True, parsedArgs.destructive,
+                                                                    parsedArgs.password_reset)
+                grantPlan = grant_plan.GrantPlan({'accessLevel': echoAccessLevel,
+                                                  'destructive': parsedArgs.destructive,
+                                                  'passwordReset': parsedArgs.password_reset,
+                                                  'yamlConf': parsedArgs.yaml_conf})
+            planError = None
+            try:
+                start(autoGrantConfig, True, parsedArgs.log_passwords, parsedArgs.destructive, parsedArgs.password_reset, parsedArgs.revert,
+                      parsedArgs.user_list, parsedArgs.group_list, parsedArgs.cluster_list,
+                      parsedArgs.workers, parsedArgs.cluster_concurrency, parsedArgs.max_in_flight,
+                      grantPlan, stateStore, parsedArgs.ldap_cache, parsedArgs.batch_size, echoScript,
+                      parsedArgs.drop_chunk_size, parsedArgs.retention_days, checkpointStore,
+                      parsedArgs.resume, parsedArgs.retries)
+            except GrantException as e:
+                if grantPlan is None or parsedArgs.plan is not None:
+                    raise
+                # the clusters that were planned are still applied, --resume picks up the rest
+                logger.error("applying the %d clusters that could be planned", len(grantPlan.getClusters()))
+                planError = e
+            if echoScript is not None and parsedArgs.echo_dir is not None:
+                echoScript.writeDir(parsedArgs.echo_dir)
+            elif echoScript is not None:
+                echoScript.write(sys.stdout)
+            if parsedArgs.plan is not None:
+                grantPlan.save(parsedArgs.plan)
+            elif parsedArgs.echo_only is False and confirmRun(parsedArgs.non_interactive):
+                if grantPlan is not None:
+                    # run exactly what was echoed without querying ldap and the clusters again
+                    applyGrantPlan(autoGrantConfig, grantPlan, parsedArgs.log_passwords, parsedArgs.workers,
+                                   stateStore, parsedArgs.batch_size, checkpointStore, parsedArgs.resume,
+                                   parsedArgs.retries)
                 else:
-                    userInput = util.askQuestion("Are you sure you would like to run the above commands:\n" +
-                                                 "Type %s to continue %s to skip" %
-                                                 ("[Yes]", "[Enter]"))
-                if userInput == "Yes":
                     start(autoGrantConfig, parsedArgs.echo_only, parsedArgs.log_passwords, parsedArgs.destructive, parsedArgs.password_reset,
                           parsedArgs.revert, parsedArgs.user_list, parsedArgs.group_list,
-                          parsedArgs.cluster_list)
-                else:
-                    logger.info("skipping...")
+                          parsedArgs.cluster_list, parsedArgs.workers, parsedArgs.cluster_concurrency,
+                          parsedArgs.max_in_flight, None, None, parsedArgs.ldap_cache,
+                          parsedArgs.batch_size, None, parsedArgs.drop_chunk_size,
+                          parsedArgs.retention_days)
+            if planError is not None:
+                raise planError
+        if checkpointStore is not None:
+            checkpointStore.close()
     logger.info("done.")
     return retCode
 
@@ -7,11 +7,17 @@ mysql_query_tool tool to perform mysql queries
 """
 import argparse
 import contextlib
+import echo_script
+import grant_journal
+import hashlib
 import logging
 import MySQLdb
+from MySQLdb.constants import CLIENT
 import pprint
+import privilege_mask
 import re
 import sys
+import util
 
 
 logger = logging.getLogger(__name__)
@@ -25,12 +31,335 @@ QAL_ALL = 4
 HIDE_PASS = True
 OLD_PASS_COLUMN = "Password"
 NEW_PASS_COLUMN = "authentication_string"
+# privilege columns whose GRANT name can not be derived from the column name
+PRIVILEGE_COLUMN_NAMES = {'Show_db_priv': "SHOW DATABASES",
+                          'Create_tmp_table_priv': "CREATE TEMPORARY TABLES",
+                          'Repl_slave_priv': "REPLICATION SLAVE",
+                          'Repl_client_priv': "REPLICATION CLIENT"}
+# the grant option is reported as WITH GRANT OPTION and is not part of ALL PRIVILEGES
+GRANT_OPTION_COLUMN = "Grant_priv"
+GRANT_OPTION_TABLE_PRIV = "GRANT"
+TABLE_LEVEL_PRIVILEGES = set(privilege_mask.TABLE_PRIVILEGES)
+# roles and mysql.role_edges appeared in 8.0
+ROLES_VERSION = privilege_mask.ROLES_VERSION
+GRANT_ON_PATTERN = re.compile(r"^GRANT (.+?) ON ((?:(?:FUNCTION|PROCEDURE|TABLE) )?"
+                              r"(?:`(?:[^`]|``)*`|\*|[^\s.`]+)\.(?:`(?:[^`]|``)*`|\*|[^\s`]+)) TO (.*)$")
+GRANT_ROLES_PATTERN = re.compile(r"^GRANT (.+?) TO (.*)$")
+WITH_GRANT_OPTION_PATTERN = re.compile(r"\bWITH\b.*\bGRANT OPTION\b")
+FLUSH_PRIVILEGES = "FLUSH PRIVILEGES"
+# statements that change the grant tables without going through GRANT, REVOKE or CREATE USER
+DIRECT_GRANT_TABLE_WRITE_PATTERN = re.compile(r"^\s*(?:INSERT|UPDATE|DELETE|REPLACE)\b.*\bmysql\.`?"
+                                              r"(?:user|db|tables_priv|columns_priv|procs_priv|proxies_priv)\b",
+                                              re.IGNORECASE | re.DOTALL)
+# the statements the query tool changes grants with, parsed to journal their inverses
+PRIVILEGE_STATEMENT_PATTERN = re.compile(r"^(GRANT|REVOKE) (.+) ON (.+) (?:TO|FROM) %s@%s$")
+ROLE_STATEMENT_PATTERN = re.compile(r"^(GRANT|REVOKE) %s@%s (?:TO|FROM) %s@%s$")
+COLUMN_PRIVILEGE_PATTERN = re.compile(r"^(.+) \(`(.+)`\)$")
+CREATE_USER_QUERY = "CREATE USER %s@%s"
+DROP_USER_QUERY = "DROP USER "
+SET_PASSWORD_QUERY = "SET PASSWORD FOR %s@%s = %s"
+ALTER_PASSWORD_QUERY = "ALTER USER %s@%s IDENTIFIED WITH mysql_native_password AS %s"
+# statements whose last argument is a password or its hash
+PASSWORD_STATEMENT_PATTERN = re.compile(r"^SET PASSWORD\b|\bIDENTIFIED\b")
+REDACTED = "REDACTED"
+# no such grant, table grant or routine grant, no such user for SET PASSWORD and CREATE or DROP USER failing
+MISSING_GRANT_ERRORS = frozenset([1141, 1147, 1403, 1133, 1396])
+
+
+def splitUserAtHost(userAtHost):
+    """splits 'user'@'host' or user@host into its unquoted parts"""
+    userPart, hostPart = (x.strip("'") for x in userAtHost.rsplit('@', 1))
+    return userPart, hostPart
+
+
+def getColumnPrivileges(row):
+    """converts the Y/N *_priv columns of a mysql.user or mysql.db row into
+       the privilege names SHOW GRANTS would report for that row
+    """
+    privileges = set()
+    privColumns = [x for x in row.keys()
+                   if x.endswith("_priv") and x != GRANT_OPTION_COLUMN]
+    grantedColumns = [x for x in privColumns if row[x] == 'Y']
+    if 0 < len(privColumns) and len(grantedColumns) == len(privColumns):
+        privileges.add("ALL PRIVILEGES")
+    else:
+        for column in grantedColumns:
+            if column in PRIVILEGE_COLUMN_NAMES:
+                privileges.add(PRIVILEGE_COLUMN_NAMES[column])
+            else:
+                privileges.add(column[:-len("_priv")].replace("_", " ").upper())
+    if row.get(GRANT_OPTION_COLUMN) == 'Y':
+        privileges.add(privilege_mask.GRANT_OPTION)
+    return privileges
+
+
+def getTablePrivileges(tablePriv):
+    """converts the Table_priv SET column of mysql.tables_priv into
+       the privilege names SHOW GRANTS would report for that row
+    """
+    if isinstance(tablePriv, basestring):
+        tablePriv = [x for x in tablePriv.split(",") if 0 < len(x)]
+    privileges = set([x.upper() for x in tablePriv])
+    grantOption = GRANT_OPTION_TABLE_PRIV in privileges
+    privileges.discard(GRANT_OPTION_TABLE_PRIV)
+    if TABLE_LEVEL_PRIVILEGES <= privileges:
+        privileges = set(["ALL PRIVILEGES"])
+    if grantOption:
+        privileges.add(privilege_mask.GRANT_OPTION)
+    return privileges
+
+
+def unquote(name):
+    """strips the backticks or quotes SHOW GRANTS puts around an identifier"""
+    name = name.strip()
+    if 2 <= len(name) and name[0] == name[-1] and name[0] in "`'\"":
+        name = name[1:-1].replace(name[0] * 2, name[0])
+    return name
+
+
+def unquoteUserAtHost(userAtHost):
+    """converts `user`@`host` or 'user'@'host' into user@host"""
+    userPart, hostPart = userAtHost.strip().rsplit('@', 1)
+    return unquote(userPart) + '@' + unquote(hostPart)
+
+
+def splitGrantList(grantList):
+    """splits on the commas that are not inside parentheses or quotes"""
+    items = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, char in enumerate(grantList):
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in "`'\"":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            items.append(grantList[start:i].strip())
+            start = i + 1
+    items.append(grantList[start:].strip())
+    return [x for x in items if 0 < len(x)]
+
+
+def parseGrantLine(grantLine):
+    """
+    parses one row of SHOW GRANTS
+    returns (db_table, set(privileges), {column: set(privileges)}, roles)
+    db_table is None for a role grant and the result is None for anything else e.g. GRANT PROXY
+    e.g. GRANT SELECT (`a`, `b`), INSERT ON `db`.`t` TO `u`@`%` WITH GRANT OPTION returns
+    ('db.t', set(['INSERT', 'GRANT OPTION']), {'a': set(['SELECT']), 'b': set(['SELECT'])}, [])
+    """
+    matches = GRANT_ON_PATTERN.match(grantLine)
+    if matches is None:
+        matches = GRANT_ROLES_PATTERN.match(grantLine)
+        if matches is None or " ON " in matches.group(1):
+            logger.warning("could not parse grant: %s", grantLine)
+            return None
+        roles = [unquoteUserAtHost(x) for x in splitGrantList(matches.group(1)) if '@' in x]
+        return None, set(), {}, roles
+    dbTable = matches.group(2).strip().replace("`", "")
+    privileges = set()
+    columnDict = {}
+    for item in splitGrantList(matches.group(1)):
+        if item.endswith(")") and "(" in item:
+            privilege, columns = item[:-1].split("(", 1)
+            for column in splitGrantList(columns):
+                columnDict.setdefault(unquote(column), set()).add(privilege.strip().upper())
+        else:
+            privileges.add(item.upper())
+    if WITH_GRANT_OPTION_PATTERN.search(matches.group(3)):
+        privileges.add(privilege_mask.GRANT_OPTION)
+    return dbTable, privileges, columnDict, []
+
+
+class StatementBatchException(Exception):
+    """a queued statement failed, owner is whoever queued it e.g. the user@host being granted"""
+
+    def __init__(self, error, owner, statement):
+        super(StatementBatchException, self).__init__("%s: [%s] queued for %s failed" % (error, statement, owner))
+        self.error = error
+        self.owner = owner
+        self.statement = statement
+
+
+class GrantSnapshot(object):
+    """
+    an in-memory index of the accounts and grants on a cluster
+    keyed by user@host and then by db_table holding privilege_mask masks
+    """
+
+    def __init__(self):
+        self._passwordHashes = {}
+        self._userGrants = {}
+        self._columnGrants = {}
+        self._roles = {}
+
+    def _getKey(self, userAtHost):
+        userPart, hostPart = splitUserAtHost(userAtHost)
+        return userPart + '@' + hostPart
+
+    def addUser(self, userAtHost, passwordHash):
+        key = self._getKey(userAtHost)
+        self._passwordHashes[key] = passwordHash
+        if key not in self._userGrants:
+            self._userGrants[key] = {}
+
+    def dropUser(self, userAtHost):
+        key = self._getKey(userAtHost)
+        self._passwordHashes.pop(key, None)
+        self._userGrants.pop(key, None)
+        self._columnGrants.pop(key, None)
+        self._roles.pop(key, None)
+
+    def addGrants(self, userAtHost, dbTable, privileges):
+        """privileges is a list of names or a mask"""
+        key = self._getKey(userAtHost)
+        if key not in self._userGrants:
+            self._userGrants[key] = {}
+        userGrants = self._userGrants[key]
+        userGrants[dbTable] = userGrants.get(dbTable, 0) | privilege_mask.toMask(privileges, dbTable)
+
+    def removeGrants(self, userAtHost, dbTable, privileges):
+        """the *.* grant stays as USAGE like the mysql.user row does"""
+        key = self._getKey(userAtHost)
+        userGrants = self._userGrants.get(key, {})
+        if dbTable in userGrants:
+            userGrants[dbTable] &= ~privilege_mask.toMask(privileges, dbTable)
+            if userGrants[dbTable] == 0 and dbTable != "*.*":
+                del userGrants[dbTable]
+
+    def addColumnGrants(self, userAtHost, dbTable, column, privileges):
+        columnGrants = self._columnGrants.setdefault(self._getKey(userAtHost), {}).setdefault(dbTable, {})
+        columnGrants[column] = columnGrants.get(column, 0) | privilege_mask.toMask(privileges, dbTable)
+
+    def addRole(self, userAtHost, roleAtHost):
+        self._roles.setdefault(self._getKey(userAtHost), set()).add(self._getKey(roleAtHost))
+
+    def userExists(self, userAtHost):
+        return self._getKey(userAtHost) in self._passwordHashes
+
+    def getPasswordHash(self, userAtHost):
+        return self._passwordHashes.get(self._getKey(userAtHost))
+
+    def getUserGrants(self, userAtHost):
+        """returns {db_table: set(privileges)} for the user"""
+        userGrants = self._userGrants.get(self._getKey(userAtHost), {})
+        return dict((x, privilege_mask.toNames(y, x)) for x, y in userGrants.items())
+
+    def getGrantMask(self, userAtHost, dbTable):
+        """returns the mask the user holds on db_table or None"""
+        return self._userGrants.get(self._getKey(userAtHost), {}).get(dbTable)
+
+    def getColumnGrants(self, userAtHost):
+        """returns {db_table: {column: set(privileges)}} for the user"""
+        columnGrants = self._columnGrants.get(self._getKey(userAtHost), {})
+        return dict((x, dict((column, privilege_mask.toNames(mask, x)) for column, mask in y.items()))
+                    for x, y in columnGrants.items())
+
+    def getRoles(self, userAtHost):
+        """returns the user@host of every role granted to the user"""
+        return set(self._roles.get(self._getKey(userAtHost), set()))
+
+    def getAllUsers(self):
+        return set(self._passwordHashes.keys())
+
+    def getGrantTables(self, userAtHost):
+        return set(self._userGrants.get(self._getKey(userAtHost), {}).keys())
+
+    def getColumnMask(self, userAtHost, dbTable, column):
+        return self._columnGrants.get(self._getKey(userAtHost), {}).get(dbTable, {}).get(column, 0)
+
+    def toRecords(self):
+        """
+        returns a json serializable dict per account sorted by user@host
+        privileges are kept by name so saved records outlive the privilege_mask bit layout
+        """
+        recordList = []
+        for key in sorted(self._passwordHashes.keys()):
+            userGrants = self._userGrants.get(key, {})
+            columnGrants = self._columnGrants.get(key, {})
+            recordList.append({'user': key,
+                               'hash': self._passwordHashes[key],
+                               'grants': dict((x, privilege_mask.toNameList(y, x)) for x, y in userGrants.items()),
+                               'columns': dict((x, dict((column, privilege_mask.toNameList(mask, x))
+                                                        for column, mask in y.items()))
+                                               for x, y in columnGrants.items()),
+                               'roles': sorted(self._roles.get(key, []))})
+        return recordList
+
+    @classmethod
+    def fromRecords(cls, recordList):
+        snapshot = cls()
+        for record in recordList:
+            userAtHost = record['user']
+            snapshot.addUser(userAtHost, record['hash'])
+            for dbTable, privileges in record['grants'].items():
+                snapshot.addGrants(userAtHost, dbTable, privileges)
+            for dbTable, columnDict in record['columns'].items():
+                for column, privileges in columnDict.items():
+                    snapshot.addColumnGrants(userAtHost, dbTable, column, privileges)
+            for roleAtHost in record['roles']:
+                snapshot.addRole(userAtHost, roleAtHost)
+        return snapshot
+
+    def getFingerprint(self):
+        """a digest of every account, password hash, grant and role in the snapshot"""
+        digest = hashlib.sha1()
+        for key in sorted(set(self._passwordHashes.keys()) | set(self._userGrants.keys())):
+            digest.update("%s\0%s\0" % (key, self._passwordHashes.get(key)))
+            userGrants = self._userGrants.get(key, {})
+            for dbTable in sorted(userGrants.keys()):
+                digest.update("%s:%x\0" % (dbTable, userGrants[dbTable]))
+            columnGrants = self._columnGrants.get(key, {})
+            for dbTable in sorted(columnGrants.keys()):
+                for column in sorted(columnGrants[dbTable].keys()):
+                    digest.update("%s(%s):%x\0" % (dbTable, column, columnGrants[dbTable][column]))
+            for role in sorted(self._roles.get(key, [])):
+                digest.update("role:%s\0" % role)
+        return digest.hexdigest()
+
+
+def getRecreateStatements(snapshot, userAtHost, version=None):
+    """returns the statements creating userAtHost again with its saved hash, grants and roles"""
+    userPart, hostPart = splitUserAtHost(userAtHost)
+    passwordHash = snapshot.getPasswordHash(userAtHost)
+    statementList = [(QAL_READ_WRITE, "CREATE USER %s@%s", (userPart, hostPart))]
+    if passwordHash:
+        statementList = [(QAL_READ_WRITE, "CREATE USER %s@%s IDENTIFIED BY PASSWORD %s",
+                          (userPart, hostPart, passwordHash))]
+    for dbTable in sorted(snapshot.getGrantTables(userAtHost)):
+        mask = snapshot.getGrantMask(userAtHost, dbTable)
+        if mask:
+            statementList.append((QAL_READ_WRITE, "GRANT %s ON %s TO %%s@%%s" %
+                                  (privilege_mask.render(mask, dbTable, version), dbTable), (userPart, hostPart)))
+    columnGrants = snapshot.getColumnGrants(userAtHost)
+    for dbTable in sorted(columnGrants.keys()):
+        for column in sorted(columnGrants[dbTable].keys()):
+            columnMask = snapshot.getColumnMask(userAtHost, dbTable, column)
+            columnPrivileges = ", ".join("%s (`%s`)" % (x, column)
+                                         for x in privilege_mask.toNameList(columnMask, dbTable))
+            statementList.append((QAL_READ_WRITE, "GRANT %s ON %s TO %%s@%%s" % (columnPrivileges, dbTable),
+                                  (userPart, hostPart)))
+    for roleAtHost in sorted(snapshot.getRoles(userAtHost)):
+        rolePart, roleHostPart = splitUserAtHost(roleAtHost)
+        statementList.append((QAL_READ_WRITE, "GRANT %s@%s TO %s@%s", (rolePart, roleHostPart, userPart, hostPart)))
+    return statementList
 
 
 class MysqlQueryTool(object):
 
     def __init__(self, cluster, mysqlUser, mysqlPass, echoAccessLevel,
-                 queryAccessLevel, logPasswords, database=''):
+                 queryAccessLevel, logPasswords, database='', batchSize=None):
+        """
+        with a batchSize above 1 the statements that change grants are queued
+        and sent batchSize at a time as one multi statement query
+        NOTE: call finishStatements to send what is left in the queue
+        """
         self._cluster = cluster
         self._mysqlUser = mysqlUser
         self._mysqlPass = mysqlPass
@@ -40,19 +369,33 @@ class MysqlQueryTool(object):
         self._database = database
         self._connection = None
         self._version = None
+        self._snapshot = None
+        self._statementRecorder = None
+        self._echoScript = None
+        self._batchSize = batchSize
+        self._pendingStatements = []
+        self._statementOwner = None
+        self._needsFlushPrivileges = False
+        self._journal = None
+        self._journalWriter = None
         self.connect()
 
     def connect(self):
         if self._connection is None:
-            self._connection = MySQLdb.connect(self._cluster, self._mysqlUser, self._mysqlPass,
-                                               self._database)
+            if self.isBatching():
+                self._connection = MySQLdb.connect(self._cluster, self._mysqlUser, self._mysqlPass,
+                                                   self._database, client_flag=CLIENT.MULTI_STATEMENTS)
+            else:
+                self._connection = MySQLdb.connect(self._cluster, self._mysqlUser, self._mysqlPass,
+                                                   self._database)
 
     def closeConnection(self):
         if self._connection is not None:
             self._connection.close()
             self._connection = None
 
-    def getCmdLineQuery(self, query, qArgs):
+    def getCmdLineClient(self):
+        """returns the mysql command line that reaches the cluster without a query"""
         clusterArg = ""
         usernameArg = ""
         passwordArg = ""
@@ -68,25 +411,41 @@ class MysqlQueryTool(object):
                 passwordArg = " -pREDACTED"
         if self._database is not None and 0 < len(self._database):
             databaseArg = " %s" % self._database
+        return 'mysql%s%s%s%s' % (clusterArg, usernameArg, passwordArg, databaseArg)
+
+    def getPrintableQuery(self, query, qArgs):
+        """returns query with its arguments filled in for logs, passwords are redacted unless logPasswords"""
+        if qArgs is None:
+            return query
+        if not self._logPasswords and PASSWORD_STATEMENT_PATTERN.search(query):
+            qArgs = tuple(qArgs[:-1]) + (REDACTED,)
+        return query % tuple(qArgs)
+
+    def getCmdLineQuery(self, query, qArgs):
         sql = query
         if qArgs is not None:
             literalQuery = query.replace("%s", "'%s'")
             sql = literalQuery % qArgs
-        cmdLineQuery = ('mysql%s%s%s%s -e "%s"' %
-                        (clusterArg, usernameArg, passwordArg, databaseArg,
-                         sql))
+        cmdLineQuery = ('%s -e "%s"' % (self.getCmdLineClient(), sql))
         return cmdLineQuery
 
     def beginTransaction(self):
-        self._connection.autocommit(False)
+        """while batching nothing is sent until a batch fills so there is nothing to hold open"""
+        if not self.isBatching():
+            self._connection.autocommit(False)
 
     def rollbackTransaction(self):
-        self._connection.rollback()
-        self._connection.autocommit(True)
+        """while batching the statements not yet sent for the current owner are dropped"""
+        if self.isBatching():
+            self._pendingStatements = [x for x in self._pendingStatements if x[2] != self._statementOwner]
+        else:
+            self._connection.rollback()
+            self._connection.autocommit(True)
 
     def commitTransaction(self):
-        self._connection.commit()
-        self._connection.autocommit(True)
+        if not self.isBatching():
+            self._connection.commit()
+            self._connection.autocommit(True)
 
     def getCursor(self):
         cursor = None
@@ -94,31 +453,288 @@ class MysqlQueryTool(object):
             cursor = self._connection.cursor(MySQLdb.cursors.DictCursor)
         return cursor
 
+    def setStatementRecorder(self, statementRecorder):
+        """statementRecorder(accessLevel, query, qArgs) is called for every
+           echoed query so it can be saved and run later
+        """
+        self._statementRecorder = statementRecorder
+
+    def setEchoScript(self, echoScript):
+        """echoed queries are added to the echo_script.EchoScript rather than printed"""
+        self._echoScript = echoScript
+
+    def setJournal(self, journal):
+        """
+        every statement run from now on that changes grants is appended to the
+        grant_journal.GrantJournal with the statements undoing it before it is sent
+        """
+        self._journal = journal
+        if journal is not None:
+            self._journalWriter = journal.addWriter()
+
+    def willExecute(self, accessLevel):
+        """returns whether a query at accessLevel is run rather than echoed"""
+        return accessLevel <= self._queryAccessLevel
+
+    def isBatching(self):
+        return self._batchSize is not None and 1 < self._batchSize
+
+    def setStatementOwner(self, owner):
+        """the statements queued from now on are blamed on owner if they fail"""
+        self._statementOwner = owner
+
+    def getPendingCount(self):
+        return len(self._pendingStatements)
+
+    def needsFlushPrivileges(self):
+        return self._needsFlushPrivileges
+
+    def setNeedsFlushPrivileges(self):
+        """used to carry the need over from another connection to the same cluster"""
+        self._needsFlushPrivileges = True
+
+    def flushStatements(self):
+        """sends the queued statements batchSize at a time, they are journaled only now
+           so statements dropped by rollbackTransaction never are
+        """
+        journaled = False
+        for query, qArgs, owner, journalEntry in self._pendingStatements:
+            if journalEntry is not None:
+                self._journal.append(*(journalEntry + (self._journalWriter,)))
+                journaled = True
+        if journaled:
+            # one fsync makes every queued statement durable before any is sent
+            self._journal.sync(self._journalWriter)
+        while 0 < len(self._pendingStatements):
+            batch = self._pendingStatements[:self._batchSize]
+            del self._pendingStatements[:self._batchSize]
+            self.executeBatch(batch)
+        if journaled:
+            self._journal.sent(self._journalWriter)
+
+    def finishStatements(self):
+        """sends the queued statements then a single FLUSH PRIVILEGES if a direct grant table write needs it"""
+        self.flushStatements()
+        if self._needsFlushPrivileges:
+            self._needsFlushPrivileges = False
+            qArgs = None
+            self.executeQuery(FLUSH_PRIVILEGES, qArgs)
+
+    def executeBatch(self, batch):
+        """runs [(query, qArgs, owner)] as one multi statement query
+           the statement that fails is found by counting the result sets that came back
+        """
+        sqlList = []
+        for query, qArgs, owner, journalEntry in batch:
+            if qArgs is not None:
+                query = query % tuple([self._connection.literal(x) for x in qArgs])
+            sqlList.append(query)
+        logger.debug("sending a batch of %d statements", len(sqlList))
+        with contextlib.closing(self.getCursor()) as cursor:
+            index = 0
+            try:
+                cursor.execute(";\n".join(sqlList))
+                index += 1
+                while cursor.nextset():
+                    index += 1
+            except Exception as e:
+                query, qArgs, owner, journalEntry = batch[min(index, len(batch) - 1)]
+                printableQuery = self.getPrintableQuery(query, qArgs)
+                logger.error("query[%s] failed with exception:%s, %d later statements were not run",
+                             printableQuery, pprint.pformat(e), len(batch) - index - 1)
+                self._pendingStatements = []
+                raise StatementBatchException(e, owner, printableQuery)
+
+    def executeQuery(self, query, qArgs):
+        printableQuery = self.getPrintableQuery(query, qArgs)
+        logger.debug(printableQuery)
+        with contextlib.closing(
+                self.getCursor()) as cursor:
+            try:
+                cursor.execute(query, qArgs)
+                result = cursor.fetchall()
+                logger.debug("raw data:%s", pprint.pformat(result))
+            except Exception as e:
+                logger.error("query[%s] failed with exception:%s", printableQuery, pprint.pformat(e))
+                raise e
+        return result
+
     def queryMySQL(self, accessLevel, query, qArgs):
+        """
+        runs, echoes or skips the query depending on its accessLevel
+        while batching writes are queued and return None, FLUSH PRIVILEGES is left to
+        finishStatements and reads send the queue first so they see the writes
+        """
         result = None
         if self._queryAccessLevel < accessLevel:
             if self._echoAccessLevel < accessLevel:
                 logger.debug("skipping destructive query: %s, ",
                              self.getCmdLineQuery(query, qArgs))
             else:
-                print self.getCmdLineQuery(query, qArgs)
+                if self._echoScript is not None:
+                    self._echoScript.addStatement(self._cluster, self.getCmdLineClient(),
+                                                  echo_script.toSqlStatement(query, qArgs))
+                else:
+                    util.echo(self.getCmdLineQuery(query, qArgs))
+                if self._statementRecorder is not None:
+                    self._statementRecorder(accessLevel, query, qArgs)
+        elif not self.isBatching():
+            result = self.executeJournaled(accessLevel, query, qArgs)
+        elif query == FLUSH_PRIVILEGES:
+            # GRANT, REVOKE and CREATE USER reload the grants themselves
+            pass
+        elif QAL_READ < accessLevel:
+            if DIRECT_GRANT_TABLE_WRITE_PATTERN.match(query):
+                self._needsFlushPrivileges = True
+            # the inverses are worked out now against the snapshot the statement is queued on
+            self._pendingStatements.append((query, qArgs, self._statementOwner,
+                                            self.getJournalEntry(accessLevel, query, qArgs)))
+            if self._batchSize <= len(self._pendingStatements):
+                self.flushStatements()
         else:
-            printableQuery = query
-            if qArgs is not None:
-                printableQuery = (query % qArgs)
-            logger.debug(printableQuery)
-            with contextlib.closing(
-                    self.getCursor()) as cursor:
-                try:
-                    cursor.execute(query, qArgs)
-                    result = cursor.fetchall()
-                    logger.debug("raw data:%s", pprint.pformat(result))
-                except Exception as e:
-                    logger.error("query[%s] failed with exception:%s", printableQuery, pprint.pformat(e))
-                    raise e
+            self.flushStatements()
+            result = self.executeQuery(query, qArgs)
+        return result
 
+    def queryMySQLUnbatched(self, accessLevel, query, qArgs):
+        """like queryMySQL but sends the queue first and then runs query on its own
+           so the caller can handle its failure
+        """
+        if not self.isBatching() or self._queryAccessLevel < accessLevel:
+            return self.queryMySQL(accessLevel, query, qArgs)
+        self.flushStatements()
+        return self.executeJournaled(accessLevel, query, qArgs)
+
+    def executeJournaled(self, accessLevel, query, qArgs):
+        """runs query once it is durable in the journal and records that it ran"""
+        journaled = self.journalStatement(accessLevel, query, qArgs)
+        if journaled:
+            self._journal.sync(self._journalWriter)
+        result = self.executeQuery(query, qArgs)
+        if journaled:
+            self._journal.sent(self._journalWriter)
         return result
 
+    def getJournalEntry(self, accessLevel, query, qArgs):
+        """returns (users, accessLevel, query, qArgs, inverseList) to journal a statement that changes grants or None"""
+        if self._journal is None or accessLevel <= QAL_READ or query == FLUSH_PRIVILEGES:
+            return None
+        users, inverseList = self.getInverseStatements(query, qArgs)
+        return (users, accessLevel, query, qArgs, inverseList)
+
+    def journalStatement(self, accessLevel, query, qArgs):
+        """appends a statement that changes grants to the journal, returns whether it did"""
+        journalEntry = self.getJournalEntry(accessLevel, query, qArgs)
+        if journalEntry is None:
+            return False
+        self._journal.append(*(journalEntry + (self._journalWriter,)))
+        return True
+
+    def getInverseStatements(self, query, qArgs):
+        """
+        returns (users, [(accessLevel, query, qArgs)]) the user@hosts query changes
+        and the statements undoing it worked out from the grant snapshot
+        the list is None when what query changes is not known
+        """
+        snapshot = self._snapshot
+        roleMatch = ROLE_STATEMENT_PATTERN.match(query)
+        if roleMatch is not None:
+            roleAtHost = qArgs[0] + '@' + qArgs[1]
+            userAtHost = qArgs[2] + '@' + qArgs[3]
+            grant = roleMatch.group(1) == "GRANT"
+            if snapshot is not None and grant == (roleAtHost in snapshot.getRoles(userAtHost)):
+                # the role was already granted or was never there
+                return [userAtHost], []
+            if grant:
+                return [userAtHost], [(QAL_READ_WRITE, "REVOKE %s@%s FROM %s@%s", qArgs)]
+            return [userAtHost], [(QAL_READ_WRITE, "GRANT %s@%s TO %s@%s", qArgs)]
+        privilegeMatch = PRIVILEGE_STATEMENT_PATTERN.match(query)
+        if privilegeMatch is not None:
+            action, privileges, dbTable = privilegeMatch.groups()
+            userAtHost = qArgs[0] + '@' + qArgs[1]
+            return [userAtHost], self.getInversePrivileges(action == "GRANT", userAtHost, privileges, dbTable, qArgs)
+        if query.startswith(CREATE_USER_QUERY):
+            return [qArgs[0] + '@' + qArgs[1]], [(QAL_READ_WRITE_DELETE, "DROP USER %s@%s", tuple(qArgs[:2]))]
+        if query.startswith(DROP_USER_QUERY):
+            users = [qArgs[i] + '@' + qArgs[i + 1] for i in range(0, len(qArgs), 2)]
+            if snapshot is None or not all(snapshot.userExists(x) for x in users):
+                return users, None
+            inverseList = []
+            for userAtHost in users:
+                inverseList.extend(getRecreateStatements(snapshot, userAtHost, self._version))
+            return users, inverseList
+        if query in [SET_PASSWORD_QUERY, ALTER_PASSWORD_QUERY]:
+            userAtHost = qArgs[0] + '@' + qArgs[1]
+            if snapshot is None:
+                return [userAtHost], None
+            return [userAtHost], [(QAL_READ_WRITE, query, (qArgs[0], qArgs[1],
+                                                           snapshot.getPasswordHash(userAtHost) or ''))]
+        return [], None
+
+    def getInversePrivileges(self, grant, userAtHost, privileges, dbTable, qArgs):
+        """
+        returns the REVOKE of what a GRANT added or the GRANT of what a REVOKE removed
+        without a snapshot every named privilege is assumed to change
+        """
+        action, preposition, accessLevel = "GRANT", "TO", QAL_READ_WRITE
+        if grant:
+            action, preposition, accessLevel = "REVOKE", "FROM", QAL_READ_WRITE_DELETE
+        tableNames = []
+        columnDict = {}
+        for privilege in privileges.split(", "):
+            columnMatch = COLUMN_PRIVILEGE_PATTERN.match(privilege)
+            if columnMatch is not None:
+                columnDict.setdefault(columnMatch.group(2), []).append(columnMatch.group(1))
+            else:
+                tableNames.append(privilege)
+
+        def getChangedMask(mask, currentMask):
+            if currentMask is None:
+                return mask
+            if grant:
+                return mask & ~currentMask
+            return mask & currentMask
+        inverseList = []
+        if 0 < len(tableNames):
+            currentMask = None
+            if self._snapshot is not None:
+                currentMask = self._snapshot.getGrantMask(userAtHost, dbTable) or 0
+            changedMask = getChangedMask(privilege_mask.toMask(tableNames, dbTable), currentMask)
+            if changedMask:
+                inverseList.append((accessLevel, "%s %s ON %s %s %%s@%%s" %
+                                    (action, privilege_mask.render(changedMask, dbTable, self._version),
+                                     dbTable, preposition),
+                                    qArgs))
+        for column in sorted(columnDict.keys()):
+            currentMask = None
+            if self._snapshot is not None:
+                currentMask = self._snapshot.getColumnMask(userAtHost, dbTable, column)
+            changedMask = getChangedMask(privilege_mask.toMask(columnDict[column], dbTable), currentMask)
+            if changedMask:
+                columnPrivileges = ", ".join("%s (`%s`)" % (x, column)
+                                             for x in privilege_mask.toNameList(changedMask, dbTable))
+                inverseList.append((accessLevel, "%s %s ON %s %s %%s@%%s" %
+                                    (action, columnPrivileges, dbTable, preposition), qArgs))
+        return inverseList
+
+    def undoJournal(self, entryList, userList=None):
+        """
+        runs the inverses of a run's journal newest first
+        a statement whose batch failed or was cut short by a crash may never have run
+        so only its inverse may fail and only because the grant or user is missing
+        :param userList: only the statements changing accounts of these user names are undone
+        """
+        for entry in reversed(entryList):
+            for accessLevel, query, qArgs in grant_journal.getInverseList([entry], userList):
+                try:
+                    self.queryMySQL(accessLevel, query, qArgs)
+                except MySQLdb.Error as e:
+                    if entry.get('sent', True) or not e.args or e.args[0] not in MISSING_GRANT_ERRORS:
+                        raise
+                    logger.warning("%s may never have run so undoing it with %s on %s failed: %s",
+                                   entry['statement'][1], query, self._cluster, e)
+        self.finishStatements()
+
     def getVersion(self):
         if(self._version is None):
             versionDict = self.queryVersion()
@@ -132,61 +748,164 @@ class MysqlQueryTool(object):
 
     def queryFlushPrivileges(self):
         qArgs = None
-        return self.queryMySQL(QAL_READ_WRITE, "FLUSH PRIVILEGES", qArgs)
+        return self.queryMySQL(QAL_READ_WRITE, FLUSH_PRIVILEGES, qArgs)
 
     def queryGrant(self, userAtHost, privileges,
                    db_table):
+        """privileges is a list of names or a privilege_mask mask"""
         ret = None
         userPart, hostPart = (x.strip("'") for x in userAtHost.rsplit('@', 1))
-        privilegeStr = self.getVerifiedPrivilegeString(privileges)
-        query = "GRANT " + privilegeStr + " ON " + db_table + " TO %s@%s"
+        mask = privilege_mask.toMask(privileges, db_table)
+        query = "GRANT " + privilege_mask.render(mask, db_table, self.getVersion()) + " ON " + db_table + " TO %s@%s"
         qArgs = (userPart, hostPart)
         ret = self.queryMySQL(QAL_READ_WRITE, query, qArgs)
+        if self._snapshot is not None and self.willExecute(QAL_READ_WRITE):
+            self._snapshot.addGrants(userAtHost, db_table, mask)
         return ret
 
-    def queryUserGrants(self, userAtHost):
+    def queryGrantLines(self, userAtHost):
+        """returns parseGrantLine of every SHOW GRANTS row of the user"""
         query = "SHOW GRANTS FOR %s@%s"
         userPart, hostPart = (x.strip("'") for x in userAtHost.rsplit('@', 1))
         qArgs = (userPart, hostPart)
         result = self.queryMySQL(QAL_READ, query, qArgs)
+        grantLines = []
+        for row in result or []:
+            for value in row.values():
+                grantLine = parseGrantLine(value)
+                if grantLine is not None:
+                    grantLines.append(grantLine)
+        return grantLines
+
+    def queryUserGrants(self, userAtHost):
+        """returns {db_table: set(privileges)} from SHOW GRANTS, column grants and roles are left out"""
         userGrantDict = {}
-        if result is not None:
-            for row in result:
-                for value in row.values():
-                    matches = re.search(r"^GRANT (.*) ON (.*) TO ", value)
-                    db_table = matches.group(2).strip().replace("`", "")
-                    grants = set(matches.group(1).split(", "))
-                    if db_table not in userGrantDict:
-                        userGrantDict[db_table] = grants
-                    else:
-                        userGrantDict[db_table] |= grants
+        for dbTable, privileges, columnDict, roles in self.queryGrantLines(userAtHost):
+            if dbTable is not None and 0 < len(privileges):
+                userGrantDict.setdefault(dbTable, set()).update(privileges)
         return userGrantDict
 
     def queryRevoke(self, userAtHost, privileges,
                     db_table):
+        """privileges is a list of names or a privilege_mask mask"""
         ret = None
         userPart, hostPart = (x.strip("'") for x in userAtHost.rsplit('@', 1))
-        privilegeStr = self.getVerifiedPrivilegeString(privileges)
-        query = "REVOKE " + privilegeStr + " ON " + db_table + " FROM %s@%s"
+        mask = privilege_mask.toMask(privileges, db_table)
+        query = "REVOKE " + privilege_mask.render(mask, db_table, self.getVersion()) + " ON " + db_table + " FROM %s@%s"
         qArgs = (userPart, hostPart)
         ret = self.queryMySQL(QAL_READ_WRITE_DELETE, query, qArgs)
+        if self._snapshot is not None and self.willExecute(QAL_READ_WRITE_DELETE):
+            self._snapshot.removeGrants(userAtHost, db_table, mask)
         return ret
 
+    def queryPrivilegeTable(self, query):
+        """returns the rows or None when the account may not read the table"""
+        qArgs = None
+        try:
+            return self.queryMySQL(QAL_READ, query, qArgs) or []
+        except MySQLdb.Error as e:
+            logger.warning("falling back to SHOW GRANTS on %s: %s", self._cluster, e)
+            return None
+
+    def loadGrantSnapshot(self):
+        """reads mysql.user, mysql.db, mysql.tables_priv, mysql.columns_priv,
+           mysql.procs_priv and on 8.0 mysql.role_edges in bulk
+           a privilege table the account can not read is replaced by SHOW GRANTS per user
+           once loaded userExists, getPasswordHash, findAllUsers and
+           getGrantDeltaDict are answered from the snapshot
+           instead of a round trip per user
+        """
+        snapshot = GrantSnapshot()
+        passwordColumn = self.getPasswordColumn()
+        qArgs = None
+        userRows = self.queryMySQL(QAL_READ, "SELECT * FROM mysql.user", qArgs)
+        for row in userRows or []:
+            userAtHost = row['User'] + '@' + row['Host']
+            snapshot.addUser(userAtHost, row.get(passwordColumn))
+            snapshot.addGrants(userAtHost, "*.*", getColumnPrivileges(row))
+        complete = True
+        dbRows = self.queryPrivilegeTable("SELECT * FROM mysql.db")
+        complete &= dbRows is not None
+        for row in dbRows or []:
+            dbPrivileges = getColumnPrivileges(row)
+            if 0 < len(dbPrivileges):
+                snapshot.addGrants(row['User'] + '@' + row['Host'],
+                                   row['Db'] + ".*", dbPrivileges)
+        tableRows = self.queryPrivilegeTable("SELECT User, Host, Db, Table_name, Table_priv FROM mysql.tables_priv")
+        complete &= tableRows is not None
+        for row in tableRows or []:
+            tablePrivileges = getTablePrivileges(row['Table_priv'])
+            if 0 < len(tablePrivileges):
+                snapshot.addGrants(row['User'] + '@' + row['Host'],
+                                   row['Db'] + "." + row['Table_name'],
+                                   tablePrivileges)
+        columnRows = self.queryPrivilegeTable("SELECT User, Host, Db, Table_name, Column_name, Column_priv FROM mysql.columns_priv")
+        complete &= columnRows is not None
+        for row in columnRows or []:
+            columnPrivileges = getTablePrivileges(row['Column_priv'])
+            if 0 < len(columnPrivileges):
+                snapshot.addColumnGrants(row['User'] + '@' + row['Host'],
+                                         row['Db'] + "." + row['Table_name'],
+                                         row['Column_name'], columnPrivileges)
+        procRows = self.queryPrivilegeTable("SELECT User, Host, Db, Routine_name, Routine_type, Proc_priv FROM mysql.procs_priv")
+        complete &= procRows is not None
+        for row in procRows or []:
+            procPrivileges = getTablePrivileges(row['Proc_priv'])
+            if 0 < len(procPrivileges):
+                snapshot.addGrants(row['User'] + '@' + row['Host'],
+                                   row['Routine_type'] + " " + row['Db'] + "." + row['Routine_name'],
+                                   procPrivileges)
+        if ROLES_VERSION <= self.getVersion():
+            roleRows = self.queryPrivilegeTable("SELECT FROM_USER, FROM_HOST, TO_USER, TO_HOST FROM mysql.role_edges")
+            complete &= roleRows is not None
+            for row in roleRows or []:
+                snapshot.addRole(row['TO_USER'] + '@' + row['TO_HOST'],
+                                 row['FROM_USER'] + '@' + row['FROM_HOST'])
+        if not complete:
+            # every grant is reported by SHOW GRANTS so merging it over what was read is safe
+            for userAtHost in snapshot.getAllUsers():
+                for dbTable, privileges, columnDict, roles in self.queryGrantLines(userAtHost):
+                    if dbTable is not None and 0 < len(privileges):
+                        snapshot.addGrants(userAtHost, dbTable, privileges)
+                    for column in columnDict.keys():
+                        snapshot.addColumnGrants(userAtHost, dbTable, column, columnDict[column])
+                    for role in roles:
+                        snapshot.addRole(userAtHost, role)
+        self._snapshot = snapshot
+        return snapshot
+
+    def getGrantSnapshot(self):
+        return self._snapshot
+
+    def setGrantSnapshot(self, snapshot):
+        """shares a snapshot loaded by another connection to the same cluster"""
+        self._snapshot = snapshot
+
     def getGrantDeltaDict(self, userAtHost, dbTable, privileges):
+        """returns {'grants': mask, 'revokes': mask} to bring the user to privileges on dbTable"""
         userPart, hostPart = (x.strip("'") for x in userAtHost.rsplit('@', 1))
-        correctGrants = set(self.getVerifiedPrivilegeString(privileges).split(", "))
-        grantDeltaDict = {'grants': correctGrants, 'revokes': set([])}
-        userGrantDict = {}
-        userExists = self.userExists(userPart, hostPart)
-        if userExists:
+        correctMask = privilege_mask.toMask(privileges, dbTable)
+        currentMask = None
+        if self._snapshot is not None:
+            currentMask = self._snapshot.getGrantMask(userAtHost, dbTable)
+        elif self.userExists(userPart, hostPart):
             userGrantDict = self.queryUserGrants(userAtHost)
-        if dbTable in userGrantDict:
-            currentGrants = set(self.getVerifiedPrivilegeString(userGrantDict[dbTable]).split(", "))
-            grantDeltaDict['grants'] = correctGrants - currentGrants
-            grantDeltaDict['revokes'] = currentGrants - correctGrants
+            if dbTable in userGrantDict:
+                currentMask = privilege_mask.toMask(userGrantDict[dbTable], dbTable)
+        # privileges the server does not know are neither granted nor revoked
+        correctMask = privilege_mask.getSupportedMask(correctMask, self.getVersion())
+        grantDeltaDict = {'grants': correctMask, 'revokes': 0}
+        if currentMask is not None:
+            currentMask = privilege_mask.getSupportedMask(currentMask, self.getVersion())
+            grantDeltaDict['grants'] = correctMask & ~currentMask
+            # GRANT OPTION is given when the config lists it but never taken away
+            # as configs predating its tracking do not list it for accounts that hold it
+            grantDeltaDict['revokes'] = currentMask & ~correctMask & ~privilege_mask.GRANT_OPTION_MASK
         return grantDeltaDict
 
     def findAllUsers(self):
+        if self._snapshot is not None:
+            return self._snapshot.getAllUsers()
         query = "SELECT User, Host FROM mysql.user"
         qArgs = None
         result = self.queryMySQL(QAL_READ, query, qArgs)
@@ -196,6 +915,8 @@ class MysqlQueryTool(object):
         return users
 
     def userExists(self, userPart, hostPart):
+        if self._snapshot is not None:
+            return self._snapshot.userExists(userPart + '@' + hostPart)
         query = "SELECT User, Host FROM mysql.user WHERE User = %s AND Host = %s"
         qArgs = (userPart, hostPart)
         result = self.queryMySQL(QAL_READ, query, qArgs)
@@ -204,17 +925,24 @@ class MysqlQueryTool(object):
             userExists = False
         return userExists
 
-    def getPasswordHash(self, userPart, hostPart):
+    def getPasswordColumn(self):
         fieldName = NEW_PASS_COLUMN
         version = self.getVersion()
         if version <= 5.6:
             fieldName = OLD_PASS_COLUMN
-        query = "SELECT " + fieldName + " FROM mysql.user WHERE User = %s AND Host = %s"
-        qArgs = (userPart, hostPart)
-        result = self.queryMySQL(QAL_READ, query, qArgs)
+        return fieldName
+
+    def getPasswordHash(self, userPart, hostPart):
         passwordHash = None
-        if result is not None and len(result) == 1:
-            passwordHash = result[0][fieldName]
+        if self._snapshot is not None:
+            passwordHash = self._snapshot.getPasswordHash(userPart + '@' + hostPart)
+        else:
+            fieldName = self.getPasswordColumn()
+            query = "SELECT " + fieldName + " FROM mysql.user WHERE User = %s AND Host = %s"
+            qArgs = (userPart, hostPart)
+            result = self.queryMySQL(QAL_READ, query, qArgs)
+            if result is not None and len(result) == 1:
+                passwordHash = result[0][fieldName]
         if passwordHash in [OLD_PASS_COLUMN, NEW_PASS_COLUMN]:
             passwordHash = None
         return passwordHash
@@ -229,7 +957,15 @@ class MysqlQueryTool(object):
                 if useHash:
                     query = "CREATE USER %s@%s IDENTIFIED BY PASSWORD %s"
                 qArgs = (newUser, newHost, newPassword)
-                return self.queryMySQL(QAL_READ_WRITE, query, qArgs)
+                # not queued so a failure reaches the drop and retry below
+                ret = self.queryMySQLUnbatched(QAL_READ_WRITE, query, qArgs)
+                if self._snapshot is not None and self.willExecute(QAL_READ_WRITE):
+                    self._snapshot.addUser(newUserAtHost, newPassword if useHash else None)
+                    self._snapshot.addGrants(newUserAtHost, "*.*", ["USAGE"])
+                return ret
+            except StatementBatchException:
+                # the queue sent first failed on other statements so retrying here would blame the wrong user
+                raise
             except Exception:
                 # try and drop the user first if the create fails
                 # this can sometimes happen after a restore
@@ -241,7 +977,102 @@ class MysqlQueryTool(object):
         newHost = hostPart.strip("'")
         query = "DROP USER %s@%s"
         qArgs = (newUser, newHost)
-        return self.queryMySQL(QAL_READ_WRITE_DELETE, query, qArgs)
+        ret = self.queryMySQL(QAL_READ_WRITE_DELETE, query, qArgs)
+        if self._snapshot is not None and self.willExecute(QAL_READ_WRITE_DELETE):
+            self._snapshot.dropUser(newUserAtHost)
+        return ret
+
+    def setPasswordHash(self, userAtHost, passwordHash):
+        userPart, hostPart = (x.strip("'") for x in userAtHost.rsplit('@', 1))
+        query = SET_PASSWORD_QUERY
+        if 5.7 <= self.getVersion():
+            query = ALTER_PASSWORD_QUERY
+        ret = self.queryMySQL(QAL_READ_WRITE, query, (userPart, hostPart, passwordHash))
+        if self._snapshot is not None and self.willExecute(QAL_READ_WRITE):
+            self._snapshot.addUser(userAtHost, passwordHash)
+        return ret
+
+    def queryColumnGrant(self, userAtHost, privileges, dbTable, column, revoke=False):
+        """grants or revokes privileges on a single column of dbTable"""
+        userPart, hostPart = (x.strip("'") for x in userAtHost.rsplit('@', 1))
+        columnPrivileges = ", ".join("%s (`%s`)" % (x, column) for x in privilege_mask.toNameList(privileges, dbTable))
+        query = "GRANT " + columnPrivileges + " ON " + dbTable + " TO %s@%s"
+        if revoke:
+            query = "REVOKE " + columnPrivileges + " ON " + dbTable + " FROM %s@%s"
+        return self.queryMySQL(QAL_READ_WRITE, query, (userPart, hostPart))
+
+    def queryRole(self, userAtHost, roleAtHost, revoke=False):
+        userPart, hostPart = (x.strip("'") for x in userAtHost.rsplit('@', 1))
+        rolePart, roleHostPart = (x.strip("'") for x in roleAtHost.rsplit('@', 1))
+        query = "GRANT %s@%s TO %s@%s"
+        if revoke:
+            query = "REVOKE %s@%s FROM %s@%s"
+        return self.queryMySQL(QAL_READ_WRITE, query, (rolePart, roleHostPart, userPart, hostPart))
+
+    def restoreGrantSnapshot(self, savedSnapshot, dropChunkSize=100, userList=None):
+        """
+        brings the cluster back to savedSnapshot with the fewest statements
+        accounts made since are dropped, missing ones are created with their saved hash
+        and only the grants, column grants and roles that differ are granted or revoked
+        :param userList: only the accounts of these user names are restored, all of them when None
+        """
+        liveSnapshot = self.loadGrantSnapshot()
+        savedUsers = savedSnapshot.getAllUsers()
+        liveUsers = liveSnapshot.getAllUsers()
+        if userList is not None:
+            userSet = set(userList)
+            savedUsers = set(x for x in savedUsers if splitUserAtHost(x)[0] in userSet)
+            liveUsers = set(x for x in liveUsers if splitUserAtHost(x)[0] in userSet)
+        self.dropUsers(sorted(liveUsers - savedUsers), dropChunkSize)
+        for userAtHost in sorted(savedUsers):
+            passwordHash = savedSnapshot.getPasswordHash(userAtHost)
+            if not liveSnapshot.userExists(userAtHost):
+                if passwordHash:
+                    self.createUser(userAtHost, passwordHash, True)
+                else:
+                    self.createUser(userAtHost, '')
+            elif passwordHash != liveSnapshot.getPasswordHash(userAtHost):
+                self.setPasswordHash(userAtHost, passwordHash)
+            dbTables = savedSnapshot.getGrantTables(userAtHost) | liveSnapshot.getGrantTables(userAtHost)
+            for dbTable in sorted(dbTables):
+                savedMask = savedSnapshot.getGrantMask(userAtHost, dbTable) or 0
+                liveMask = liveSnapshot.getGrantMask(userAtHost, dbTable) or 0
+                if savedMask & ~liveMask:
+                    self.queryGrant(userAtHost, savedMask & ~liveMask, dbTable)
+                if liveMask & ~savedMask:
+                    self.queryRevoke(userAtHost, liveMask & ~savedMask, dbTable)
+            savedColumns = savedSnapshot.getColumnGrants(userAtHost)
+            liveColumns = liveSnapshot.getColumnGrants(userAtHost)
+            for dbTable in sorted(set(savedColumns.keys()) | set(liveColumns.keys())):
+                columns = set(savedColumns.get(dbTable, {}).keys()) | set(liveColumns.get(dbTable, {}).keys())
+                for column in sorted(columns):
+                    savedMask = savedSnapshot.getColumnMask(userAtHost, dbTable, column)
+                    liveMask = liveSnapshot.getColumnMask(userAtHost, dbTable, column)
+                    if savedMask & ~liveMask:
+                        self.queryColumnGrant(userAtHost, savedMask & ~liveMask, dbTable, column)
+                    if liveMask & ~savedMask:
+                        self.queryColumnGrant(userAtHost, liveMask & ~savedMask, dbTable, column, True)
+            savedRoles = savedSnapshot.getRoles(userAtHost)
+            liveRoles = liveSnapshot.getRoles(userAtHost)
+            for roleAtHost in sorted(savedRoles - liveRoles):
+                self.queryRole(userAtHost, roleAtHost)
+            for roleAtHost in sorted(liveRoles - savedRoles):
+                self.queryRole(userAtHost, roleAtHost, True)
+        self.finishStatements()
+
+    def dropUsers(self, userAtHostList, chunkSize):
+        """drops the users with one DROP USER statement per chunkSize accounts"""
+        for i in range(0, len(userAtHostList), max(chunkSize, 1)):
+            chunk = userAtHostList[i:i + max(chunkSize, 1)]
+            qArgs = []
+            for userAtHost in chunk:
+                userPart, hostPart = userAtHost.rsplit('@', 1)
+                qArgs += [userPart.strip("'"), hostPart.strip("'")]
+            query = "DROP USER " + ", ".join(["%s@%s"] * len(chunk))
+            self.queryMySQL(QAL_READ_WRITE_DELETE, query, tuple(qArgs))
+            if self._snapshot is not None and self.willExecute(QAL_READ_WRITE_DELETE):
+                for userAtHost in chunk:
+                    self._snapshot.dropUser(userAtHost)
 
     def createDatabase(self, database):
         query = "CREATE DATABASE IF NOT EXISTS %s" % (database)
@@ -249,55 +1080,11 @@ class MysqlQueryTool(object):
         return self.queryMySQL(QAL_READ_WRITE, query, qArgs)
 
     def getAllPrivileges(self):
-        return set(["ALL PRIVILEGES",
-                    "ALTER",
-                    "ALTER ROUTINE",
-                    "CREATE",
-                    "CREATE ROUTINE",
-                    "CREATE TEMPORARY TABLES",
-                    "CREATE VIEW",
-                    "CREATE USER",
-                    "DELETE",
-                    "DROP",
-                    "EVENT",
-                    "EXECUTE",
-                    "FILE",
-                    "GRANT OPTION",
-                    "INDEX",
-                    "INSERT",
-                    "LOCK TABLES",
-                    "PROCESS",
-                    "PROXY",
-                    "REFERENCES",
-                    "RELOAD",
-                    "REPLICATION CLIENT",
-                    "REPLICATION SLAVE",
-                    "SELECT",
-                    "SHOW DATABASES",
-                    "SHOW VIEW",
-                    "SHUTDOWN",
-                    "SUPER",
-                    "TRIGGER",
-                    "CREATE TABLESPACE",
-                    "UPDATE",
-                    "USAGE"])
-
-    def getVerifiedPrivilegeString(self, privileges):
-        """This list comes from show privileges to remove a privilege
-           simply comment it out
-        """
-        allPrivileges = self.getAllPrivileges()
-        privilegeStr = ""
-        if "ALL PRIVILEGES" in privileges:
-            privilegeStr = ", ".join(allPrivileges)
-        else:
-            upperPrivileges = set([x.upper() for x in privileges])
-            badPrivileges = set(upperPrivileges) - allPrivileges
-            for badPrivilege in badPrivileges:
-                logger.error("Stripping out %s", badPrivilege)
-            goodPrivileges = upperPrivileges & allPrivileges
-            privilegeStr = ", ".join(goodPrivileges)
-        return privilegeStr
+        return set(privilege_mask.PRIVILEGES) | set([privilege_mask.ALL_PRIVILEGES, privilege_mask.USAGE])
+
+    def getVerifiedPrivilegeString(self, privileges, dbTable="*.*"):
+        """returns the privileges as a GRANT would list them with unknown ones stripped"""
+        return privilege_mask.render(privilege_mask.toMask(privileges, dbTable), dbTable)
 
 
 def main(args=None):
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+privilege_mask is a module to represent mysql privileges as an integer bitmask
+ so grant and revoke deltas are bit operations and sql is rendered only when emitted
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+ALL_PRIVILEGES = "ALL PRIVILEGES"
+USAGE = "USAGE"
+GRANT_OPTION = "GRANT OPTION"
+# This list comes from show privileges, a privilege's bit is its index
+PRIVILEGES = ["ALTER",
+              "ALTER ROUTINE",
+              "CREATE",
+              "CREATE ROLE",
+              "CREATE ROUTINE",
+              "CREATE TABLESPACE",
+              "CREATE TEMPORARY TABLES",
+              "CREATE USER",
+              "CREATE VIEW",
+              "DELETE",
+              "DROP",
+              "DROP ROLE",
+              "EVENT",
+              "EXECUTE",
+              "FILE",
+              GRANT_OPTION,
+              "INDEX",
+              "INSERT",
+              "LOCK TABLES",
+              "PROCESS",
+              "PROXY",
+              "REFERENCES",
+              "RELOAD",
+              "REPLICATION CLIENT",
+              "REPLICATION SLAVE",
+              "SELECT",
+              "SHOW DATABASES",
+              "SHOW VIEW",
+              "SHUTDOWN",
+              "SUPER",
+              "TRIGGER",
+              "UPDATE"]
+PRIVILEGE_BITS = dict((x, 1 << i) for i, x in enumerate(PRIVILEGES))
+GRANT_OPTION_MASK = PRIVILEGE_BITS[GRANT_OPTION]
+USAGE_MASK = 0
+LEVEL_GLOBAL = "global"
+LEVEL_DATABASE = "database"
+LEVEL_TABLE = "table"
+# CREATE ROLE and DROP ROLE only parse on 8.0 and later
+ROLES_VERSION = 8.0
+ROLE_PRIVILEGES = frozenset(["CREATE ROLE", "DROP ROLE"])
+DATABASE_PRIVILEGES = frozenset(["ALTER", "ALTER ROUTINE", "CREATE", "CREATE ROUTINE",
+                                 "CREATE TEMPORARY TABLES", "CREATE VIEW", "DELETE", "DROP",
+                                 "EVENT", "EXECUTE", "INDEX", "INSERT", "LOCK TABLES",
+                                 "REFERENCES", "SELECT", "SHOW VIEW", "TRIGGER", "UPDATE"])
+TABLE_PRIVILEGES = frozenset(["ALTER", "CREATE", "CREATE VIEW", "DELETE", "DROP", "INDEX",
+                              "INSERT", "REFERENCES", "SELECT", "SHOW VIEW", "TRIGGER", "UPDATE"])
+
+
+def _makeMask(names):
+    mask = 0
+    for name in names:
+        mask |= PRIVILEGE_BITS[name]
+    return mask
+
+
+ROLE_MASK = _makeMask(ROLE_PRIVILEGES)
+# what ALL PRIVILEGES expands to at each level, it never includes GRANT OPTION
+ALL_MASKS = {LEVEL_GLOBAL: _makeMask(set(PRIVILEGES) - set([GRANT_OPTION, "PROXY"])),
+             LEVEL_DATABASE: _makeMask(DATABASE_PRIVILEGES),
+             LEVEL_TABLE: _makeMask(TABLE_PRIVILEGES)}
+# (tuple(privileges), level): mask, config lists are converted once and then looked up
+_maskCache = {}
+
+
+def getLevel(dbTable):
+    """returns whether db_table names the global, a database or a table level"""
+    if dbTable == "*.*":
+        return LEVEL_GLOBAL
+    if dbTable.endswith(".*"):
+        return LEVEL_DATABASE
+    return LEVEL_TABLE
+
+
+def toMask(privileges, dbTable="*.*"):
+    """
+    converts privilege names into a mask, unknown names are logged and stripped
+    :param privileges: a list or set of names e.g. ['select', 'ALL PRIVILEGES'] or a mask
+    """
+    if isinstance(privileges, (int, long)):
+        return privileges
+    if isinstance(privileges, basestring):
+        privileges = [privileges]
+    level = getLevel(dbTable)
+    cacheKey = (tuple(privileges), level)
+    mask = _maskCache.get(cacheKey)
+    if mask is None:
+        mask = USAGE_MASK
+        for privilege in privileges:
+            name = privilege.upper()
+            if name == ALL_PRIVILEGES:
+                mask |= ALL_MASKS[level]
+            elif name in PRIVILEGE_BITS:
+                mask |= PRIVILEGE_BITS[name]
+            elif name != USAGE:
+                logger.error("Stripping out %s", name)
+        _maskCache[cacheKey] = mask
+    return mask
+
+
+def getSupportedMask(mask, version=None):
+    """returns mask without the privileges a server of version does not know, None keeps them all"""
+    if version is not None and version < ROLES_VERSION:
+        mask &= ~ROLE_MASK
+    return mask
+
+
+def toNameList(mask, dbTable="*.*", version=None):
+    """returns the names of a mask as SHOW GRANTS lists them, ALL PRIVILEGES first"""
+    mask = getSupportedMask(mask, version)
+    if mask == USAGE_MASK:
+        return [USAGE]
+    names = []
+    allMask = getSupportedMask(ALL_MASKS[getLevel(dbTable)], version)
+    if mask & allMask == allMask:
+        names.append(ALL_PRIVILEGES)
+        mask &= ~allMask
+    for i, name in enumerate(PRIVILEGES):
+        if mask & (1 << i):
+            names.append(name)
+    return names
+
+
+def toNames(mask, dbTable="*.*", version=None):
+    """returns set(privileges) of a mask"""
+    return set(toNameList(mask, dbTable, version))
+
+
+def render(mask, dbTable="*.*", version=None):
+    """returns the privilege list of a GRANT or REVOKE statement for a server of version"""
+    return ", ".join(toNameList(mask, dbTable, version))
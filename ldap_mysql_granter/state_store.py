@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+state_store is a module to remember what was last applied to each cluster
+ so unchanged clusters and users can be skipped on the next run
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+logger = logging.getLogger(__name__)
+DEFAULT_STATE_FILE = os.path.join(os.path.expanduser("~"), 'mysqlgrants_state.sqlite')
+# the user_at_host checkpointed once every user of a cluster is applied
+CLUSTER_DONE = ''
+
+
+def hashUserInputs(grantList):
+    """a digest of the grants a user should have on a cluster
+       :param grantList: [{'db_table': '*.*', 'privileges': ['SELECT']}]
+    """
+    normalized = sorted([grant['db_table'], sorted(set([x.upper() for x in grant['privileges']]))]
+                        for grant in grantList)
+    return hashlib.sha1(json.dumps(normalized)).hexdigest()
+
+
+def hashClusterInputs(userInputHashDict, destructive):
+    """a digest of every user input on a cluster and the options that change the outcome"""
+    normalized = [sorted(userInputHashDict.items()), bool(destructive)]
+    return hashlib.sha1(json.dumps(normalized)).hexdigest()
+
+
+def hashRunInputs(grantDict, destructive, passwordReset):
+    """
+    a digest of everything a run applies, the checkpoints of a run are kept under it
+    :param grantDict: {cluster: {userAtHost: grantList}}
+    """
+    normalized = [sorted([cluster, hashClusterInputs(dict((x, hashUserInputs(grantDict[cluster][x]))
+                                                          for x in grantDict[cluster].keys()), destructive)]
+                         for cluster in grantDict.keys()),
+                  bool(passwordReset)]
+    return hashlib.sha1(json.dumps(normalized)).hexdigest()
+
+
+def hashUserGrants(userGrants, passwordHash):
+    """a digest of the grants a user has on the server
+       :param userGrants: {'*.*': set(['SELECT'])}
+    """
+    normalized = [passwordHash is not None,
+                  sorted([x, sorted(userGrants[x])] for x in userGrants.keys())]
+    return hashlib.sha1(json.dumps(normalized)).hexdigest()
+
+
+class GrantStateStore(object):
+
+    def __init__(self, stateFile=DEFAULT_STATE_FILE):
+        """
+        opens or creates the sqlite stateFile
+        NOTE: the store is shared by the cluster workers so every access takes _lock
+        """
+        self._stateFile = stateFile
+        self._lock = threading.Lock()
+        stateDir = os.path.dirname(stateFile)
+        if 0 < len(stateDir) and not os.path.exists(stateDir):
+            os.makedirs(stateDir)
+        self._connection = sqlite3.connect(stateFile, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS cluster_state ("
+                                     "cluster TEXT PRIMARY KEY, input_hash TEXT, "
+                                     "fingerprint TEXT, applied TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS user_state ("
+                                     "cluster TEXT, user_at_host TEXT, input_hash TEXT, "
+                                     "grant_hash TEXT, PRIMARY KEY (cluster, user_at_host))")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS run_checkpoint ("
+                                     "run_hash TEXT, cluster TEXT, user_at_host TEXT, "
+                                     "PRIMARY KEY (run_hash, cluster, user_at_host))")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def getClusterState(self, cluster):
+        """returns (inputHash, fingerprint) last applied to the cluster or None"""
+        with self._lock:
+            row = self._connection.execute("SELECT input_hash, fingerprint FROM cluster_state "
+                                           "WHERE cluster = ?", (cluster,)).fetchone()
+        if row is not None:
+            row = tuple(row)
+        return row
+
+    def getUserStates(self, cluster):
+        """returns {userAtHost: (inputHash, grantHash)} last applied to the cluster"""
+        with self._lock:
+            rows = self._connection.execute("SELECT user_at_host, input_hash, grant_hash FROM user_state "
+                                            "WHERE cluster = ?", (cluster,)).fetchall()
+        return dict((row[0], (row[1], row[2])) for row in rows)
+
+    def getChangedUsers(self, cluster, snapshot, userInputHashDict, clusterInputHash):
+        """
+        returns the users whose inputs or server grants differ from the last applied state
+        :param snapshot: a mysql_query_tool.GrantSnapshot of the cluster
+        """
+        if self.getClusterState(cluster) == (clusterInputHash, snapshot.getFingerprint()):
+            return []
+        userStateDict = self.getUserStates(cluster)
+        changedUsers = []
+        for userAtHost in userInputHashDict.keys():
+            grantHash = hashUserGrants(snapshot.getUserGrants(userAtHost),
+                                       snapshot.getPasswordHash(userAtHost))
+            if userStateDict.get(userAtHost) != (userInputHashDict[userAtHost], grantHash):
+                changedUsers.append(userAtHost)
+        return changedUsers
+
+    def saveClusterState(self, cluster, snapshot, userInputHashDict, clusterInputHash):
+        """replaces the state of the cluster with the snapshot taken after applying it"""
+        userRows = []
+        for userAtHost in userInputHashDict.keys():
+            grantHash = hashUserGrants(snapshot.getUserGrants(userAtHost),
+                                       snapshot.getPasswordHash(userAtHost))
+            userRows.append((cluster, userAtHost, userInputHashDict[userAtHost], grantHash))
+        applied = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM user_state WHERE cluster = ?", (cluster,))
+                self._connection.executemany("INSERT INTO user_state VALUES (?, ?, ?, ?)", userRows)
+                self._connection.execute("INSERT OR REPLACE INTO cluster_state VALUES (?, ?, ?, ?)",
+                                         (cluster, clusterInputHash, snapshot.getFingerprint(), applied))
+        logger.debug("saved state of %d users on %s", len(userRows), cluster)
+
+    def getCheckpoints(self, runHash):
+        """returns {cluster: set(userAtHost)} of what the run has applied, CLUSTER_DONE marks a finished cluster"""
+        with self._lock:
+            rows = self._connection.execute("SELECT cluster, user_at_host FROM run_checkpoint "
+                                            "WHERE run_hash = ?", (runHash,)).fetchall()
+        checkpointDict = {}
+        for cluster, userAtHost in rows:
+            checkpointDict.setdefault(cluster, set()).add(userAtHost)
+        return checkpointDict
+
+    def saveCheckpoints(self, runHash, cluster, users):
+        with self._lock:
+            with self._connection:
+                self._connection.executemany("INSERT OR IGNORE INTO run_checkpoint VALUES (?, ?, ?)",
+                                             [(runHash, cluster, x) for x in users])
+
+    def clearCheckpoints(self):
+        """forgets the checkpoints of every run"""
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM run_checkpoint")
+
+
+class RunCheckpoint(object):
+
+    def __init__(self, stateStore, runHash, resume):
+        """
+        the clusters and users a run finished, saved under runHash in stateStore
+        with resume the checkpoints of an earlier run with the same inputs are skipped
+        NOTE: the cluster workers share it so every access takes _lock
+        """
+        self._stateStore = stateStore
+        self._runHash = runHash
+        self._lock = threading.Lock()
+        self._checkpointDict = {}
+        if resume:
+            self._checkpointDict = stateStore.getCheckpoints(runHash)
+            if 0 < len(self._checkpointDict):
+                logger.info("resuming run %s from the checkpoints of %d clusters", runHash,
+                            len(self._checkpointDict))
+            else:
+                logger.warning("no checkpoints of run %s to resume from, its inputs may have changed", runHash)
+
+    def getRunHash(self):
+        return self._runHash
+
+    def startOver(self):
+        """a run that is not resumed drops every checkpoint so only the latest run can be resumed"""
+        self._stateStore.clearCheckpoints()
+        with self._lock:
+            self._checkpointDict = {}
+
+    def isClusterDone(self, cluster):
+        with self._lock:
+            return CLUSTER_DONE in self._checkpointDict.get(cluster, ())
+
+    def getDoneUsers(self, cluster):
+        with self._lock:
+            return self._checkpointDict.get(cluster, set()) - set([CLUSTER_DONE])
+
+    def saveUsers(self, cluster, users):
+        """checkpoints users once every statement queued for them was sent"""
+        if 0 < len(users):
+            self._stateStore.saveCheckpoints(self._runHash, cluster, users)
+            with self._lock:
+                self._checkpointDict.setdefault(cluster, set()).update(users)
+
+    def saveCluster(self, cluster):
+        self.saveUsers(cluster, [CLUSTER_DONE])
@@ -73,6 +73,26 @@ class TestLdapGrantMapper(unittest.TestCase):
         hosts = self.autoGrantConfig.getHostsForGroup('group2')
         self.assertItemsEqual(['%'], hosts)
 
+    def test_getGroupsForCluster(self):
+        """tests the getGroupsForCluster function uses the index built at load
+        """
+        self.assertItemsEqual(['group1', 'group2'], self.autoGrantConfig.getGroupsForCluster('cluster1'))
+        self.assertItemsEqual(['group2'], self.autoGrantConfig.getGroupsForCluster('cluster2'))
+        self.assertItemsEqual([], self.autoGrantConfig.getGroupsForCluster('cluster3'))
+        self.yamlDict['group_to_grants_map']['cluster3'] = {'group3': {'%': {'*.*': ["SELECT"]}}}
+        self.autoGrantConfig.overrideYamlDictForTests(self.yamlDict)
+        self.assertItemsEqual(['group3'], self.autoGrantConfig.getGroupsForCluster('cluster3'))
+        self.assertItemsEqual(['%'], self.autoGrantConfig.getHostsForGroup('group3'))
+
+    def test_getGrantListIsACopy(self):
+        """tests the grant dicts returned can be changed without touching the index
+        """
+        grantList = self.autoGrantConfig.getGrantList("'somebody'@'%'", "cluster1", "group2")
+        grantList[0]['privileges'] = ['SELECT', 'INSERT']
+        grantList = self.autoGrantConfig.getGrantList("'somebody'@'%'", "cluster1", "group2")
+        self.assertEquals([{'db_table': '*.*', 'privileges': ['SELECT']}], grantList)
+        self.assertEquals([], self.autoGrantConfig.getGrantList("'somebody'@'host3'", "cluster1", "group2"))
+
     def test_getGrantList(self):
         """tests the getGrant function returns a valid list of GRANT strings
         """
@@ -123,6 +143,21 @@ class TestLdapGrantMapper(unittest.TestCase):
         self.assertEquals(self.productManagersList,
                           customGroups['product_managers'])
 
+    def test_getMysqlUserFiltered(self):
+        """tests the getMysqlUserFiltered function matches whole users only
+        """
+        self.assertFalse(self.autoGrantConfig.getMysqlUserFiltered("root@localhost"))
+        self.yamlDict['mysql_user_filter'] = ['debian-sys-maint@localhost', 'root@.*', 'repl|replica@%']
+        self.autoGrantConfig.overrideYamlDictForTests(self.yamlDict)
+        self.assertTrue(self.autoGrantConfig.getMysqlUserFiltered("debian-sys-maint@localhost"))
+        self.assertFalse(self.autoGrantConfig.getMysqlUserFiltered("debian-sys-maint@localhost2"))
+        self.assertTrue(self.autoGrantConfig.getMysqlUserFiltered("root@localhost"))
+        self.assertTrue(self.autoGrantConfig.getMysqlUserFiltered("root@localhost"))
+        self.assertFalse(self.autoGrantConfig.getMysqlUserFiltered("notroot@localhost"))
+        self.assertTrue(self.autoGrantConfig.getMysqlUserFiltered("repl"))
+        self.assertTrue(self.autoGrantConfig.getMysqlUserFiltered("replica@%"))
+        self.assertFalse(self.autoGrantConfig.getMysqlUserFiltered("repl@%"))
+
     def test_getLdapURL(self):
         """tests the getLdapURL function returns a valid url
         """
@@ -133,5 +168,32 @@ class TestLdapGrantMapper(unittest.TestCase):
         self.assertTrue(0 < len(parsedUrl.netloc))
         self.assertEquals(self.ldapUrl, url)
 
+    def test_getLdapPageSize(self):
+        """tests the getLdapPageSize function defaults and can disable paging
+        """
+        self.assertEquals(auto_grant_config.DEFAULT_LDAP_PAGE_SIZE, self.autoGrantConfig.getLdapPageSize())
+        self.yamlDict['ldap_page_size'] = 0
+        self.autoGrantConfig.overrideYamlDictForTests(self.yamlDict)
+        self.assertEquals(0, self.autoGrantConfig.getLdapPageSize())
+
+    def test_getLdapCacheTtl(self):
+        """tests the getLdapCacheTtl function defaults when missing or not numeric
+        """
+        self.assertEquals(auto_grant_config.DEFAULT_LDAP_CACHE_TTL, self.autoGrantConfig.getLdapCacheTtl())
+        self.yamlDict['ldap_cache_ttl'] = "soon"
+        self.autoGrantConfig.overrideYamlDictForTests(self.yamlDict)
+        self.assertEquals(auto_grant_config.DEFAULT_LDAP_CACHE_TTL, self.autoGrantConfig.getLdapCacheTtl())
+        self.yamlDict['ldap_cache_ttl'] = 600
+        self.autoGrantConfig.overrideYamlDictForTests(self.yamlDict)
+        self.assertEquals(600, self.autoGrantConfig.getLdapCacheTtl())
+
+    def test_getLdapGidOrdering(self):
+        """tests the getLdapGidOrdering function is opt in
+        """
+        self.assertFalse(self.autoGrantConfig.getLdapGidOrdering())
+        self.yamlDict['ldap_gid_ordering'] = True
+        self.autoGrantConfig.overrideYamlDictForTests(self.yamlDict)
+        self.assertTrue(self.autoGrantConfig.getLdapGidOrdering())
+
 if __name__ == '__main__':
     unittest.main()
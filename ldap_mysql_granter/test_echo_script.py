@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_echo_script are the tests associated with the echo_script
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+from StringIO import StringIO
+import echo_script
+import logging
+import os
+import shutil
+import stat
+import unittest
+logging.basicConfig(level=logging.CRITICAL)
+logger = logging.getLogger(__name__)
+
+
+class TestEchoScript(unittest.TestCase):
+    def setUp(self):
+        self._scriptPath = "./testEchoScript"
+        self._echoScript = echo_script.EchoScript()
+        self._echoScript.addPreamble("cluster2", "mysqldump --host=cluster2 mysql user > c2.sql")
+        self._echoScript.addPreamble("cluster1", "mysqldump --host=cluster1 mysql user > c1.sql")
+        self._echoScript.addStatement("cluster1", "mysql -h cluster1 -u grant_bot",
+                                      echo_script.toSqlStatement("GRANT SELECT ON *.* TO %s@%s", ("user", "%")))
+        self._echoScript.addStatement("cluster1", "mysql -h cluster1 -u grant_bot",
+                                      echo_script.toSqlStatement("FLUSH PRIVILEGES", None))
+
+    def tearDown(self):
+        if os.path.exists(self._scriptPath):
+            shutil.rmtree(self._scriptPath)
+
+    def test_toSqlStatement(self):
+        self.assertEquals("CREATE USER 'o\\'brien'@'%' IDENTIFIED BY 'a\\\\b';",
+                          echo_script.toSqlStatement("CREATE USER %s@%s IDENTIFIED BY %s", ("o'brien", "%", "a\\b")))
+        self.assertEquals("FLUSH PRIVILEGES;", echo_script.toSqlStatement("FLUSH PRIVILEGES;", None))
+
+    def test_write(self):
+        out = StringIO()
+        self._echoScript.write(out)
+        # every dump runs before the first statement and a cluster without statements gets no session
+        self.assertEquals("set -e\n" +
+                          "mysqldump --host=cluster1 mysql user > c1.sql\n" +
+                          "mysqldump --host=cluster2 mysql user > c2.sql\n" +
+                          "mysql -h cluster1 -u grant_bot <<'EOF_SQL'\n" +
+                          "-- cluster: cluster1\n" +
+                          "GRANT SELECT ON *.* TO 'user'@'%';\n" +
+                          "FLUSH PRIVILEGES;\n" +
+                          "EOF_SQL\n", out.getvalue())
+
+    def test_writeDir(self):
+        self._echoScript.writeDir(self._scriptPath)
+        self.assertEquals(["cluster1.sql", "preamble.sh"], sorted(os.listdir(self._scriptPath)))
+        sqlFile = os.path.join(self._scriptPath, "cluster1.sql")
+        self.assertEquals(0600, stat.S_IMODE(os.stat(sqlFile).st_mode))
+        with open(sqlFile) as f:
+            self.assertEquals(self._echoScript.getSql("cluster1"), f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
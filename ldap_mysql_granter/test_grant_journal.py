@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_grant_journal are the tests associated with the grant_journal
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import grant_journal
+import logging
+import os
+import shutil
+import stat
+import unittest
+logging.basicConfig(level=logging.CRITICAL)
+logger = logging.getLogger(__name__)
+
+
+class TestGrantJournal(unittest.TestCase):
+    def setUp(self):
+        self._journalPath = "./testGrantJournal"
+        self._journalFile = os.path.join(self._journalPath, "20150101-000000", "cluster", grant_journal.JOURNAL_FILE)
+        self._journal = grant_journal.GrantJournal(self._journalFile)
+
+    def tearDown(self):
+        self._journal.close()
+        if os.path.exists(self._journalPath):
+            shutil.rmtree(self._journalPath)
+
+    def test_appendAndRead(self):
+        self.assertEquals(None, grant_journal.readJournal(self._journalFile))
+        self._journal.close()
+        # nothing appended leaves no journal
+        self.assertFalse(os.path.exists(self._journalFile))
+        self._journal.append(["reader@%"], 2, "GRANT SELECT ON aDB.* TO %s@%s", ("reader", "%"),
+                             [(3, "REVOKE SELECT ON aDB.* FROM %s@%s", ("reader", "%"))])
+        self._journal.sync()
+        # it holds password hashes
+        self.assertEquals(0600, stat.S_IMODE(os.stat(self._journalFile).st_mode))
+        entryList = grant_journal.readJournal(self._journalFile)
+        self.assertEquals([{'users': ["reader@%"], 'statement': [2, "GRANT SELECT ON aDB.* TO %s@%s", ["reader", "%"]],
+                            'inverse': [[3, "REVOKE SELECT ON aDB.* FROM %s@%s", ["reader", "%"]]],
+                            'group': [entryList[0]['group'][0], None, 0], 'sent': False}],
+                          entryList)
+
+    def test_sentGroups(self):
+        writer1 = self._journal.addWriter()
+        writer2 = self._journal.addWriter()
+        self._journal.append(["a@%"], 2, "GRANT", ("a", "%"), [], writer1)
+        self._journal.sync(writer1)
+        self._journal.append(["b@%"], 2, "GRANT", ("b", "%"), [], writer2)
+        self._journal.sync(writer2)
+        self._journal.sent(writer1)
+        self._journal.append(["c@%"], 2, "GRANT", ("c", "%"), [], writer1)
+        self._journal.sync(writer1)
+        self._journal.close()
+        # only the groups acknowledged as sent are known to have run
+        self.assertEquals([True, False, False], [x['sent'] for x in grant_journal.readJournal(self._journalFile)])
+
+    def test_sentGroupsRetried(self):
+        self._journal.append(["a@%"], 2, "GRANT", ("a", "%"), [], self._journal.addWriter())
+        self._journal.sync(1)
+        self._journal.close()
+        # a retry appends to the same file with writer and group ids starting over
+        retryJournal = grant_journal.GrantJournal(self._journalFile)
+        writer = retryJournal.addWriter()
+        self.assertEquals(1, writer)
+        retryJournal.append(["a@%"], 2, "GRANT", ("a", "%"), [], writer)
+        retryJournal.sync(writer)
+        retryJournal.sent(writer)
+        retryJournal.close()
+        # the retry's sent marker does not cover the first attempt's failed group
+        self.assertEquals([False, True], [x['sent'] for x in grant_journal.readJournal(self._journalFile)])
+
+    def test_tornLastEntry(self):
+        self._journal.append(["reader@%"], 2, "CREATE USER %s@%s", ("reader", "%"), [(3, "DROP USER %s@%s", ("reader", "%"))])
+        self._journal.close()
+        with open(self._journalFile, 'a') as f:
+            f.write('{"users": ["wri')
+        self.assertEquals(1, len(grant_journal.readJournal(self._journalFile)))
+        with open(self._journalFile, 'a') as f:
+            f.write('\n{"users": []}\n')
+        self.assertRaises(grant_journal.GrantJournalException, grant_journal.readJournal, self._journalFile)
+
+    def test_getInverseList(self):
+        entryList = [{'users': ["reader@%"], 'statement': [2, "GRANT", None], 'inverse': [[3, "REVOKE", ["reader", "%"]]]},
+                     {'users': ["writer@%"], 'statement': [2, "SET PASSWORD", None], 'inverse': None},
+                     {'users': ["writer@%"], 'statement': [2, "CREATE USER", None], 'inverse': [[3, "DROP", ["writer", "%"]]]}]
+        self.assertEquals([(3, "DROP", ("writer", "%")), (3, "REVOKE", ("reader", "%"))],
+                          grant_journal.getInverseList(entryList))
+        self.assertEquals([(3, "REVOKE", ("reader", "%"))], grant_journal.getInverseList(entryList, ["reader"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
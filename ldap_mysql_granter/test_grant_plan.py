@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_grant_plan are the tests associated with the grant_plan
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import grant_plan
+import json
+import logging
+import os
+import shutil
+import stat
+import unittest
+logging.basicConfig(level=logging.CRITICAL)
+logger = logging.getLogger(__name__)
+
+
+class TestGrantPlan(unittest.TestCase):
+    def setUp(self):
+        self._planPath = "./testGrantPlan"
+        self._planFile = os.path.join(self._planPath, "plan.json")
+        self._grantPlan = grant_plan.GrantPlan({'accessLevel': 2, 'destructive': False})
+        self._grantPlan.setFingerprint("cluster1", "abc123")
+        self._grantPlan.addStatement("cluster1", 2, "CREATE USER %s@%s IDENTIFIED BY %s", ("user", "%", "aRandPass"),
+                                     grant_plan.STEP_CREATE_USER)
+        self._grantPlan.addStatement("cluster1", 2, "GRANT SELECT ON *.* TO %s@%s", ("user", "%"))
+        self._grantPlan.setFingerprint("cluster2", "def456")
+        self._grantPlan.setDefaultCluster("cluster1")
+        self._grantPlan.setNewUsers({"user@%": {'clusters': ["cluster1"],
+                                                'password': "aRandPass",
+                                                'template': "invite"}})
+
+    def tearDown(self):
+        if os.path.exists(self._planPath):
+            shutil.rmtree(self._planPath)
+
+    def test_statements(self):
+        self.assertEquals(["cluster1", "cluster2"], self._grantPlan.getClusters())
+        self.assertEquals(2, self._grantPlan.getStatementCount())
+        self.assertEquals([(2, "CREATE USER %s@%s IDENTIFIED BY %s", ("user", "%", "aRandPass")),
+                           (2, "GRANT SELECT ON *.* TO %s@%s", ("user", "%"))],
+                          self._grantPlan.getStatements("cluster1"))
+        self.assertEquals([], self._grantPlan.getStatements("cluster2"))
+        self.assertEquals([grant_plan.STEP_CREATE_USER, grant_plan.STEP_QUERY],
+                          [x[0] for x in self._grantPlan.getSteps("cluster1")])
+
+    def test_saveAndLoad(self):
+        self._grantPlan.save(self._planFile)
+        # the plan holds new passwords so only the owner may read it
+        self.assertEquals(0600, stat.S_IMODE(os.stat(self._planFile).st_mode))
+        loadedPlan = grant_plan.GrantPlan.load(self._planFile)
+        self.assertEquals(self._grantPlan.getCreated(), loadedPlan.getCreated())
+        self.assertEquals(2, loadedPlan.getOption('accessLevel'))
+        self.assertEquals("abc123", loadedPlan.getFingerprint("cluster1"))
+        self.assertEquals("def456", loadedPlan.getFingerprint("cluster2"))
+        self.assertEquals("cluster1", loadedPlan.getDefaultCluster())
+        self.assertEquals(self._grantPlan.getSteps("cluster1"), loadedPlan.getSteps("cluster1"))
+        self.assertDictEqual(self._grantPlan.getNewUsers(), loadedPlan.getNewUsers())
+        self.assertEquals(self._grantPlan.getRunHash(), loadedPlan.getRunHash())
+
+    def test_runHash(self):
+        contentHash = self._grantPlan.getRunHash()
+        self._grantPlan.clearStatements("cluster1")
+        self.assertNotEquals(contentHash, self._grantPlan.getRunHash())
+        self._grantPlan.setRunHash("abc")
+        self._grantPlan.save(self._planFile)
+        self.assertEquals("abc", grant_plan.GrantPlan.load(self._planFile).getRunHash())
+        self._grantPlan.removeCluster("cluster2")
+        self.assertEquals(["cluster1"], self._grantPlan.getClusters())
+
+    def test_loadWrongVersion(self):
+        os.makedirs(self._planPath)
+        planDict = self._grantPlan.toDict()
+        planDict['version'] = grant_plan.PLAN_VERSION + 1
+        with open(self._planFile, 'w') as f:
+            json.dump(planDict, f)
+        with self.assertRaises(grant_plan.PlanException):
+            grant_plan.GrantPlan.load(self._planFile)
+
+    def test_loadMissing(self):
+        with self.assertRaises(grant_plan.PlanException):
+            grant_plan.GrantPlan.load(self._planFile)
+
+
+if __name__ == '__main__':
+    unittest.main()
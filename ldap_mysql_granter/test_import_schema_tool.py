@@ -15,6 +15,8 @@ from StringIO import StringIO
 import logging
 import mock
 import sys
+import threading
+import time
 import import_schema_tool
 import import_schema_config
 import unittest
@@ -55,6 +57,7 @@ class TestImportSchema(unittest.TestCase):
         self._unmockedMysqlQueryToolQueryUserGrants = import_schema_tool.mysql_query_tool.MysqlQueryTool.queryUserGrants
         self._unmockedMysqlQueryToolGetPasswordHash = import_schema_tool.mysql_query_tool.MysqlQueryTool.getPasswordHash
         self._unmockedMysqlQueryToolGetCursor = import_schema_tool.mysql_query_tool.MysqlQueryTool.getCursor
+        self._unmockedMysqlQueryToolGetVersion = import_schema_tool.mysql_query_tool.MysqlQueryTool.getVersion
 
         # Mock SchemaImportTool out
         self.mockedSchemaImportTool.importUsers = mock.MagicMock(return_value=None)
@@ -65,16 +68,16 @@ class TestImportSchema(unittest.TestCase):
         import_schema_tool.mysql_query_tool.MysqlQueryTool.getPasswordHash = mock.MagicMock(return_value="passhash")
         import_schema_tool.mysql_query_tool.MysqlQueryTool.userGrants = mock.MagicMock(return_value={'aDB': ["SELECT"]})
         import_schema_tool.mysql_query_tool.MysqlQueryTool.getCursor = mock.MagicMock(return_value=test_mysql_query_tool.FakeMysqlCursor())
+        import_schema_tool.mysql_query_tool.MysqlQueryTool.getVersion = mock.MagicMock(return_value=5.5)
 
     def tearDown(self):
-        # Restore SchemaImportTool from unmocked
-        import_schema_tool.SchemaImportTool.importUsers = self._unmockedSchemaImportToolImportUsers
-        import_schema_tool.SchemaImportTool.importSchema = self._unmockedSchemaImportToolImportSchema
+        # SchemaImportTool is only mocked on the instance so the class is left untouched
         # Restore MySQLQueryTool from unmocked
         import_schema_tool.mysql_query_tool.MysqlQueryTool.userExists = self._unmockedMysqlQueryToolUserExists
         import_schema_tool.mysql_query_tool.MysqlQueryTool.queryUserGrants = self._unmockedMysqlQueryToolQueryUserGrants
         import_schema_tool.mysql_query_tool.MysqlQueryTool.getPasswordHash = self._unmockedMysqlQueryToolGetPasswordHash
         import_schema_tool.mysql_query_tool.MysqlQueryTool.getCursor = self._unmockedMysqlQueryToolGetCursor
+        import_schema_tool.mysql_query_tool.MysqlQueryTool.getVersion = self._unmockedMysqlQueryToolGetVersion
 
     # @unittest.skip("wip")
     @mock.patch.object(import_schema_tool.mysql_query_tool.MySQLdb, "connect")
@@ -135,6 +138,132 @@ class TestImportSchema(unittest.TestCase):
         # remock
         self.mockedSchemaImportTool.importSchema = mock.MagicMock(return_value=None)
 
+    @mock.patch.object(import_schema_tool.mysql_backup_tool.MysqlBackupTool, "getCurrentTimeBackup")
+    @mock.patch.object(import_schema_tool.mysql_query_tool.MySQLdb, "connect")
+    def test_importSchemaStream(self, mysqlConnMock, getCurrentTimeBackupMock):
+        getCurrentTimeBackupMock.return_value = "20150904-150131"
+        mysqlConnMock.return_value = test_mysql_query_tool.FakeMysqlConnection()
+        yamlConf = {'mysql_schemas': [{'host1': [{'bDB': 'dDB'}, {'aDB.aTable': 'eDB'}]}]}
+        importSchemaConfig = import_schema_config.ImportSchemaConfig()
+        importSchemaConfig.overrideYamlDictForTests(yamlConf)
+        schemaImportTool = import_schema_tool.SchemaImportTool(self.echoOnly, self.logPasswords, self.backupPath,
+                                                               self.username, self.password, True, "gzip")
+        schemaImportTool.remoteMysqlUser = "remoteMysqlUser"
+        schemaImportTool.remoteMysqlPass = "remoteMysqlPass"
+        with captured_output() as (out, err):
+            schemaImportTool.importSchema(importSchemaConfig)
+            outLines = out.getvalue().strip().splitlines()
+        self.assertEquals([
+            "mysql -h localhost -u localUsername -plocalPassword mysql -e \"CREATE DATABASE IF NOT EXISTS dDB\"",
+            "mysqldump --single-transaction --no-data --host=host1 --user=remoteMysqlUser --password=remoteMysqlPass bDB | tee >(gzip > backuppath/20150904-150131/host1/bDB.sql.gz) | mysql --host=localhost --user=localUsername --password=localPassword dDB",
+            "mysql -h localhost -u localUsername -plocalPassword mysql -e \"CREATE DATABASE IF NOT EXISTS eDB\"",
+            "mysqldump --single-transaction --no-data --host=host1 --user=remoteMysqlUser --password=remoteMysqlPass aDB.aTable | tee >(gzip > backuppath/20150904-150131/host1/aDB.aTable.sql.gz) | mysql --host=localhost --user=localUsername --password=localPassword eDB",
+        ], outLines)
+
+    @mock.patch.object(import_schema_tool.mysql_backup_tool.MysqlBackupTool, "getCurrentTimeBackup")
+    @mock.patch.object(import_schema_tool.mysql_query_tool.MySQLdb, "connect")
+    def test_importSchemaArchive(self, mysqlConnMock, getCurrentTimeBackupMock):
+        getCurrentTimeBackupMock.return_value = "20150904-150131"
+        mysqlConnMock.return_value = test_mysql_query_tool.FakeMysqlConnection()
+        yamlConf = {'mysql_schemas': [{'host1': [{'bDB': 'dDB'}]}]}
+        importSchemaConfig = import_schema_config.ImportSchemaConfig()
+        importSchemaConfig.overrideYamlDictForTests(yamlConf)
+        schemaImportTool = import_schema_tool.SchemaImportTool(self.echoOnly, self.logPasswords, self.backupPath,
+                                                               self.username, self.password, False, "gzip")
+        schemaImportTool.remoteMysqlUser = "remoteMysqlUser"
+        schemaImportTool.remoteMysqlPass = "remoteMysqlPass"
+        with captured_output() as (out, err):
+            schemaImportTool.importSchema(importSchemaConfig)
+            outLines = out.getvalue().strip().splitlines()
+        # without --stream the dump file itself is compressed
+        self.assertEquals([
+            "mysql -h localhost -u localUsername -plocalPassword mysql -e \"CREATE DATABASE IF NOT EXISTS dDB\"",
+            "mysqldump --single-transaction --no-data --host=host1 --user=remoteMysqlUser --password=remoteMysqlPass bDB | gzip > backuppath/20150904-150131/host1/bDB.sql.gz",
+            "gunzip -c backuppath/20150904-150131/host1/bDB.sql.gz | mysql --host=localhost --user=localUsername --password=localPassword dDB",
+        ], outLines)
+
+    def test_getImportLanes(self):
+        mysqlSchemas = [{'dbhost1': [{'bdb': 'bdb'}, {'adb': 'adb'}]},
+                        {'dbhost2': [{'bdb': 'bdb'}]},
+                        {'dbhost2': [{'adb': 'bdb'}]}]
+        # entries loading the same database keep their config order
+        self.assertEquals([[('dbhost1', 'bdb', 'bdb'), ('dbhost2', 'bdb', 'bdb'), ('dbhost2', 'adb', 'bdb')],
+                           [('dbhost1', 'adb', 'adb')]],
+                          import_schema_tool.getImportLanes(mysqlSchemas))
+        # entries dumping the same source to the same file share a lane too
+        mysqlSchemas = [{'dbhost1': [{'adb': 'adb'}, {'bdb': 'bdb'}, {'adb': 'cdb'}]},
+                        {'dbhost2': [{'adb': 'bdb'}]}]
+        self.assertEquals([[('dbhost1', 'adb', 'adb'), ('dbhost1', 'adb', 'cdb')],
+                           [('dbhost1', 'bdb', 'bdb'), ('dbhost2', 'adb', 'bdb')]],
+                          import_schema_tool.getImportLanes(mysqlSchemas))
+        # an entry joining two lanes merges them in config order
+        mysqlSchemas = [{'dbhost1': [{'adb': 'adb'}, {'bdb': 'bdb'}, {'adb': 'bdb'}]}]
+        self.assertEquals([[('dbhost1', 'adb', 'adb'), ('dbhost1', 'bdb', 'bdb'), ('dbhost1', 'adb', 'bdb')]],
+                          import_schema_tool.getImportLanes(mysqlSchemas))
+
+    @mock.patch.object(import_schema_tool.mysql_backup_tool.MysqlBackupTool, "getCurrentTimeBackup")
+    def test_importSchemaParallel(self, getCurrentTimeBackupMock):
+        getCurrentTimeBackupMock.return_value = "20150904-150131"
+        yamlConf = {'mysql_schemas': [{'host1': [{'aDB': 'aDB'}, {'bDB': 'bDB'}, {'cDB': 'cDB'}]},
+                                      {'host2': [{'dDB': 'dDB'}, {'eDB': 'aDB'}, {'fDB': 'fDB'}]},
+                                      {'host2': [{'gDB': 'fDB'}]}]}
+        importSchemaConfig = import_schema_config.ImportSchemaConfig()
+        importSchemaConfig.overrideYamlDictForTests(yamlConf)
+        schemaImportTool = import_schema_tool.SchemaImportTool(False, self.logPasswords, self.backupPath,
+                                                               self.username, self.password, workers=4,
+                                                               hostConcurrency=1)
+        schemaImportTool.makeLocalMysql = mock.MagicMock()
+        lock = threading.Lock()
+        runningDict = {'host1': 0, 'host2': 0, 'all': 0}
+        maxDict = dict(runningDict)
+        finished = []
+
+        def fakeImportEntry(localMysql, backupName, cluster, dbTableSrc, dbTableDst):
+            with lock:
+                for key in [cluster, 'all']:
+                    runningDict[key] += 1
+                    maxDict[key] = max(maxDict[key], runningDict[key])
+            time.sleep(0.01)
+            with lock:
+                for key in [cluster, 'all']:
+                    runningDict[key] -= 1
+                finished.append(dbTableSrc)
+            if dbTableSrc == "fDB":
+                raise Exception("denied")
+        schemaImportTool.importEntry = fakeImportEntry
+        with self.assertRaises(import_schema_tool.SchemaImportException):
+            schemaImportTool.importSchema(importSchemaConfig)
+        self.assertEquals(1, maxDict['host1'])
+        self.assertEquals(1, maxDict['host2'])
+        self.assertEquals(2, maxDict['all'])
+        # aDB is loaded from host1 before host2 and gDB is skipped once fDB failed
+        self.assertTrue(finished.index("aDB") < finished.index("eDB"))
+        self.assertEquals(sorted(["aDB", "bDB", "cDB", "dDB", "eDB", "fDB"]), sorted(finished))
+
+    @mock.patch.object(import_schema_tool.mysql_backup_tool.MysqlBackupTool, "getCurrentTimeBackup")
+    def test_importSchemaFreeHost(self, getCurrentTimeBackupMock):
+        getCurrentTimeBackupMock.return_value = "20150904-150131"
+        yamlConf = {'mysql_schemas': [{'host1': [{'aDB': 'aDB'}, {'bDB': 'bDB'}, {'cDB': 'cDB'}]},
+                                      {'host2': [{'dDB': 'dDB'}]}]}
+        importSchemaConfig = import_schema_config.ImportSchemaConfig()
+        importSchemaConfig.overrideYamlDictForTests(yamlConf)
+        schemaImportTool = import_schema_tool.SchemaImportTool(False, self.logPasswords, self.backupPath,
+                                                               self.username, self.password, workers=2,
+                                                               hostConcurrency=1)
+        schemaImportTool.makeLocalMysql = mock.MagicMock()
+        lock = threading.Lock()
+        started = []
+
+        def fakeImportEntry(localMysql, backupName, cluster, dbTableSrc, dbTableDst):
+            with lock:
+                started.append(dbTableSrc)
+            time.sleep(0.05)
+        schemaImportTool.importEntry = fakeImportEntry
+        schemaImportTool.importSchema(importSchemaConfig)
+        # the second worker skips the busy host1 lanes instead of waiting on them
+        self.assertEquals(["aDB", "dDB"], started[:2])
+        self.assertEquals(sorted(["aDB", "bDB", "cDB", "dDB"]), sorted(started))
+
     @mock.patch.object(import_schema_config.ImportSchemaConfig, "__new__", create=False)
     def test_start(self, schemaConfig):
         yamlConfFile = None
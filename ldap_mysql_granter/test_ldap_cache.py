@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_ldap_cache are the tests associated with the ldap_cache
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+#  This script requires the following packages to be installed:
+#   mock==1.0.1
+
+import ldap_cache
+import logging
+import mock
+import os
+import shutil
+import stat
+import unittest
+logging.basicConfig(level=logging.CRITICAL)
+logger = logging.getLogger(__name__)
+
+
+class FakeLdapQueryTool(object):
+    """serves groupDict the way ldap_query_tool.LdapQueryTool would"""
+
+    def __init__(self, groupDict):
+        self.groupDict = groupDict
+        self.iterGroupsCalls = []
+        self.queryEntryCalls = []
+
+    def iterGroups(self, base, minGid=None, groupList=None, userList=None, gidOrdering=False,
+                   pageSize=None, attrList=None):
+        self.iterGroupsCalls.append(attrList)
+        for dn in sorted(self.groupDict.keys()):
+            yield dn, dict((x, self.groupDict[dn][x]) for x in attrList if x in self.groupDict[dn])
+
+    def queryEntry(self, dn, attrList=None):
+        self.queryEntryCalls.append(dn)
+        if dn not in self.groupDict:
+            return None
+        return dict((x, self.groupDict[dn][x]) for x in attrList if x in self.groupDict[dn])
+
+
+class TestLdapCache(unittest.TestCase):
+    def setUp(self):
+        self._cachePath = "./testLdapCache"
+        self._ldapCache = ldap_cache.LdapGroupCache("ldap://ldap.example.com", "ou=groups,dc=nodomain",
+                                                    60, self._cachePath)
+        self._groupDict = {}
+        for i in range(4):
+            self._groupDict["cn=group%d,ou=groups,dc=nodomain" % i] = {
+                'cn': ["group%d" % i],
+                'gidNumber': ["2000%d" % i],
+                'memberUid': ["user%d" % i],
+                'modifyTimestamp': ["20150101000000Z"]}
+        self._ldapQueryTool = FakeLdapQueryTool(self._groupDict)
+        self._connect = mock.MagicMock(return_value=self._ldapQueryTool)
+
+    def tearDown(self):
+        if os.path.exists(self._cachePath):
+            shutil.rmtree(self._cachePath)
+
+    def getGroupEntries(self, mode=ldap_cache.CACHE_MODE_USE):
+        return self._ldapCache.getGroupEntries(self._connect, 20000, False, 500, mode)
+
+    def test_fetchAndReuse(self):
+        self.assertDictEqual(self._groupDict, self.getGroupEntries())
+        self.assertEquals(1, self._connect.call_count)
+        # the cache holds member lists so only the owner may read it
+        self.assertEquals(0600, stat.S_IMODE(os.stat(self._ldapCache.getCacheFile()).st_mode))
+        # within the ttl ldap is not bound at all
+        self.assertDictEqual(self._groupDict, self.getGroupEntries())
+        self.assertEquals(1, self._connect.call_count)
+
+    def test_refreshChanged(self):
+        self.getGroupEntries()
+        self._groupDict["cn=group1,ou=groups,dc=nodomain"]['memberUid'] = ["user1", "user5"]
+        self._groupDict["cn=group1,ou=groups,dc=nodomain"]['modifyTimestamp'] = ["20150102000000Z"]
+        del self._groupDict["cn=group3,ou=groups,dc=nodomain"]
+        self._ldapQueryTool.iterGroupsCalls = []
+        groupEntries = self.getGroupEntries(ldap_cache.CACHE_MODE_REFRESH)
+        self.assertDictEqual(self._groupDict, groupEntries)
+        # one cheap listing of the change markers then only the changed group is fetched
+        self.assertEquals([ldap_cache.STAMP_ATTRIBUTES], self._ldapQueryTool.iterGroupsCalls)
+        self.assertEquals(["cn=group1,ou=groups,dc=nodomain"], self._ldapQueryTool.queryEntryCalls)
+
+    def test_refreshMostlyChanged(self):
+        self.getGroupEntries()
+        for dn in self._groupDict.keys():
+            self._groupDict[dn]['modifyTimestamp'] = ["20150102000000Z"]
+        self._ldapQueryTool.iterGroupsCalls = []
+        self.assertDictEqual(self._groupDict, self.getGroupEntries(ldap_cache.CACHE_MODE_REFRESH))
+        self.assertEquals([ldap_cache.STAMP_ATTRIBUTES, ldap_cache.CACHE_ATTRIBUTES],
+                          self._ldapQueryTool.iterGroupsCalls)
+        self.assertEquals([], self._ldapQueryTool.queryEntryCalls)
+
+    def test_refreshWithoutStamps(self):
+        for dn in self._groupDict.keys():
+            del self._groupDict[dn]['modifyTimestamp']
+        self.getGroupEntries()
+        self._ldapQueryTool.iterGroupsCalls = []
+        self.getGroupEntries(ldap_cache.CACHE_MODE_REFRESH)
+        self.assertEquals([ldap_cache.STAMP_ATTRIBUTES, ldap_cache.CACHE_ATTRIBUTES],
+                          self._ldapQueryTool.iterGroupsCalls)
+
+    def test_otherQueryRefetches(self):
+        self.getGroupEntries()
+        self._ldapQueryTool.iterGroupsCalls = []
+        self._ldapCache.getGroupEntries(self._connect, 30000, False, 500)
+        self.assertEquals([ldap_cache.CACHE_ATTRIBUTES], self._ldapQueryTool.iterGroupsCalls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,7 @@ test_ldap_query_tool are the tests associated with the ldap_query_tool
 
 from contextlib import contextmanager
 from StringIO import StringIO
+import json
 import ldap_query_tool
 import logging
 import mock
@@ -70,6 +71,70 @@ class TestLdapQueryTool(unittest.TestCase):
         ldapQueryDict = ldapQueryTool.queryLDAP(fakeBase, fakeFilter)
         self.assertDictEqual(expectedLdapDict, ldapQueryDict)
 
+    def test_queryGroups(self):
+        fakeConnection = FakeLdapConnection()
+        fakeConnection.search_st = mock.MagicMock(return_value=[])
+        ldap_query_tool.ldap.initialize = mock.MagicMock(
+            return_value=fakeConnection)
+        ldapQueryTool = ldap_query_tool.LdapQueryTool("not_an_endpoint", "not_a_username", "not_a_password")
+        ldapQueryTool.queryGroups("not_a_base", 20000, None, ["user1"], True, None)
+        fakeConnection.search_st.assert_called_once_with(
+            "not_a_base", ldap_query_tool.ldap.SCOPE_SUBTREE,
+            "(&(objectClass=posixGroup)(gidNumber>=20000)(|(memberUid=user1)))",
+            attrlist=ldap_query_tool.GROUP_ATTRIBUTES, timeout=100)
+
+    def test_iterLDAPPaged(self):
+        fakeConnection = FakeLdapConnection()
+        pageList = [([('cn=group1,dc=example,dc=com', {'cn': ['group1']}),
+                      (None, ['ldap://referral.example.com/'])], "cookie1"),
+                     ([('cn=group2,dc=example,dc=com', {'cn': ['group2']})], "")]
+
+        def fakeResult3(msgId, timeout, resp_ctrl_classes):
+            resultData, cookie = pageList[msgId]
+            pageControl = mock.MagicMock()
+            pageControl.controlType = ldap_query_tool.SimplePagedResultsControl.controlType
+            pageControl.cookie = cookie
+            return (ldap_query_tool.ldap.RES_SEARCH_RESULT, resultData, msgId, [pageControl])
+        fakeConnection.search_ext = mock.MagicMock(side_effect=[0, 1])
+        fakeConnection.result3 = mock.MagicMock(side_effect=fakeResult3)
+        ldap_query_tool.ldap.initialize = mock.MagicMock(
+            return_value=fakeConnection)
+        ldapQueryTool = ldap_query_tool.LdapQueryTool("not_an_endpoint", "not_a_username", "not_a_password")
+        entries = ldapQueryTool.iterLDAP("not_a_base", "(cn=*)", ['cn'], 1)
+        # nothing is fetched until the entries are consumed
+        self.assertEquals(0, fakeConnection.search_ext.call_count)
+        self.assertEquals([('cn=group1,dc=example,dc=com', {'cn': ['group1']}),
+                           ('cn=group2,dc=example,dc=com', {'cn': ['group2']})],
+                          list(entries))
+        self.assertEquals(2, fakeConnection.search_ext.call_count)
+
+    def test_queryEntry(self):
+        fakeConnection = FakeLdapConnection()
+        fakeConnection.search_st = mock.MagicMock(return_value=[('cn=group1,dc=example,dc=com', {'cn': ['group1']})])
+        ldap_query_tool.ldap.initialize = mock.MagicMock(
+            return_value=fakeConnection)
+        ldapQueryTool = ldap_query_tool.LdapQueryTool("not_an_endpoint", "not_a_username", "not_a_password")
+        self.assertEquals({'cn': ['group1']}, ldapQueryTool.queryEntry('cn=group1,dc=example,dc=com', ['cn']))
+        fakeConnection.search_st.assert_called_once_with('cn=group1,dc=example,dc=com', ldap_query_tool.ldap.SCOPE_BASE,
+                                                         attrlist=['cn'], timeout=100)
+        fakeConnection.search_st = mock.MagicMock(side_effect=ldap_query_tool.ldap.NO_SUCH_OBJECT)
+        self.assertEquals(None, ldapQueryTool.queryEntry('cn=group2,dc=example,dc=com', ['cn']))
+
+    def test_makeGroupFilter(self):
+        self.assertEquals("(&(objectClass=posixGroup))",
+                          ldap_query_tool.makeGroupFilter())
+        # without an ordering rule the gid is left to the client
+        self.assertEquals("(&(objectClass=posixGroup))",
+                          ldap_query_tool.makeGroupFilter(20000))
+        self.assertEquals("(&(objectClass=posixGroup)(gidNumber>=20000))",
+                          ldap_query_tool.makeGroupFilter(20000, gidOrdering=True))
+        self.assertEquals("(&(objectClass=posixGroup)(|(cn=group1)(cn=group2)))",
+                          ldap_query_tool.makeGroupFilter(groupList=["group2", "group1"]))
+        self.assertEquals("(&(objectClass=posixGroup)(|(memberUid=a\\2a)(memberUid=sixteencharacter*)))",
+                          ldap_query_tool.makeGroupFilter(userList=["a*", "sixteencharacter"]))
+        self.assertEquals("(&(objectClass=posixGroup)(!(objectClass=*)))",
+                          ldap_query_tool.makeGroupFilter(userList=[]))
+
 
 class TestLdapQueryToolMain(unittest.TestCase):
     def setUp(self):
@@ -107,6 +172,29 @@ class TestLdapQueryToolMain(unittest.TestCase):
             ldap_query_tool.LdapQueryTool.queryLDAP.assert_has_calls(
                 expectedCalls)
 
+    def test_mainOutput(self):
+        fakeEntries = [('cn=agroup,ou=Groups,dc=example,dc=com', {'cn': ['agroup'],
+                                                                  'gidNumber': ['20001']})]
+        unmockedIterLDAP = ldap_query_tool.LdapQueryTool.iterLDAP
+        ldap_query_tool.LdapQueryTool.iterLDAP = mock.MagicMock(return_value=iter(fakeEntries))
+        try:
+            with captured_output() as (out, err):
+                ldap_query_tool.main(["-e", "not_an_endpoint", "-u", "not_a_username",
+                                      "-p", "not_a_password", "-b", "not_a_base",
+                                      "--page-size", "100", "-o", "jsonl"])
+                self.assertEquals({'dn': 'cn=agroup,ou=Groups,dc=example,dc=com',
+                                   'attributes': {'cn': ['agroup'], 'gidNumber': ['20001']}},
+                                  json.loads(out.getvalue().strip()))
+            ldap_query_tool.LdapQueryTool.iterLDAP.assert_called_once_with("not_a_base", None, None, 100)
+            ldap_query_tool.LdapQueryTool.iterLDAP = mock.MagicMock(return_value=iter(fakeEntries))
+            with captured_output() as (out, err):
+                ldap_query_tool.main(["-e", "not_an_endpoint", "-u", "not_a_username",
+                                      "-p", "not_a_password", "-b", "not_a_base", "-o", "ldif"])
+                self.assertIn("dn: cn=agroup,ou=Groups,dc=example,dc=com", out.getvalue())
+                self.assertIn("gidNumber: 20001", out.getvalue())
+        finally:
+            ldap_query_tool.LdapQueryTool.iterLDAP = unmockedIterLDAP
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,14 +6,20 @@ test_mysql_backup_tool are the tests associated with the mysql_backup_tool
  author:   Nicholas Flink <nicholas@sproutsocial.com>
 """
 
+from contextlib import closing
 from contextlib import contextmanager
 from StringIO import StringIO
+import bz2
 import datetime
+import echo_script
+import errno
+import gzip
 import logging
 import mock
 import mysql_backup_tool
 import os
 import shutil
+import stat
 import sys
 import unittest
 logging.basicConfig(level=logging.CRITICAL)
@@ -31,6 +37,47 @@ def captured_output():
         sys.stdout, sys.stderr = old_out, old_err
 
 
+class FakeProcess(object):
+    """stands in for a subprocess.Popen of mysqldump or mysql"""
+
+    def __init__(self, stdout, stdin, returnCode):
+        self.stdout = stdout
+        self.stdin = stdin
+        self._returnCode = returnCode
+
+        self.killed = False
+
+    def wait(self):
+        return self._returnCode
+
+    def kill(self):
+        self.killed = True
+
+
+class FakeStdin(StringIO):
+    """keeps what was written after it is closed"""
+
+    def close(self):
+        self.data = self.getvalue()
+        StringIO.close(self)
+
+
+class FakeSnapshot(object):
+    """stands in for a mysql_query_tool.GrantSnapshot"""
+
+    def __init__(self, fingerprint, recordList):
+        self._fingerprint = fingerprint
+        self._recordList = recordList
+        self.toRecordsCount = 0
+
+    def getFingerprint(self):
+        return self._fingerprint
+
+    def toRecords(self):
+        self.toRecordsCount += 1
+        return self._recordList
+
+
 class TestMysqlBackupTool(unittest.TestCase):
     def setUp(self):
         echoOnly = True
@@ -67,17 +114,28 @@ class TestMysqlBackupTool(unittest.TestCase):
             outStr = out.getvalue().strip()
             self.assertEquals(outStr, "mysql --host=%s --user=%s --password=%s theDB < %s" % ("theCluster", self._username, self._password, dumpFile))
 
+    def test_echoScriptPreamble(self):
+        echoScript = echo_script.EchoScript()
+        self._mysqlBackupTool.setEchoScript(echoScript)
+        with captured_output() as (out, err):
+            self._mysqlBackupTool.performMySQLDumpList(self._cluster, self._username, self._password,
+                                                       self._backupName, ["aDB"])
+            self.assertEquals("", out.getvalue())
+        self.assertEquals(["mysqldump --skip-dump-date --single-transaction --host=%s --user=%s --password=%s aDB | gzip > %s" %
+                           (self._cluster, self._username, self._password, os.path.join(self._backupPath, "aDB.sql.gz"))],
+                          echoScript.getPreamble())
+
     def test_performMySQLDumpList(self):
         aDBList = ["aDB"]
         with captured_output() as (out, err):
             self._mysqlBackupTool.performMySQLDumpList(self._cluster, self._username, self._password, self._backupName, aDBList)
             outStr = out.getvalue().strip()
-            self.assertEquals(outStr, "mysqldump --single-transaction --host=%s --user=%s --password=%s aDB > %s" % (self._cluster, self._username, self._password, os.path.join(self._backupPath, "aDB.sql")))
+            self.assertEquals(outStr, "mysqldump --skip-dump-date --single-transaction --host=%s --user=%s --password=%s aDB | gzip > %s" % (self._cluster, self._username, self._password, os.path.join(self._backupPath, "aDB.sql.gz")))
         bDBList = [("bDB", "bTable")]
         with captured_output() as (out, err):
             self._mysqlBackupTool.performMySQLDumpList(self._cluster, self._username, self._password, self._backupName, bDBList)
             outStr = out.getvalue().strip()
-            self.assertEquals(outStr, "mysqldump --single-transaction --host=%s --user=%s --password=%s bDB bTable > %s" % (self._cluster, self._username, self._password, os.path.join(self._backupPath, "bDB.bTable.sql")))
+            self.assertEquals(outStr, "mysqldump --skip-dump-date --single-transaction --host=%s --user=%s --password=%s bDB bTable | gzip > %s" % (self._cluster, self._username, self._password, os.path.join(self._backupPath, "bDB.bTable.sql.gz")))
 
     def test_restoreFromMySQLDumpList(self):
         aDBList = ["aDB"]
@@ -91,6 +149,220 @@ class TestMysqlBackupTool(unittest.TestCase):
             outStr = out.getvalue().strip()
             self.assertEquals(outStr, "mysql --host=%s --user=%s --password=%s bDB < %s" % (self._cluster, self._username, self._password, os.path.join(self._backupPath, "bDB.bTable.sql")))
 
+    def test_restoreCompressedEcho(self):
+        open(os.path.join(self._backupPath, "cDB.sql.bz2"), 'a').close()
+        with captured_output() as (out, err):
+            self._mysqlBackupTool.restoreFromMySQLDumpList(self._cluster, self._username, self._password, self._backupName, ["cDB"])
+            self.assertEquals("bunzip2 -c %s | mysql --host=%s --user=%s --password=%s cDB" %
+                              (os.path.join(self._backupPath, "cDB.sql.bz2"), self._cluster, self._username, self._password),
+                              out.getvalue().strip())
+
+    @mock.patch("subprocess.Popen")
+    def test_streamDump(self, popenMock):
+        dumpFile = os.path.join(self._backupPath, "cDB.sql.gz")
+        defaultsFiles = []
+
+        def fakeDump(args, stdout=None, stderr=None):
+            defaultsFile = args[1].split("=", 1)[1]
+            defaultsFiles.append(defaultsFile)
+            with open(defaultsFile) as f:
+                self.assertEquals('[client]\nuser="username"\npassword=\'pa"ss\'\n', f.read())
+            return FakeProcess(StringIO("CREATE TABLE cTable;\n"), None, 0)
+        popenMock.side_effect = fakeDump
+        self._mysqlBackupTool.setEchoOnly(False)
+        self._mysqlBackupTool.performMySQLDump(self._cluster, self._username, 'pa"ss', "cDB", dumpFile, ["--no-data"])
+        dumpArgs = popenMock.call_args[0][0]
+        # the password is never on the command line and the file holding it is removed
+        self.assertEquals(["mysqldump", "--no-data", "--host=cluster", "cDB"], [dumpArgs[0]] + dumpArgs[2:])
+        self.assertFalse(os.path.exists(defaultsFiles[0]))
+        self.assertEquals("CREATE TABLE cTable;\n", gzip.open(dumpFile).read())
+
+    @mock.patch("subprocess.Popen")
+    def test_streamDumpFailure(self, popenMock):
+        dumpFile = os.path.join(self._backupPath, "cDB.sql.gz")
+        popenMock.return_value = FakeProcess(StringIO("partial"), None, 2)
+        self._mysqlBackupTool.setEchoOnly(False)
+        self.assertRaises(mysql_backup_tool.MysqlDumpException, self._mysqlBackupTool.performMySQLDump,
+                          self._cluster, self._username, self._password, "cDB", dumpFile)
+        self.assertEquals(["aDB.sql", "bDB.bTable.sql"], sorted(os.listdir(self._backupPath)))
+
+    @mock.patch("subprocess.Popen")
+    def test_streamRestore(self, popenMock):
+        dumpFile = os.path.join(self._backupPath, "cDB.sql.bz2")
+        with closing(bz2.BZ2File(dumpFile, 'wb')) as f:
+            f.write("CREATE TABLE cTable;\n")
+        stdin = FakeStdin()
+        popenMock.return_value = FakeProcess(None, stdin, 0)
+        self._mysqlBackupTool.setEchoOnly(False)
+        self._mysqlBackupTool.restoreFromMySQLDump(self._cluster, self._username, self._password, "cDB", dumpFile)
+        restoreArgs = popenMock.call_args[0][0]
+        self.assertEquals(["mysql", "--host=cluster", "cDB"], [restoreArgs[0]] + restoreArgs[2:])
+        self.assertEquals("CREATE TABLE cTable;\n", stdin.data)
+
+    @mock.patch("subprocess.Popen")
+    def test_streamRestoreCorrupt(self, popenMock):
+        dumpFile = os.path.join(self._backupPath, "cDB.sql.gz")
+        with open(dumpFile, 'wb') as f:
+            f.write("not gzip")
+        stdin = FakeStdin()
+        popenMock.return_value = FakeProcess(None, stdin, 0)
+        self._mysqlBackupTool.setEchoOnly(False)
+        self.assertRaises(mysql_backup_tool.MysqlRestoreException, self._mysqlBackupTool.restoreFromMySQLDump,
+                          self._cluster, self._username, self._password, "cDB", dumpFile)
+        # mysql is stopped and its stdin closed so waiting on it can not hang
+        self.assertTrue(popenMock.return_value.killed)
+        self.assertEquals("", stdin.data)
+
+    @mock.patch("subprocess.Popen")
+    def test_pipeMySQLDump(self, popenMock):
+        archiveFile = os.path.join(self._backupPath, "pipe", "cDB.sql.gz")
+        dump = "CREATE TABLE cTable;\nINSERT INTO `cTable` VALUES (1),(2),(3);\nINSERT INTO `cTable` VALUES (4);\n"
+        stdin = FakeStdin()
+
+        def fakeProcess(args, stdin=None, stdout=None, stderr=None):
+            if args[0] == "mysqldump":
+                return FakeProcess(StringIO(dump), None, 0)
+            return FakeProcess(None, restoreStdin, 0)
+        restoreStdin = stdin
+        popenMock.side_effect = fakeProcess
+        self._mysqlBackupTool.setEchoOnly(False)
+        stats = self._mysqlBackupTool.pipeMySQLDump(self._cluster, self._username, self._password, "cDB",
+                                                    "localhost", "localUser", "localPass", "dDB", ["--no-data"],
+                                                    archiveFile)
+        restoreArgs, dumpArgs = [x[0][0] for x in popenMock.call_args_list]
+        self.assertEquals(["mysql", "--host=localhost", "dDB"], [restoreArgs[0]] + restoreArgs[2:])
+        self.assertEquals(["mysqldump", "--no-data", "--host=cluster", "cDB"], [dumpArgs[0]] + dumpArgs[2:])
+        self.assertEquals(dump, stdin.data)
+        self.assertEquals(dump, gzip.open(archiveFile).read())
+        self.assertEquals(len(dump), stats['bytes'])
+        self.assertEquals(4, stats['rows'])
+        # a failed restore leaves no archive behind
+        os.remove(archiveFile)
+        restoreStdin = FakeStdin()
+        popenMock.side_effect = lambda args, **kwargs: FakeProcess(StringIO(dump), restoreStdin,
+                                                                    1 if args[0] == "mysql" else 0)
+        self.assertRaises(mysql_backup_tool.MysqlRestoreException, self._mysqlBackupTool.pipeMySQLDump,
+                          self._cluster, self._username, self._password, "cDB", "localhost", "localUser",
+                          "localPass", "dDB", [], archiveFile)
+        self.assertEquals([], os.listdir(os.path.dirname(archiveFile)))
+
+    @mock.patch("subprocess.Popen")
+    def test_pipeMySQLDumpArchiveFailure(self, popenMock):
+        archiveFile = os.path.join(self._backupPath, "cDB.sql.gz")
+        restoreProc = FakeProcess(None, FakeStdin(), 0)
+        dumpProc = FakeProcess(StringIO("CREATE TABLE cTable;\n"), None, 0)
+        popenMock.side_effect = lambda args, **kwargs: restoreProc if args[0] == "mysql" else dumpProc
+        archive = mock.MagicMock()
+        archive.write.side_effect = IOError(errno.ENOSPC, "No space left on device")
+        self._mysqlBackupTool.setEchoOnly(False)
+        with mock.patch.object(mysql_backup_tool, "openDumpFile", return_value=archive):
+            self.assertRaises(mysql_backup_tool.MysqlDumpException, self._mysqlBackupTool.pipeMySQLDump,
+                              self._cluster, self._username, self._password, "cDB", "localhost", "localUser",
+                              "localPass", "dDB", [], archiveFile)
+        # a full disk is not mistaken for mysql going away and neither process is left running
+        self.assertTrue(dumpProc.killed)
+        self.assertTrue(restoreProc.killed)
+        self.assertEquals("CREATE TABLE cTable;\n", restoreProc.stdin.data)
+
+    def test_quoteOption(self):
+        self.assertEquals('"pa ss"', mysql_backup_tool.quoteOption("pa ss"))
+        # only the escapes an option file reads back are used
+        self.assertEquals('"a\\\\b\\tc\\n"', mysql_backup_tool.quoteOption("a\\b\tc\n"))
+        # a double quote can not be escaped so the value is single quoted
+        self.assertEquals("'pa\"ss#'", mysql_backup_tool.quoteOption('pa"ss#'))
+        self.assertRaises(mysql_backup_tool.OptionFileException, mysql_backup_tool.quoteOption, "pa\"ss'")
+
+    def test_dumpRowCounter(self):
+        counter = mysql_backup_tool.DumpRowCounter()
+        dump = "INSERT INTO `aTable` VALUES (1),(2);\nINSERT INTO `aTable` VALUES (3),(4),(5);\n"
+        # markers split across chunks are counted once
+        for i in range(0, len(dump), 2):
+            counter.update(dump[i:i + 2])
+        self.assertEquals(5, counter.rows)
+
+    def test_grantSnapshotFile(self):
+        recordList = [{'user': "reader@%", 'hash': "*CAFEBABE", 'grants': {'*.*': ["SELECT"]},
+                       'columns': {}, 'roles': []}]
+        snapshot = FakeSnapshot("aFingerprint", recordList)
+        self.assertEquals(None, self._mysqlBackupTool.loadGrantSnapshot(self._backupName, "cluster2"))
+        self.assertFalse(self._mysqlBackupTool.hasGrantSnapshot(self._backupName, "cluster2"))
+        self._mysqlBackupTool.saveGrantSnapshot(self._backupName, "cluster2", snapshot)
+        self.assertTrue(self._mysqlBackupTool.hasGrantSnapshot(self._backupName, "cluster2"))
+        snapshotFile = self._mysqlBackupTool.findManifestBlob(self._backupName, "cluster2", "grants.jsonl")
+        self.assertTrue(snapshotFile.endswith(".gz"))
+        # it holds password hashes
+        self.assertEquals(0600, stat.S_IMODE(os.stat(snapshotFile).st_mode))
+        self.assertEquals(recordList, self._mysqlBackupTool.loadGrantSnapshot(self._backupName, "cluster2"))
+        with closing(gzip.open(snapshotFile, 'wb')) as f:
+            f.write('{"version": 0}\n')
+        self.assertRaises(mysql_backup_tool.GrantSnapshotException,
+                          self._mysqlBackupTool.loadGrantSnapshot, self._backupName, "cluster2")
+
+    def test_unchangedGrantSnapshot(self):
+        snapshot = FakeSnapshot("aFingerprint", [])
+        self._mysqlBackupTool.saveGrantSnapshot("20150101-000000", self._cluster, snapshot)
+        self._mysqlBackupTool.saveGrantSnapshot(self._backupName, self._cluster, snapshot)
+        # the records are only read the first time
+        self.assertEquals(1, snapshot.toRecordsCount)
+        self.assertEquals(self._mysqlBackupTool.findManifestBlob("20150101-000000", self._cluster, "grants.jsonl"),
+                          self._mysqlBackupTool.findManifestBlob(self._backupName, self._cluster, "grants.jsonl"))
+        self.assertEquals([], self._mysqlBackupTool.loadGrantSnapshot(self._backupName, self._cluster))
+        self.assertEquals(self._backupName, self._mysqlBackupTool.getLastBackup())
+
+    @mock.patch("subprocess.Popen")
+    def test_dumpDeduplication(self, popenMock):
+        popenMock.side_effect = lambda *args, **kwargs: FakeProcess(StringIO("CREATE TABLE cTable;\n"), None, 0)
+        self._mysqlBackupTool.setEchoOnly(False)
+        for backupName in ["20150101-000000", self._backupName]:
+            self._mysqlBackupTool.performMySQLDumpList(self._cluster, self._username, self._password,
+                                                       backupName, ["cDB", ["dDB", "dTable"]])
+        self.assertEquals(["--skip-dump-date"], popenMock.call_args[0][0][2:3])
+        # the backup directory holds only the manifest and both dumps share one blob
+        self.assertEquals(["manifest.json"],
+                          os.listdir(os.path.join(self._fakeBackupPath, "20150101-000000", self._cluster)))
+        blobFile = self._mysqlBackupTool.findManifestBlob(self._backupName, self._cluster, "dDB.dTable.sql")
+        self.assertEquals(blobFile, self._mysqlBackupTool.findManifestBlob("20150101-000000", self._cluster, "cDB.sql"))
+        self.assertEquals("CREATE TABLE cTable;\n", gzip.open(blobFile).read())
+        stdin = FakeStdin()
+        popenMock.side_effect = lambda *args, **kwargs: FakeProcess(None, stdin, 0)
+        self._mysqlBackupTool.restoreFromMySQLDumpList(self._cluster, self._username, self._password,
+                                                       self._backupName, ["cDB"])
+        self.assertEquals("CREATE TABLE cTable;\n", stdin.data)
+
+    def test_pruneBlobs(self):
+        self._mysqlBackupTool.saveGrantSnapshot("20150101-000000", self._cluster, FakeSnapshot("old", []))
+        self._mysqlBackupTool.saveGrantSnapshot("20150101-000000", "cluster2", FakeSnapshot("kept", []))
+        self._mysqlBackupTool.saveGrantSnapshot(self._backupName, "cluster2", FakeSnapshot("kept", []))
+        oldBlob = self._mysqlBackupTool.findManifestBlob("20150101-000000", self._cluster, "grants.jsonl")
+        keptBlob = self._mysqlBackupTool.findManifestBlob(self._backupName, "cluster2", "grants.jsonl")
+        self._mysqlBackupTool.pruneBefore("20150102-000000")
+        self.assertFalse(os.path.exists(oldBlob))
+        self.assertTrue(os.path.exists(keptBlob))
+        self.assertEquals(sorted([self._backupName, "blobs", "catalog.json"]), sorted(os.listdir(self._fakeBackupPath)))
+
+    def test_catalog(self):
+        for backupName, cluster in [("20150101-000000", self._cluster), ("20150102-000000", "cluster2"),
+                                    ("20150103-000000", self._cluster)]:
+            self._mysqlBackupTool.saveGrantSnapshot(backupName, cluster, FakeSnapshot(backupName, []))
+        # the backup made in setUp is found by the first listing
+        self.assertEquals(self._backupName, self._mysqlBackupTool.getLastBackup())
+        self.assertEquals("20150102-000000", self._mysqlBackupTool.getLastBackup("cluster2"))
+        self.assertEquals("20150101-000000", self._mysqlBackupTool.getNearestBackup(self._cluster, "20150102-120000"))
+        self.assertEquals(None, self._mysqlBackupTool.getNearestBackup("cluster2", "20150101-120000"))
+        os.makedirs(os.path.join(self._fakeBackupPath, "malformed"))
+        self._mysqlBackupTool.pruneBefore("20150102-000000")
+        self.assertEquals(sorted(["20150102-000000", "20150103-000000", self._backupName, "blobs", "catalog.json"]),
+                          sorted(os.listdir(self._fakeBackupPath)))
+        self.assertEquals(None, self._mysqlBackupTool.getNearestBackup(self._cluster, "20150102-120000"))
+        # another tool sharing the backup path reads the same catalog
+        otherBackupTool = mysql_backup_tool.MysqlBackupTool(True, False, self._fakeBackupPath)
+        catalog = {"cluster2": ["20150102-000000"], self._cluster: ["20150103-000000", self._backupName]}
+        self.assertEquals(catalog, otherBackupTool.loadCatalog())
+        # without a catalog it is rebuilt from the backup directories
+        os.remove(otherBackupTool.getCatalogFile())
+        self.assertEquals(catalog, otherBackupTool.loadCatalog())
+        self.assertTrue(os.path.exists(otherBackupTool.getCatalogFile()))
+
     def test_pruneing(self):
         now = datetime.timedelta(days=0)
         yesterday = datetime.timedelta(days=1)
@@ -14,8 +14,12 @@ from contextlib import contextmanager
 from StringIO import StringIO
 import logging
 import mock
+import shutil
 import sys
 import mysql_grants_generator
+import privilege_mask
+import threading
+import time
 import unittest
 import auto_grant_config
 logging.basicConfig(level=logging.CRITICAL)
@@ -88,10 +92,15 @@ class TestMysqlGrantsGenerator(unittest.TestCase):
         self._unmockedQueryToolQueryGrant = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant
         self._unmockedQueryToolBeginTrans = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.beginTransaction
         self._unmockedQueryToolCommitTrans = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.commitTransaction
+        self._unmockedQueryToolRollbackTrans = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.rollbackTransaction
         self._unmockedQueryToolCloseConn = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.closeConnection
         self._unmockedQueryToolCreateUser = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.createUser
         self._unmockedQueryToolGetVersion = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.getVersion
-        self._unmockedBackupToolDump = mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.performMySQLDumpList
+        self._unmockedQueryToolFlushStatements = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.flushStatements
+        self._unmockedQueryToolFinishStatements = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.finishStatements
+        self._unmockedQueryToolNeedsFlush = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.needsFlushPrivileges
+        self._unmockedQueryToolGetPendingCount = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.getPendingCount
+        self._unmockedBackupToolSaveSnapshot = mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot
         self._unmockedEmailToolSendMail = mysql_grants_generator.email_tool.EmailTool.sendMail
         self._unmockedEmailToolSendInvite = mysql_grants_generator.email_tool.EmailTool.sendChangePasswordInvite
         # Mock
@@ -103,7 +112,11 @@ class TestMysqlGrantsGenerator(unittest.TestCase):
         mysql_grants_generator.mysql_query_tool.MysqlQueryTool.closeConnection = mock.MagicMock(return_value=None)
         mysql_grants_generator.mysql_query_tool.MysqlQueryTool.createUser = mock.MagicMock(return_value=None)
         mysql_grants_generator.mysql_query_tool.MysqlQueryTool.getVersion = mock.MagicMock(return_value=5.5)
-        mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.performMySQLDumpList = mock.MagicMock(return_value=None)
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.flushStatements = mock.MagicMock(return_value=None)
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.finishStatements = mock.MagicMock(return_value=None)
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.needsFlushPrivileges = mock.MagicMock(return_value=False)
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.getPendingCount = mock.MagicMock(return_value=0)
+        mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot = mock.MagicMock(return_value=None)
         mysql_grants_generator.email_tool.EmailTool.sendMail = mock.MagicMock(return_value=None)
         mysql_grants_generator.email_tool.EmailTool.sendChangePasswordInvite = mock.MagicMock(return_value=None)
 
@@ -117,10 +130,41 @@ class TestMysqlGrantsGenerator(unittest.TestCase):
         mysql_grants_generator.mysql_query_tool.MysqlQueryTool.closeConnection = self._unmockedQueryToolCloseConn
         mysql_grants_generator.mysql_query_tool.MysqlQueryTool.createUser = self._unmockedQueryToolCreateUser
         mysql_grants_generator.mysql_query_tool.MysqlQueryTool.getVersion = self._unmockedQueryToolGetVersion
-        mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.performMySQLDumpList = self._unmockedBackupToolDump
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.flushStatements = self._unmockedQueryToolFlushStatements
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.finishStatements = self._unmockedQueryToolFinishStatements
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.needsFlushPrivileges = self._unmockedQueryToolNeedsFlush
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.getPendingCount = self._unmockedQueryToolGetPendingCount
+        mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot = self._unmockedBackupToolSaveSnapshot
         mysql_grants_generator.email_tool.EmailTool.sendMail = self._unmockedEmailToolSendMail
         mysql_grants_generator.email_tool.EmailTool.sendChangePasswordInvite = self._unmockedEmailToolSendInvite
 
+    @mock.patch.object(mysql_grants_generator.mysql_query_tool.MysqlQueryTool, 'restoreGrantSnapshot')
+    @mock.patch.object(mysql_grants_generator.mysql_backup_tool.MysqlBackupTool, 'loadGrantSnapshot')
+    @mock.patch.object(mysql_grants_generator.mysql_backup_tool.MysqlBackupTool, 'getNearestBackup')
+    def test_revertAccess(self, getNearestBackupMock, loadGrantSnapshotMock, restoreGrantSnapshotMock):
+        getNearestBackupMock.return_value = "20150102-000000"
+        loadGrantSnapshotMock.return_value = [{'user': "user2@%", 'hash': "", 'grants': {'*.*': ["SELECT"]},
+                                               'columns': {}, 'roles': []}]
+        mysql_grants_generator.revertAccess(self.autoGrantConfig, "20150102-000000", True, False,
+                                            ["user2"], ["cluster2"], 2)
+        loadGrantSnapshotMock.assert_called_once_with("20150102-000000", "cluster2")
+        savedSnapshot, dropChunkSize, userList = restoreGrantSnapshotMock.call_args[0]
+        self.assertEquals(set(["user2@%"]), savedSnapshot.getAllUsers())
+        self.assertEquals(["user2"], userList)
+        # a cluster the run did not back up is left alone rather than reverted to an older run's backup
+        getNearestBackupMock.return_value = "20150101-000000"
+        loadGrantSnapshotMock.reset_mock()
+        restoreGrantSnapshotMock.reset_mock()
+        mysql_grants_generator.revertAccess(self.autoGrantConfig, "20150102-000000", True, False,
+                                            ["user2"], ["cluster2"], 2)
+        self.assertFalse(loadGrantSnapshotMock.called)
+        self.assertFalse(restoreGrantSnapshotMock.called)
+        getNearestBackupMock.return_value = "20150102-000000"
+        # a mysql.user dump can not be restored for some users only
+        loadGrantSnapshotMock.return_value = None
+        self.assertRaises(mysql_grants_generator.GrantException, mysql_grants_generator.revertAccess,
+                          self.autoGrantConfig, "20150102-000000", True, False, ["user2"], None, 2)
+
     def test_makeGroupDict(self):
         ldapDict = {'cn=agroup,ou=Groups,dc=example,dc=com': {
                     'cn': ['agroup'],
@@ -142,6 +186,31 @@ class TestMysqlGrantsGenerator(unittest.TestCase):
                              'group2': ['user2', 'user3']}
         self.assertItemsEqual(expectedGroupDict, groupDict)
 
+    def test_queryLdapGroups(self):
+        self.yamlDict['ldap_group_desc'] = "ou=groups,dc=nodomain"
+        self.yamlDict['ldap_min_gid'] = 20000
+        self.autoGrantConfig.overrideYamlDictForTests(self.yamlDict)
+        pageSize = mysql_grants_generator.auto_grant_config.DEFAULT_LDAP_PAGE_SIZE
+        ldapQueryTool = mock.MagicMock()
+        ldapQueryTool.iterGroups = mock.MagicMock(side_effect=lambda *args: iter([
+            ('cn=agroup,ou=Groups,dc=example,dc=com', {'cn': ['agroup'],
+                                                       'gidNumber': ['20001'],
+                                                       'memberUid': ['user1', 'user4']})]))
+        mysql_grants_generator.queryLdapGroups(self.autoGrantConfig, ldapQueryTool)
+        ldapQueryTool.iterGroups.assert_called_once_with("ou=groups,dc=nodomain", 20000, None, None, False, pageSize)
+        ldapQueryTool.iterGroups.reset_mock()
+        mysql_grants_generator.queryLdapGroups(self.autoGrantConfig, ldapQueryTool, userList="user1,user2")
+        ldapQueryTool.iterGroups.assert_called_once_with("ou=groups,dc=nodomain", 20000, None, ["user1", "user2"], False, pageSize)
+        ldapQueryTool.iterGroups.reset_mock()
+        # the members of the named groups are looked up before all of their groups
+        groupEntries = mysql_grants_generator.queryLdapGroups(self.autoGrantConfig, ldapQueryTool, groupList="agroup,group1")
+        ldapQueryTool.iterGroups.assert_has_calls([
+            mock.call("ou=groups,dc=nodomain", 20000, ["agroup", "group1"], None, False, pageSize),
+            mock.call("ou=groups,dc=nodomain", 20000, None, ["user1", "user4", "user1", "user2"], False, pageSize)])
+        # the entries stream straight into makeGroupDict
+        groupDict = mysql_grants_generator.makeGroupDict(self.autoGrantConfig, groupEntries)
+        self.assertEquals(['user1', 'user4'], groupDict['agroup'])
+
     def test_makeUserDict(self):
         groupDict = {'agroup': ['user1', 'user2', 'user3'],
                      'group1': ['user1', 'user2'],
@@ -241,24 +310,24 @@ class TestMysqlGrantsGenerator(unittest.TestCase):
                                    'privileges': ['SELECT']}],
                       "user3@%": [{'db_table': '*.*',
                                    'privileges': ['SELECT']}]}}
-        expectedCalls = [mock.call('user3@%', set(['SELECT']), '*.*'),
-                         mock.call('user2@%', set(['SELECT']), '*.*'),
-                         mock.call('user3@%', set(['SELECT']), '*.*'),
+        expectedCalls = [mock.call('user3@%', privilege_mask.toMask(['SELECT']), '*.*'),
+                         mock.call('user2@%', privilege_mask.toMask(['SELECT']), '*.*'),
+                         mock.call('user3@%', privilege_mask.toMask(['SELECT']), '*.*'),
                          mock.call('user2@host1',
-                                   set(['INSERT', 'UPDATE', 'SELECT',
-                                        'DELETE']), '*.*'),
-                         mock.call('user2@host2', set(['SUPER']),
+                                   privilege_mask.toMask(['INSERT', 'UPDATE', 'SELECT',
+                                                          'DELETE']), '*.*'),
+                         mock.call('user2@host2', privilege_mask.toMask(['SUPER']),
                                    'bDB.bTable'),
-                         mock.call('user2@host2', set(['DROP', 'ALTER']),
+                         mock.call('user2@host2', privilege_mask.toMask(['DROP', 'ALTER']),
                                    'aDB.aTable'),
-                         mock.call('user2@%', set(['SELECT']), '*.*'),
-                         mock.call('user1@host2', set(['SUPER']),
+                         mock.call('user2@%', privilege_mask.toMask(['SELECT']), '*.*'),
+                         mock.call('user1@host2', privilege_mask.toMask(['SUPER']),
                                    'bDB.bTable'),
-                         mock.call('user1@host2', set(['DROP', 'ALTER']),
+                         mock.call('user1@host2', privilege_mask.toMask(['DROP', 'ALTER']),
                                    'aDB.aTable'),
                          mock.call('user1@host1',
-                                   set(['INSERT', 'UPDATE', 'SELECT',
-                                        'DELETE']), '*.*')]
+                                   privilege_mask.toMask(['INSERT', 'UPDATE', 'SELECT',
+                                                          'DELETE']), '*.*')]
         echoOnly = False
         logPasswords = True
         destructive = False
@@ -267,6 +336,250 @@ class TestMysqlGrantsGenerator(unittest.TestCase):
                                            echoOnly, logPasswords, destructive, passwordReset)
         mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant.assert_has_calls(expectedCalls)
 
+    def test_grantAccessParallel(self):
+        grantDict = {'cluster1':
+                     {"user1@host1": [{'db_table': '*.*',
+                                       'privileges': ['SELECT']}],
+                      "user2@%": [{'db_table': '*.*',
+                                   'privileges': ['SELECT', 'INSERT']}],
+                      "user3@%": [{'db_table': 'aDB.aTable',
+                                   'privileges': ['ALTER']}]},
+                     'cluster2':
+                     {"user2@%": [{'db_table': '*.*',
+                                   'privileges': ['SELECT']}]}}
+        expectedCalls = [mock.call('user1@host1', privilege_mask.toMask(['SELECT']), '*.*'),
+                         mock.call('user2@%', privilege_mask.toMask(['SELECT', 'INSERT']), '*.*'),
+                         mock.call('user3@%', privilege_mask.toMask(['ALTER']), 'aDB.aTable'),
+                         mock.call('user2@%', privilege_mask.toMask(['SELECT']), '*.*')]
+        workers = 2
+        clusterConcurrency = 2
+        mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, False, True, False, False,
+                                           workers, clusterConcurrency)
+        queryGrant = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant
+        queryGrant.assert_has_calls(expectedCalls, any_order=True)
+        self.assertEquals(len(expectedCalls), queryGrant.call_count)
+        # user2 is created once with the same password on both clusters
+        createUser = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.createUser
+        user2Passwords = set([x[0][1] for x in createUser.call_args_list if x[0][0] == "user2@%"])
+        self.assertEquals(1, len(user2Passwords))
+
+    def test_grantAccessMaxInFlight(self):
+        grantDict = {'cluster1': {"user1@host1": [{'db_table': '*.*', 'privileges': ['SELECT']}],
+                                  "user2@%": [{'db_table': '*.*', 'privileges': ['SELECT']}]},
+                     'cluster2': {"user2@%": [{'db_table': '*.*', 'privileges': ['SELECT']}]}}
+        workers = 2
+        clusterConcurrency = 2
+        maxInFlight = 1
+        lock = threading.Lock()
+        inFlightDict = {'running': 0, 'peak': 0}
+        unmockedGrantUserAccess = mysql_grants_generator.grantUserAccess
+
+        def countingGrantUserAccess(*args):
+            with lock:
+                inFlightDict['running'] += 1
+                inFlightDict['peak'] = max(inFlightDict['peak'], inFlightDict['running'])
+            try:
+                # hold the user long enough for the other workers to try to start theirs
+                time.sleep(0.02)
+                return unmockedGrantUserAccess(*args)
+            finally:
+                with lock:
+                    inFlightDict['running'] -= 1
+        with mock.patch.object(mysql_grants_generator, "grantUserAccess", side_effect=countingGrantUserAccess) as grantUserAccessMock:
+            mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, False, True, False, False,
+                                               workers, clusterConcurrency, maxInFlight)
+        self.assertEquals(3, grantUserAccessMock.call_count)
+        self.assertTrue(inFlightDict['peak'] <= maxInFlight)
+        self.assertEquals(3, mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant.call_count)
+
+    def test_grantAccessClusterFailure(self):
+        grantDict = {'cluster1': {"user1@host1": [{'db_table': '*.*', 'privileges': ['SELECT']}]},
+                     'cluster2': {"user2@%": [{'db_table': '*.*', 'privileges': ['SELECT']}]}}
+
+        def failOnUser1(userAtHost, privileges, dbTable):
+            if userAtHost == "user1@host1":
+                raise Exception("denied")
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant = mock.MagicMock(side_effect=failOnUser1)
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.rollbackTransaction = mock.MagicMock(return_value=None)
+        try:
+            with self.assertRaises(mysql_grants_generator.GrantException):
+                mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, False, True, False, False, 2)
+            # the other cluster is still reconciled
+            mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant.assert_any_call('user2@%', privilege_mask.toMask(['SELECT']), '*.*')
+        finally:
+            mysql_grants_generator.mysql_query_tool.MysqlQueryTool.rollbackTransaction = self._unmockedQueryToolRollbackTrans
+
+    def test_grantAccessBatchFailure(self):
+        grantDict = {'cluster1': {"user1@host1": [{'db_table': '*.*', 'privileges': ['SELECT']}]}}
+        batchException = mysql_grants_generator.mysql_query_tool.StatementBatchException(
+            Exception("denied"), "user0@%", "GRANT SELECT ON *.* TO 'user0'@'%'")
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.finishStatements = mock.MagicMock(side_effect=batchException)
+        with self.assertRaises(mysql_grants_generator.GrantException) as context:
+            mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, False, True, False, False)
+        # the error names the user whose statement failed not the last one queued
+        self.assertIn("for user0@% on cluster1", str(context.exception))
+        self.assertNotIn("user1@host1", str(context.exception))
+
+    def test_grantAccessPlan(self):
+        grantDict = {'cluster1': {"user1@host1": [{'db_table': '*.*', 'privileges': ['SELECT']}]}}
+        grantPlan = mysql_grants_generator.grant_plan.GrantPlan()
+        mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, True, True, False, False,
+                                           grantPlan=grantPlan)
+        self.assertEquals(['cluster1'], grantPlan.getClusters())
+        self.assertEquals('cluster1', grantPlan.getDefaultCluster())
+        self.assertNotEquals(None, grantPlan.getFingerprint('cluster1'))
+        # an echoed run is backed up so the echoed script can be reverted once applied
+        self.assertEquals(1, mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot.call_count)
+        newUsers = grantPlan.getNewUsers()
+        self.assertEquals(['cluster1'], newUsers["user1@host1"][mysql_grants_generator.CLUSTERS_KEY])
+        self.assertEquals(mysql_grants_generator.TEMPLATE_INVITE, newUsers["user1@host1"][mysql_grants_generator.TEMPLATE_KEY])
+
+    def test_applyGrantPlan(self):
+        queryMySQL = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryMySQL
+        snapshotFingerprint = mysql_grants_generator.mysql_query_tool.GrantSnapshot().getFingerprint()
+        grantPlan = mysql_grants_generator.grant_plan.GrantPlan({'accessLevel': mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE})
+        grantPlan.setFingerprint('cluster1', snapshotFingerprint)
+        grantPlan.addStatement('cluster1', mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE,
+                               "GRANT SELECT ON *.* TO %s@%s", ("user1", "host1"))
+        grantPlan.setFingerprint('cluster2', "stale")
+        grantPlan.addStatement('cluster2', mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE,
+                               "GRANT SELECT ON *.* TO %s@%s", ("user2", "%"))
+        with self.assertRaises(mysql_grants_generator.GrantException):
+            mysql_grants_generator.applyGrantPlan(self.autoGrantConfig, grantPlan, True)
+        queryMySQL.assert_any_call(mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE,
+                                   "GRANT SELECT ON *.* TO %s@%s", ("user1", "host1"))
+        # the stale cluster is left untouched
+        self.assertNotIn(mock.call(mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE,
+                                   "GRANT SELECT ON *.* TO %s@%s", ("user2", "%")),
+                         queryMySQL.call_args_list)
+
+    def test_applyGrantPlanCreateUser(self):
+        queryMySQL = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryMySQL
+        snapshotFingerprint = mysql_grants_generator.mysql_query_tool.GrantSnapshot().getFingerprint()
+        grantPlan = mysql_grants_generator.grant_plan.GrantPlan({'accessLevel': mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE})
+        grantPlan.setFingerprint('cluster1', snapshotFingerprint)
+        grantPlan.addStatement('cluster1', mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE,
+                               "CREATE USER %s@%s IDENTIFIED BY %s", ("user1", "host1", "aRandPass"),
+                               mysql_grants_generator.grant_plan.STEP_CREATE_USER)
+        grantPlan.addStatement('cluster1', mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE,
+                               "GRANT SELECT ON *.* TO %s@%s", ("user1", "host1"))
+        mysql_grants_generator.applyGrantPlan(self.autoGrantConfig, grantPlan, True)
+        # the create is replayed through createUser so a leftover account is dropped and retried
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.createUser.assert_called_once_with(
+            "user1@host1", "aRandPass", False)
+        self.assertEquals([mock.call(mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE,
+                                     "GRANT SELECT ON *.* TO %s@%s", ("user1", "host1"))],
+                          [x for x in queryMySQL.call_args_list
+                           if x[0][0] != mysql_grants_generator.mysql_query_tool.QAL_READ])
+
+    def test_applyGrantPlanInterleaved(self):
+        queryMySQL = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryMySQL
+        snapshotFingerprint = mysql_grants_generator.mysql_query_tool.GrantSnapshot().getFingerprint()
+        grantPlan = mysql_grants_generator.grant_plan.GrantPlan({'accessLevel': mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE})
+        grantPlan.setRunHash("aRunHash")
+        grantPlan.setFingerprint('cluster1', snapshotFingerprint)
+        # the statements of users applied over several connections interleave in the plan
+        for user in ["user1", "user2", "user1"]:
+            grantPlan.addStatement('cluster1', mysql_grants_generator.mysql_query_tool.QAL_READ_WRITE,
+                                   "GRANT SELECT ON *.* TO %s@%s", (user, "%"))
+        statePath = "./testInterleavedState"
+        checkpointStore = mysql_grants_generator.state_store.GrantStateStore(statePath + "/state.sqlite")
+
+        def failOnThirdGrant(accessLevel, query, qArgs):
+            if 3 == len([x for x in queryMySQL.call_args_list if x[0][1].startswith("GRANT")]):
+                raise Exception("lost connection")
+        try:
+            queryMySQL.side_effect = failOnThirdGrant
+            with self.assertRaises(Exception):
+                mysql_grants_generator.applyGrantPlan(self.autoGrantConfig, grantPlan, True,
+                                                      checkpointStore=checkpointStore, retries=0)
+            # user1 still had a statement left to send so only user2 is done
+            checkpoint = mysql_grants_generator.state_store.RunCheckpoint(checkpointStore, "aRunHash", True)
+            self.assertEquals(set(["user2@%"]), set(checkpoint.getDoneUsers('cluster1')))
+        finally:
+            queryMySQL.side_effect = None
+            checkpointStore.close()
+            shutil.rmtree(statePath)
+
+    def test_grantAccessIncremental(self):
+        grantDict = {'cluster1': {"user1@host1": [{'db_table': '*.*', 'privileges': ['SELECT']}]}}
+        statePath = "./testIncrementalState"
+        stateStore = mysql_grants_generator.state_store.GrantStateStore(statePath + "/state.sqlite")
+        try:
+            mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, False, True, False, False,
+                                               stateStore=stateStore)
+            self.assertEquals(1, mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant.call_count)
+            # nothing changed so neither the grants nor the backup run again
+            mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant.reset_mock()
+            mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot.reset_mock()
+            mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, False, True, False, False,
+                                               stateStore=stateStore)
+            self.assertEquals(0, mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant.call_count)
+            self.assertEquals(0, mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot.call_count)
+        finally:
+            stateStore.close()
+            shutil.rmtree(statePath)
+
+    def test_grantAccessRetry(self):
+        grantDict = {'cluster1': {"user1@host1": [{'db_table': '*.*', 'privileges': ['SELECT']}]},
+                     'cluster2': {"user2@%": [{'db_table': '*.*', 'privileges': ['SELECT']}]}}
+        failures = ["user1@host1"]
+
+        def failOnceOnUser1(userAtHost, privileges, dbTable):
+            if userAtHost in failures:
+                failures.remove(userAtHost)
+                raise Exception("lost connection")
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant = mock.MagicMock(side_effect=failOnceOnUser1)
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.rollbackTransaction = mock.MagicMock(return_value=None)
+        saveGrantSnapshot = mysql_grants_generator.mysql_backup_tool.MysqlBackupTool.saveGrantSnapshot
+
+        def hasGrantSnapshot(backupName, cluster):
+            return (backupName, cluster) in [x[0][:2] for x in saveGrantSnapshot.call_args_list]
+        try:
+            with mock.patch.object(mysql_grants_generator.mysql_backup_tool.MysqlBackupTool, "hasGrantSnapshot",
+                                   side_effect=hasGrantSnapshot):
+                mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, False, True, False, False, retries=1)
+            self.assertEquals(3, mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant.call_count)
+            # the retry keeps the backup taken before the first attempt changed anything
+            self.assertEquals(["cluster1", "cluster2"], sorted(x[0][1] for x in saveGrantSnapshot.call_args_list))
+        finally:
+            mysql_grants_generator.mysql_query_tool.MysqlQueryTool.rollbackTransaction = self._unmockedQueryToolRollbackTrans
+
+    def test_grantAccessResume(self):
+        grantDict = {'cluster1': {"user1@host1": [{'db_table': '*.*', 'privileges': ['SELECT']}]},
+                     'cluster2': {"user2@%": [{'db_table': '*.*', 'privileges': ['SELECT']}],
+                                  "user3@%": [{'db_table': '*.*', 'privileges': ['SELECT']}]}}
+        statePath = "./testResumeState"
+        checkpointStore = mysql_grants_generator.state_store.GrantStateStore(statePath + "/state.sqlite")
+        queryGrant = mysql_grants_generator.mysql_query_tool.MysqlQueryTool.queryGrant
+
+        def failOnUser2(userAtHost, privileges, dbTable):
+            if userAtHost == "user2@%":
+                raise Exception("denied")
+        mysql_grants_generator.mysql_query_tool.MysqlQueryTool.rollbackTransaction = mock.MagicMock(return_value=None)
+        try:
+            queryGrant.side_effect = failOnUser2
+            with self.assertRaises(mysql_grants_generator.GrantException):
+                mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, False, True, False, False,
+                                                   batchSize=1, checkpointStore=checkpointStore, retries=0)
+            queryGrant.side_effect = None
+            queryGrant.reset_mock()
+            mysql_grants_generator.grantAccess(self.autoGrantConfig, grantDict, False, True, False, False,
+                                               batchSize=1, checkpointStore=checkpointStore, resume=True)
+            # neither the finished cluster nor the finished users of the failed one run again
+            self.assertEquals(["user2@%"], [x[0][0] for x in queryGrant.call_args_list])
+        finally:
+            mysql_grants_generator.mysql_query_tool.MysqlQueryTool.rollbackTransaction = self._unmockedQueryToolRollbackTrans
+            checkpointStore.close()
+            shutil.rmtree(statePath)
+
+    def test_findUsersToDrop(self):
+        self.yamlDict['mysql_user_filter'] = ["root@localhost", "repl_.*@%"]
+        self.autoGrantConfig.overrideYamlDictForTests(self.yamlDict)
+        allMysqlUsers = set(["root@localhost", "repl_1@%", "user2@%", "stale2@%", "stale1@host1"])
+        self.assertEquals(["stale1@host1", "stale2@%"],
+                          mysql_grants_generator.findUsersToDrop(self.autoGrantConfig, allMysqlUsers, ["user2@%"]))
+
     def test_updateMysqlUser(self):
         qal = mysql_grants_generator.mysql_query_tool.QAL_NONE
         mysqlConn = mysql_grants_generator.mysql_query_tool.MysqlQueryTool("cluster", "user", "pass", qal, qal)
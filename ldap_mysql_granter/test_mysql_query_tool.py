@@ -6,13 +6,16 @@ test_mysql_query_tool are the test associated with the mysql_query_tool
  author:   Nicholas Flink <nicholas@sproutsocial.com>
 """
 
+import echo_script
 import logging
 import mock
 import mysql_query_tool
+import privilege_mask
 import unittest
 logging.basicConfig(level=logging.CRITICAL)
 logger = logging.getLogger(__name__)
 ALL_PRIVS_USER = "allprivs"
+READER_USER = "reader"
 
 
 class FakeMysqlCursor(object):
@@ -20,13 +23,33 @@ class FakeMysqlCursor(object):
         self._lastQuery = None
         self._lastQArgs = None
         self._closed = False
+        self._deniedTables = []
+        self._executed = []
+        self._failingStatement = None
+        self._resultSets = []
 
     def close(self):
         self._closed = True
 
-    def execute(self, query, qArgs):
+    def execute(self, query, qArgs=None):
         self._lastQuery = query
         self._lastQArgs = qArgs
+        self._executed.append(query)
+        for table in self._deniedTables:
+            if table in query:
+                raise mysql_query_tool.MySQLdb.Error("SELECT command denied on table " + table)
+        self._resultSets = query.split(";\n")
+        self.nextset()
+
+    def nextset(self):
+        """walks the statements of a multi statement query like MySQLdb does"""
+        if len(self._resultSets) == 0:
+            return None
+        statement = self._resultSets.pop(0)
+        if statement == self._failingStatement:
+            self._resultSets = []
+            raise mysql_query_tool.MySQLdb.Error("denied: " + statement)
+        return 1
 
     def fetchall(self):
         callDict = {self._lastQuery: self._lastQArgs}
@@ -34,11 +57,35 @@ class FakeMysqlCursor(object):
         if self._lastQuery == "SELECT User, Host FROM mysql.user":
                 results = tuple([{'Host': '%', 'User': 'grant_bot'},
                                  {'Host': '%', 'User': 'revert_bot'}])
+        elif self._lastQuery == "SELECT * FROM mysql.user":
+            results = tuple([{'Host': 'localhost', 'User': ALL_PRIVS_USER, 'Password': '*DEADBEEF',
+                              'Select_priv': 'Y', 'Insert_priv': 'Y', 'Grant_priv': 'Y'},
+                             {'Host': '%', 'User': READER_USER, 'Password': '*CAFEBABE',
+                              'Select_priv': 'N', 'Insert_priv': 'N', 'Grant_priv': 'N'}])
+        elif self._lastQuery == "SELECT * FROM mysql.db":
+            results = tuple([{'Host': '%', 'User': READER_USER, 'Db': 'aDB',
+                              'Select_priv': 'Y', 'Insert_priv': 'N', 'Grant_priv': 'N'}])
+        elif self._lastQuery.startswith("SELECT User, Host, Db, Table_name, Table_priv FROM mysql.tables_priv"):
+            results = tuple([{'Host': '%', 'User': READER_USER, 'Db': 'bDB',
+                              'Table_name': 'bTable', 'Table_priv': 'Select,Update'}])
+        elif self._lastQuery.startswith("SELECT User, Host, Db, Table_name, Column_name, Column_priv FROM mysql.columns_priv"):
+            results = tuple([{'Host': '%', 'User': READER_USER, 'Db': 'bDB', 'Table_name': 'bTable',
+                              'Column_name': 'bColumn', 'Column_priv': 'Insert'}])
+        elif self._lastQuery.startswith("SELECT User, Host, Db, Routine_name, Routine_type, Proc_priv FROM mysql.procs_priv"):
+            results = tuple([{'Host': '%', 'User': READER_USER, 'Db': 'bDB', 'Routine_name': 'bProc',
+                              'Routine_type': 'PROCEDURE', 'Proc_priv': 'Execute'}])
+        elif self._lastQuery.startswith("SELECT FROM_USER, FROM_HOST, TO_USER, TO_HOST FROM mysql.role_edges"):
+            results = tuple([{'FROM_USER': 'readers', 'FROM_HOST': '%', 'TO_USER': READER_USER, 'TO_HOST': '%'}])
         elif self._lastQuery.startswith("SHOW GRANTS FOR"):
             user, host = self._lastQArgs
             userAtHost = user+"@"+host
             if user == ALL_PRIVS_USER:
                 results = tuple([{"Grants for "+userAtHost: "GRANT ALL PRIVILEGES ON *.* TO '"+user+"'@'"+host+"' IDENTIFIED BY PASSWORD '*DEADBEEFDEADBEEFDEADBEEFDEADBEEFDEADBEEF' WITH GRANT OPTION"}])
+            elif user == READER_USER:
+                results = tuple([{"Grants for "+userAtHost: "GRANT USAGE ON *.* TO `"+user+"`@`"+host+"`"},
+                                 {"Grants for "+userAtHost: "GRANT SELECT ON `aDB`.* TO `"+user+"`@`"+host+"`"},
+                                 {"Grants for "+userAtHost: "GRANT SELECT, UPDATE, INSERT (`bColumn`) ON `bDB`.`bTable` TO `"+user+"`@`"+host+"`"},
+                                 {"Grants for "+userAtHost: "GRANT EXECUTE ON PROCEDURE `bDB`.`bProc` TO `"+user+"`@`"+host+"`"}])
         return results
 
 
@@ -63,6 +110,9 @@ class FakeMysqlConnection(object):
     def cursor(self, curType):
         return FakeMysqlCursor()
 
+    def literal(self, value):
+        return "'%s'" % value
+
 
 class TestMysqlQueryTool(unittest.TestCase):
 
@@ -80,6 +130,7 @@ class TestMysqlQueryTool(unittest.TestCase):
         self._mysqlQueryTool = mysql_query_tool.MysqlQueryTool(self._cluster, self._username, self._password, echoAccessLevel, queryAccessLevel, self._logPasswords)
         self._mysqlQueryTool.getCursor = mock.MagicMock(
             return_value=self._fakeCursor)
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=8.0)
 
     def test_closeConnection(self):
         self._mysqlQueryTool.closeConnection()
@@ -92,6 +143,33 @@ class TestMysqlQueryTool(unittest.TestCase):
         expectedQuery = "mysql -h "+self._cluster+" -u "+self._username+" -p"+self._password+' -e "SHOW GRANTS FOR \'test\'@\'%\'"'
         self.assertEquals(expectedQuery, cmdLineQuery)
 
+    def test_echoScript(self):
+        echoScript = echo_script.EchoScript()
+        echoTool = mysql_query_tool.MysqlQueryTool(self._cluster, self._username, self._password,
+                                                   mysql_query_tool.QAL_ALL, mysql_query_tool.QAL_READ,
+                                                   self._logPasswords)
+        echoTool.setEchoScript(echoScript)
+        echoTool.queryMySQL(mysql_query_tool.QAL_READ_WRITE, "GRANT SELECT ON *.* TO %s@%s", ("test", "%"))
+        echoTool.queryFlushPrivileges()
+        self.assertEquals(["GRANT SELECT ON *.* TO 'test'@'%';", "FLUSH PRIVILEGES;"],
+                          echoScript.getStatements(self._cluster))
+        self.assertTrue(echoScript.getSql(self._cluster).startswith("-- cluster: cluster\n"))
+
+    def test_echoScriptRecorded(self):
+        # a plan made with --echo-format=sql must hold the scripted statements
+        echoScript = echo_script.EchoScript()
+        recorded = []
+        echoTool = mysql_query_tool.MysqlQueryTool(self._cluster, self._username, self._password,
+                                                   mysql_query_tool.QAL_ALL, mysql_query_tool.QAL_READ,
+                                                   self._logPasswords)
+        echoTool.setEchoScript(echoScript)
+        echoTool.setStatementRecorder(lambda accessLevel, query, qArgs:
+                                      recorded.append((accessLevel, query, qArgs)))
+        echoTool.queryMySQL(mysql_query_tool.QAL_READ_WRITE, "GRANT SELECT ON *.* TO %s@%s", ("test", "%"))
+        self.assertEquals(["GRANT SELECT ON *.* TO 'test'@'%';"], echoScript.getStatements(self._cluster))
+        self.assertEquals([(mysql_query_tool.QAL_READ_WRITE, "GRANT SELECT ON *.* TO %s@%s", ("test", "%"))],
+                          recorded)
+
     def test_transactions(self):
         # test successful transaction
         self.assertEquals(0, self._fakeConnection._commits)
@@ -128,7 +206,18 @@ class TestMysqlQueryTool(unittest.TestCase):
 
     def test_queryUserGrants(self):
         result = self._mysqlQueryTool.queryUserGrants(ALL_PRIVS_USER+"@localhost")
-        self.assertDictEqual({'*.*': set(['ALL PRIVILEGES'])}, result)
+        self.assertDictEqual({'*.*': set(['ALL PRIVILEGES', 'GRANT OPTION'])}, result)
+
+    def test_parseGrantLine(self):
+        self.assertEquals(('db.t', set(['INSERT', 'GRANT OPTION']), {'a': set(['SELECT']), 'b': set(['SELECT'])}, []),
+                          mysql_query_tool.parseGrantLine("GRANT SELECT (`a`, `b`), INSERT ON `db`.`t` TO `u`@`%` WITH GRANT OPTION"))
+        self.assertEquals(('*.*', set(['SELECT', 'INSERT']), {}, []),
+                          mysql_query_tool.parseGrantLine("GRANT SELECT,INSERT ON *.* TO 'u'@'%' WITH MAX_QUERIES_PER_HOUR 5"))
+        self.assertEquals(('PROCEDURE db.p', set(['EXECUTE']), {}, []),
+                          mysql_query_tool.parseGrantLine("GRANT EXECUTE ON PROCEDURE `db`.`p` TO 'u'@'%'"))
+        self.assertEquals((None, set(), {}, ['r1@%', 'r2@localhost']),
+                          mysql_query_tool.parseGrantLine("GRANT `r1`@`%`,`r2`@`localhost` TO `u`@`%`"))
+        self.assertEquals(None, mysql_query_tool.parseGrantLine("GRANT PROXY ON ''@'' TO 'root'@'localhost' WITH GRANT OPTION"))
 
     def test_queryRevoke(self):
         allPrivsUserAtHost = ALL_PRIVS_USER+"@localhost"
@@ -141,9 +230,304 @@ class TestMysqlQueryTool(unittest.TestCase):
         dbTable = "*.*"
         privileges = ["SELECT"]
         grantDeltaDict = self._mysqlQueryTool.getGrantDeltaDict(userAtHost, dbTable, privileges)
-        expectedGrantDeltaDict = {'grants': set([]),
-                                  'revokes': self._mysqlQueryTool.getAllPrivileges() - set(privileges)}
+        # GRANT OPTION is not revoked when the config does not list it
+        expectedGrantDeltaDict = {'grants': 0,
+                                  'revokes': (privilege_mask.toMask(["ALL PRIVILEGES"], dbTable) &
+                                              ~privilege_mask.toMask(privileges, dbTable))}
         self.assertDictEqual(expectedGrantDeltaDict, grantDeltaDict)
+        grantDeltaDict = self._mysqlQueryTool.getGrantDeltaDict(userAtHost, dbTable, ["ALL PRIVILEGES", "GRANT OPTION"])
+        self.assertDictEqual({'grants': 0, 'revokes': 0}, grantDeltaDict)
+        # it is still granted when the config lists it
+        self._mysqlQueryTool.userExists = mock.MagicMock(return_value=False)
+        grantDeltaDict = self._mysqlQueryTool.getGrantDeltaDict("new@%", dbTable, ["SELECT", "GRANT OPTION"])
+        self.assertEquals(privilege_mask.toMask(["SELECT", "GRANT OPTION"]), grantDeltaDict['grants'])
+
+    def test_getGrantDeltaDictBeforeRoles(self):
+        # 5.x does not know CREATE ROLE or DROP ROLE so they are never revoked or granted
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=5.7)
+        userAtHost = ALL_PRIVS_USER+'@localhost'
+        grantDeltaDict = self._mysqlQueryTool.getGrantDeltaDict(userAtHost, "*.*", ["SELECT"])
+        self.assertEquals(0, grantDeltaDict['revokes'] & privilege_mask.ROLE_MASK)
+        self._mysqlQueryTool.queryRevoke(userAtHost, grantDeltaDict['revokes'], "*.*")
+        self.assertNotIn("ROLE", self._fakeCursor._lastQuery)
+
+    def test_loadGrantSnapshot(self):
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=5.5)
+        snapshot = self._mysqlQueryTool.loadGrantSnapshot()
+        self.assertEquals(set([ALL_PRIVS_USER+'@localhost', READER_USER+'@%']), snapshot.getAllUsers())
+        self.assertEquals('*CAFEBABE', self._mysqlQueryTool.getPasswordHash(READER_USER, '%'))
+        self.assertTrue(self._mysqlQueryTool.userExists(ALL_PRIVS_USER, 'localhost'))
+        self.assertFalse(self._mysqlQueryTool.userExists('nobody', '%'))
+        self.assertDictEqual({'*.*': set(['ALL PRIVILEGES', 'GRANT OPTION'])},
+                             snapshot.getUserGrants("'"+ALL_PRIVS_USER+"'@'localhost'"))
+        self.assertDictEqual({'*.*': set(['USAGE']),
+                              'aDB.*': set(['SELECT']),
+                              'bDB.bTable': set(['SELECT', 'UPDATE']),
+                              'PROCEDURE bDB.bProc': set(['EXECUTE'])},
+                             snapshot.getUserGrants(READER_USER+'@%'))
+        self.assertDictEqual({'bDB.bTable': {'bColumn': set(['INSERT'])}},
+                             snapshot.getColumnGrants(READER_USER+'@%'))
+        # the grant tables are read once for the whole cluster
+        self.assertFalse(self._fakeCursor._lastQuery.startswith("SHOW GRANTS"))
+
+    def test_loadGrantSnapshotRoles(self):
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=8.0)
+        snapshot = self._mysqlQueryTool.loadGrantSnapshot()
+        self.assertEquals(set(['readers@%']), snapshot.getRoles(READER_USER+'@%'))
+        self.assertEquals(set(), snapshot.getRoles(ALL_PRIVS_USER+'@localhost'))
+
+    def test_loadGrantSnapshotFallback(self):
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=5.5)
+        expectedSnapshot = self._mysqlQueryTool.loadGrantSnapshot()
+        self._fakeCursor._deniedTables = ["mysql.tables_priv", "mysql.columns_priv"]
+        snapshot = self._mysqlQueryTool.loadGrantSnapshot()
+        for userAtHost in expectedSnapshot.getAllUsers():
+            self.assertDictEqual(expectedSnapshot.getUserGrants(userAtHost), snapshot.getUserGrants(userAtHost))
+            self.assertDictEqual(expectedSnapshot.getColumnGrants(userAtHost), snapshot.getColumnGrants(userAtHost))
+        self.assertEquals(expectedSnapshot.getFingerprint(), snapshot.getFingerprint())
+
+    def test_grantSnapshotRecords(self):
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=8.0)
+        snapshot = self._mysqlQueryTool.loadGrantSnapshot()
+        recordList = snapshot.toRecords()
+        self.assertEquals([ALL_PRIVS_USER+'@localhost', READER_USER+'@%'], [x['user'] for x in recordList])
+        self.assertEquals(['ALL PRIVILEGES', 'GRANT OPTION'], recordList[0]['grants']['*.*'])
+        restoredSnapshot = mysql_query_tool.GrantSnapshot.fromRecords(recordList)
+        self.assertEquals(snapshot.getFingerprint(), restoredSnapshot.getFingerprint())
+
+    def test_restoreGrantSnapshot(self):
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=5.5)
+        savedSnapshot = mysql_query_tool.GrantSnapshot.fromRecords(self._mysqlQueryTool.loadGrantSnapshot().toRecords())
+        savedSnapshot.dropUser(ALL_PRIVS_USER+'@localhost')
+        savedSnapshot.addUser("new@%", "*0123")
+        savedSnapshot.addGrants("new@%", "cDB.*", ["SELECT"])
+        savedSnapshot.addGrants(READER_USER+'@%', "aDB.*", ["INSERT"])
+        savedSnapshot.removeGrants(READER_USER+'@%', "bDB.bTable", ["UPDATE"])
+        savedSnapshot.addColumnGrants(READER_USER+'@%', "bDB.bTable", "bColumn", ["SELECT"])
+        echoScript = echo_script.EchoScript()
+        echoTool = mysql_query_tool.MysqlQueryTool(self._cluster, self._username, self._password,
+                                                   mysql_query_tool.QAL_ALL, mysql_query_tool.QAL_READ,
+                                                   self._logPasswords)
+        echoTool.getCursor = mock.MagicMock(return_value=self._fakeCursor)
+        echoTool.getVersion = mock.MagicMock(return_value=5.5)
+        echoTool.setEchoScript(echoScript)
+        echoTool.restoreGrantSnapshot(savedSnapshot)
+        # only what differs from the live grants is touched
+        self.assertEquals(["DROP USER 'allprivs'@'localhost';",
+                           "CREATE USER 'new'@'%' IDENTIFIED BY PASSWORD '*0123';",
+                           "GRANT SELECT ON cDB.* TO 'new'@'%';",
+                           "GRANT INSERT ON aDB.* TO 'reader'@'%';",
+                           "REVOKE UPDATE ON bDB.bTable FROM 'reader'@'%';",
+                           "GRANT SELECT (`bColumn`) ON bDB.bTable TO 'reader'@'%';"],
+                          echoScript.getStatements(self._cluster))
+
+    def test_restoreGrantSnapshotUserList(self):
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=5.5)
+        savedSnapshot = mysql_query_tool.GrantSnapshot.fromRecords(self._mysqlQueryTool.loadGrantSnapshot().toRecords())
+        savedSnapshot.dropUser(ALL_PRIVS_USER+'@localhost')
+        savedSnapshot.addUser("new@%", "*0123")
+        savedSnapshot.addGrants(READER_USER+'@%', "aDB.*", ["INSERT"])
+        echoScript = echo_script.EchoScript()
+        echoTool = mysql_query_tool.MysqlQueryTool(self._cluster, self._username, self._password,
+                                                   mysql_query_tool.QAL_ALL, mysql_query_tool.QAL_READ,
+                                                   self._logPasswords)
+        echoTool.getCursor = mock.MagicMock(return_value=self._fakeCursor)
+        echoTool.getVersion = mock.MagicMock(return_value=5.5)
+        echoTool.setEchoScript(echoScript)
+        echoTool.restoreGrantSnapshot(savedSnapshot, 100, [READER_USER])
+        # accounts of other users are left as they are
+        self.assertEquals(["GRANT INSERT ON aDB.* TO 'reader'@'%';"], echoScript.getStatements(self._cluster))
+
+    def test_journalInverses(self):
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=5.5)
+        self._mysqlQueryTool.loadGrantSnapshot()
+        journal = mock.MagicMock()
+        self._mysqlQueryTool.setJournal(journal)
+        self._mysqlQueryTool.queryGrant(READER_USER+'@%', ['SELECT', 'INSERT'], 'aDB.*')
+        self._mysqlQueryTool.queryRevoke(READER_USER+'@%', ['UPDATE', 'DELETE'], 'bDB.bTable')
+        self._mysqlQueryTool.createUser("new@%", "*0123", True)
+        self._mysqlQueryTool.dropUsers([ALL_PRIVS_USER+'@localhost'], 100)
+        self._mysqlQueryTool.setPasswordHash(READER_USER+'@%', "*0456")
+        self._mysqlQueryTool.queryFlushPrivileges()
+        # only what each statement changed is undone
+        self.assertEquals([[(mysql_query_tool.QAL_READ_WRITE_DELETE, "REVOKE INSERT ON aDB.* FROM %s@%s", (READER_USER, '%'))],
+                           [(mysql_query_tool.QAL_READ_WRITE, "GRANT UPDATE ON bDB.bTable TO %s@%s", (READER_USER, '%'))],
+                           [(mysql_query_tool.QAL_READ_WRITE_DELETE, "DROP USER %s@%s", ("new", '%'))],
+                           [(mysql_query_tool.QAL_READ_WRITE, "CREATE USER %s@%s IDENTIFIED BY PASSWORD %s",
+                             (ALL_PRIVS_USER, 'localhost', '*DEADBEEF')),
+                            (mysql_query_tool.QAL_READ_WRITE, "GRANT ALL PRIVILEGES, GRANT OPTION ON *.* TO %s@%s",
+                             (ALL_PRIVS_USER, 'localhost'))],
+                           [(mysql_query_tool.QAL_READ_WRITE, "SET PASSWORD FOR %s@%s = %s", (READER_USER, '%', '*CAFEBABE'))]],
+                          [x[0][4] for x in journal.append.call_args_list])
+        # each statement is synced before it is sent
+        self.assertEquals(5, journal.sync.call_count)
+
+    def test_journalBatch(self):
+        batchingTool = self.makeBatchingTool(10)
+        batchingTool.setGrantSnapshot(mysql_query_tool.GrantSnapshot())
+        journal = mock.MagicMock()
+        batchingTool.setJournal(journal)
+        batchingTool.queryGrant("a@%", ["SELECT"], "aDB.*")
+        batchingTool.queryGrant("b@%", ["SELECT"], "aDB.*")
+        batchingTool.setStatementOwner("c@%")
+        batchingTool.queryGrant("c@%", ["SELECT"], "aDB.*")
+        batchingTool.rollbackTransaction()
+        # queued statements are only journaled once they are about to be sent
+        self.assertEquals(0, journal.append.call_count)
+        batchingTool.finishStatements()
+        # one fsync covers the whole batch and the statements rolled back are not in it
+        self.assertEquals(1, journal.sync.call_count)
+        self.assertEquals([("a", "%"), ("b", "%")], [x[0][3] for x in journal.append.call_args_list])
+
+    def test_undoJournal(self):
+        entryList = [{'users': [READER_USER+'@%'], 'statement': [mysql_query_tool.QAL_READ_WRITE, "GRANT", []],
+                      'inverse': [[mysql_query_tool.QAL_READ_WRITE_DELETE, "REVOKE INSERT ON aDB.* FROM %s@%s",
+                                   [READER_USER, '%']]]},
+                     {'users': ["new@%"], 'statement': [mysql_query_tool.QAL_READ_WRITE, "CREATE USER", []],
+                      'inverse': [[mysql_query_tool.QAL_READ_WRITE_DELETE, "DROP USER %s@%s", ["new", '%']]]},
+                     {'users': [READER_USER+'@%'], 'statement': [mysql_query_tool.QAL_READ_WRITE, "SET PASSWORD", []],
+                      'inverse': [[mysql_query_tool.QAL_READ_WRITE, "SET PASSWORD FOR %s@%s = %s",
+                                   [READER_USER, '%', '*CAFEBABE']]]}]
+        echoScript = echo_script.EchoScript()
+        echoTool = mysql_query_tool.MysqlQueryTool(self._cluster, self._username, self._password,
+                                                   mysql_query_tool.QAL_ALL, mysql_query_tool.QAL_READ,
+                                                   self._logPasswords)
+        echoTool.setEchoScript(echoScript)
+        echoTool.undoJournal(entryList, [READER_USER])
+        self.assertEquals(["SET PASSWORD FOR 'reader'@'%' = '*CAFEBABE';",
+                           "REVOKE INSERT ON aDB.* FROM 'reader'@'%';"],
+                          echoScript.getStatements(self._cluster))
+
+    def test_undoJournalMissingGrant(self):
+        missingGrant = mysql_query_tool.MySQLdb.Error(1141, "There is no such grant defined")
+        self._mysqlQueryTool.queryMySQL = mock.MagicMock(side_effect=missingGrant)
+        entry = {'users': [READER_USER+'@%'], 'statement': [mysql_query_tool.QAL_READ_WRITE, "GRANT", []],
+                 'inverse': [[mysql_query_tool.QAL_READ_WRITE_DELETE, "REVOKE INSERT ON aDB.* FROM %s@%s",
+                              [READER_USER, '%']]], 'sent': False}
+        # a statement that may never have run is allowed to leave nothing to undo
+        self._mysqlQueryTool.undoJournal([entry])
+        entry['sent'] = True
+        with self.assertRaises(mysql_query_tool.MySQLdb.Error):
+            self._mysqlQueryTool.undoJournal([entry])
+        entry['sent'] = False
+        self._mysqlQueryTool.queryMySQL.side_effect = mysql_query_tool.MySQLdb.Error(1045, "Access denied")
+        with self.assertRaises(mysql_query_tool.MySQLdb.Error):
+            self._mysqlQueryTool.undoJournal([entry])
+
+    def test_getGrantDeltaDictFromSnapshot(self):
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=5.5)
+        self._mysqlQueryTool.loadGrantSnapshot()
+        self._fakeCursor._lastQuery = None
+        grantDeltaDict = self._mysqlQueryTool.getGrantDeltaDict(READER_USER+'@%', 'bDB.bTable', ['SELECT', 'INSERT'])
+        self.assertDictEqual({'grants': privilege_mask.toMask(['INSERT']),
+                              'revokes': privilege_mask.toMask(['UPDATE'])}, grantDeltaDict)
+        # the delta is computed without another round trip
+        self.assertEquals(None, self._fakeCursor._lastQuery)
+        # executed statements keep the snapshot current
+        self._mysqlQueryTool.queryGrant(READER_USER+'@%', ['INSERT'], 'bDB.bTable')
+        self._mysqlQueryTool.queryRevoke(READER_USER+'@%', ['UPDATE'], 'bDB.bTable')
+        grantDeltaDict = self._mysqlQueryTool.getGrantDeltaDict(READER_USER+'@%', 'bDB.bTable', ['SELECT', 'INSERT'])
+        self.assertDictEqual({'grants': 0, 'revokes': 0}, grantDeltaDict)
+        self._mysqlQueryTool.dropUser(READER_USER+'@%')
+        self.assertFalse(self._mysqlQueryTool.userExists(READER_USER, '%'))
+
+    def makeBatchingTool(self, batchSize):
+        batchingTool = mysql_query_tool.MysqlQueryTool(self._cluster, self._username, self._password,
+                                                       mysql_query_tool.QAL_ALL, mysql_query_tool.QAL_ALL,
+                                                       self._logPasswords, '', batchSize)
+        batchingTool.getCursor = mock.MagicMock(return_value=self._fakeCursor)
+        batchingTool.getVersion = mock.MagicMock(return_value=8.0)
+        return batchingTool
+
+    def test_batchStatements(self):
+        batchingTool = self.makeBatchingTool(2)
+        batchingTool.setStatementOwner("user1@%")
+        batchingTool.queryGrant("user1@%", ["SELECT"], "aDB.*")
+        batchingTool.queryFlushPrivileges()
+        self.assertEquals([], self._fakeCursor._executed)
+        batchingTool.queryRevoke("user1@%", ["INSERT"], "bDB.*")
+        # a full batch is sent in one round trip
+        self.assertEquals(["GRANT SELECT ON aDB.* TO 'user1'@'%';\nREVOKE INSERT ON bDB.* FROM 'user1'@'%'"],
+                          self._fakeCursor._executed)
+        batchingTool.setStatementOwner("user2@%")
+        batchingTool.queryGrant("user2@%", ["SELECT"], "*.*")
+        self.assertEquals(1, batchingTool.getPendingCount())
+        # a read sends the queue first so it sees the writes
+        batchingTool.queryVersion()
+        self.assertEquals(["GRANT SELECT ON *.* TO 'user2'@'%'", "SELECT VERSION()"],
+                          self._fakeCursor._executed[1:])
+        # grants reload the privileges themselves so the requested flush is not sent
+        batchingTool.finishStatements()
+        self.assertEquals(3, len(self._fakeCursor._executed))
+
+    def test_batchStatementsFlushOnce(self):
+        batchingTool = self.makeBatchingTool(10)
+        batchingTool.queryMySQL(mysql_query_tool.QAL_READ_WRITE,
+                                "UPDATE mysql.user SET plugin = %s WHERE User = %s", ("x", "user1"))
+        batchingTool.queryFlushPrivileges()
+        batchingTool.queryMySQL(mysql_query_tool.QAL_READ_WRITE,
+                                "UPDATE mysql.user SET plugin = %s WHERE User = %s", ("x", "user2"))
+        batchingTool.queryFlushPrivileges()
+        batchingTool.finishStatements()
+        self.assertEquals(["UPDATE mysql.user SET plugin = 'x' WHERE User = 'user1';\n"
+                           "UPDATE mysql.user SET plugin = 'x' WHERE User = 'user2'",
+                           "FLUSH PRIVILEGES"], self._fakeCursor._executed)
+
+    def test_batchStatementsFailure(self):
+        batchingTool = self.makeBatchingTool(4)
+        for user in ["user1", "user2", "user3"]:
+            batchingTool.setStatementOwner(user + "@%")
+            batchingTool.queryGrant(user + "@%", ["SELECT"], "*.*")
+        self._fakeCursor._failingStatement = "GRANT SELECT ON *.* TO 'user2'@'%'"
+        with self.assertRaises(mysql_query_tool.StatementBatchException) as context:
+            batchingTool.finishStatements()
+        self.assertEquals("user2@%", context.exception.owner)
+        self.assertEquals(0, batchingTool.getPendingCount())
+        # the statements of a failed user are dropped on rollback while the others stay queued
+        batchingTool.setStatementOwner("user4@%")
+        batchingTool.queryGrant("user4@%", ["SELECT"], "*.*")
+        batchingTool.setStatementOwner("user5@%")
+        batchingTool.queryGrant("user5@%", ["SELECT"], "*.*")
+        batchingTool.rollbackTransaction()
+        self.assertEquals(1, batchingTool.getPendingCount())
+
+    def test_batchStatementsFailureRedacted(self):
+        batchingTool = mysql_query_tool.MysqlQueryTool(self._cluster, self._username, self._password,
+                                                       mysql_query_tool.QAL_ALL, mysql_query_tool.QAL_ALL,
+                                                       False, '', 4)
+        batchingTool.getCursor = mock.MagicMock(return_value=self._fakeCursor)
+        batchingTool.setStatementOwner("user1@%")
+        batchingTool.queryMySQL(mysql_query_tool.QAL_READ_WRITE, mysql_query_tool.SET_PASSWORD_QUERY,
+                                ("user1", "%", "secret"))
+        self._fakeCursor._failingStatement = "SET PASSWORD FOR 'user1'@'%' = 'secret'"
+        with self.assertRaises(mysql_query_tool.StatementBatchException) as context:
+            batchingTool.finishStatements()
+        self.assertEquals("SET PASSWORD FOR user1@% = REDACTED", context.exception.statement)
+        self.assertEquals("CREATE USER u@% IDENTIFIED BY REDACTED",
+                          batchingTool.getPrintableQuery("CREATE USER %s@%s IDENTIFIED BY %s", ("u", "%", "pw")))
+        self.assertEquals("CREATE USER u@% IDENTIFIED BY pw",
+                          self._mysqlQueryTool.getPrintableQuery("CREATE USER %s@%s IDENTIFIED BY %s", ("u", "%", "pw")))
+
+    def test_batchCreateUserRetry(self):
+        batchingTool = self.makeBatchingTool(10)
+        batchingTool.queryGrant("user1@%", ["SELECT"], "*.*")
+        # a leftover account fails the create which drops it and creates it again
+        self._fakeCursor._failingStatement = "CREATE USER %s@%s IDENTIFIED BY PASSWORD %s"
+        originalExecute = self._fakeCursor.execute
+
+        def failOnce(query, qArgs=None):
+            try:
+                originalExecute(query, qArgs)
+            finally:
+                if query.startswith("CREATE USER"):
+                    self._fakeCursor._failingStatement = None
+        self._fakeCursor.execute = failOnce
+        batchingTool.createUser("user2@%", "*HASH", True)
+        self.assertEquals(["GRANT SELECT ON *.* TO 'user1'@'%'",
+                           "CREATE USER %s@%s IDENTIFIED BY PASSWORD %s",
+                           "DROP USER 'user2'@'%'",
+                           "CREATE USER %s@%s IDENTIFIED BY PASSWORD %s"], self._fakeCursor._executed)
+        self.assertEquals(0, batchingTool.getPendingCount())
 
     def test_findAllUsers(self):
         allUserDict = self._mysqlQueryTool.findAllUsers()
@@ -167,6 +551,14 @@ class TestMysqlQueryTool(unittest.TestCase):
         self.assertEquals("DROP USER %s@%s", self._fakeCursor._lastQuery)
         self.assertItemsEqual(("user", "host"), self._fakeCursor._lastQArgs)
 
+    def test_dropUsers(self):
+        self._mysqlQueryTool.getVersion = mock.MagicMock(return_value=5.5)
+        self._mysqlQueryTool.loadGrantSnapshot()
+        self._fakeCursor._executed = []
+        self._mysqlQueryTool.dropUsers(["a@%", "'b'@'host'", READER_USER+'@%'], 2)
+        self.assertEquals(["DROP USER %s@%s, %s@%s", "DROP USER %s@%s"], self._fakeCursor._executed)
+        self.assertItemsEqual((READER_USER, "%"), self._fakeCursor._lastQArgs)
+        self.assertFalse(self._mysqlQueryTool.userExists(READER_USER, '%'))
 
 class TestMysqlQueryToolMain(unittest.TestCase):
     def setUp(self):
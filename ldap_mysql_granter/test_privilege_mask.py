@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_privilege_mask are the tests associated with the privilege_mask
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import logging
+import privilege_mask
+import unittest
+logging.basicConfig(level=logging.CRITICAL)
+logger = logging.getLogger(__name__)
+
+
+class TestPrivilegeMask(unittest.TestCase):
+
+    def test_getLevel(self):
+        self.assertEquals(privilege_mask.LEVEL_GLOBAL, privilege_mask.getLevel("*.*"))
+        self.assertEquals(privilege_mask.LEVEL_DATABASE, privilege_mask.getLevel("aDB.*"))
+        self.assertEquals(privilege_mask.LEVEL_TABLE, privilege_mask.getLevel("aDB.aTable"))
+
+    def test_toMask(self):
+        selectInsert = privilege_mask.toMask(["SELECT", "INSERT"])
+        self.assertEquals(selectInsert, privilege_mask.toMask(["insert", "select", "blah"]))
+        self.assertEquals(selectInsert, privilege_mask.toMask(set(["SELECT", "INSERT"]), "aDB.*"))
+        self.assertEquals(selectInsert, privilege_mask.toMask(selectInsert))
+        self.assertEquals(privilege_mask.toMask(["SELECT"]), privilege_mask.toMask("select"))
+        self.assertEquals(0, privilege_mask.toMask(["USAGE"]))
+
+    def test_allPrivilegesByLevel(self):
+        tableAll = privilege_mask.toMask(["ALL PRIVILEGES"], "aDB.aTable")
+        self.assertEquals(privilege_mask.TABLE_PRIVILEGES, privilege_mask.toNames(tableAll, "*.*"))
+        self.assertEquals(tableAll, privilege_mask.toMask(list(privilege_mask.TABLE_PRIVILEGES), "aDB.aTable"))
+        globalAll = privilege_mask.toMask(["ALL PRIVILEGES"])
+        self.assertFalse(globalAll & privilege_mask.toMask(["GRANT OPTION"]))
+        self.assertTrue(globalAll & privilege_mask.toMask(["SUPER"]))
+        self.assertFalse(privilege_mask.toMask(["ALL PRIVILEGES"], "aDB.*") & privilege_mask.toMask(["SUPER"]))
+
+    def test_render(self):
+        self.assertEquals("INSERT, SELECT", privilege_mask.render(privilege_mask.toMask(["SELECT", "INSERT"])))
+        self.assertEquals("USAGE", privilege_mask.render(0))
+        allGrant = privilege_mask.toMask(["ALL PRIVILEGES", "GRANT OPTION"], "aDB.*")
+        self.assertEquals("ALL PRIVILEGES, GRANT OPTION", privilege_mask.render(allGrant, "aDB.*"))
+        self.assertEquals(set(["ALL PRIVILEGES", "GRANT OPTION"]), privilege_mask.toNames(allGrant, "aDB.*"))
+
+    def test_renderByVersion(self):
+        globalAll = privilege_mask.toMask(["ALL PRIVILEGES"])
+        self.assertEquals("ALL PRIVILEGES", privilege_mask.render(globalAll, "*.*", 5.7))
+        allButSelect = globalAll & ~privilege_mask.toMask(["SELECT"])
+        self.assertFalse(privilege_mask.ROLE_PRIVILEGES & privilege_mask.toNames(allButSelect, "*.*", 5.7))
+        self.assertTrue(privilege_mask.ROLE_PRIVILEGES <= privilege_mask.toNames(allButSelect, "*.*", 8.0))
+        self.assertEquals("USAGE", privilege_mask.render(privilege_mask.ROLE_MASK, "*.*", 5.5))
+        self.assertEquals(0, privilege_mask.getSupportedMask(privilege_mask.ROLE_MASK, 5.7))
+        self.assertEquals(privilege_mask.ROLE_MASK, privilege_mask.getSupportedMask(privilege_mask.ROLE_MASK))
+
+    def test_delta(self):
+        correctMask = privilege_mask.toMask(["SELECT", "INSERT"], "aDB.aTable")
+        currentMask = privilege_mask.toMask(["SELECT", "UPDATE"], "aDB.aTable")
+        self.assertEquals(set(["INSERT"]), privilege_mask.toNames(correctMask & ~currentMask))
+        self.assertEquals(set(["UPDATE"]), privilege_mask.toNames(currentMask & ~correctMask))
+
+
+if __name__ == '__main__':
+    unittest.main()
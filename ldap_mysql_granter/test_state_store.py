@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+test_state_store are the tests associated with the state_store
+ copyright:  2015, (c) sproutsocial.com
+ author:   Nicholas Flink <nicholas@sproutsocial.com>
+"""
+
+import logging
+import os
+import shutil
+import state_store
+import unittest
+logging.basicConfig(level=logging.CRITICAL)
+logger = logging.getLogger(__name__)
+
+
+class FakeGrantSnapshot(object):
+    """the parts of mysql_query_tool.GrantSnapshot the store reads"""
+
+    def __init__(self, fingerprint, userGrantDict):
+        self._fingerprint = fingerprint
+        self._userGrantDict = userGrantDict
+
+    def getFingerprint(self):
+        return self._fingerprint
+
+    def getUserGrants(self, userAtHost):
+        return dict(self._userGrantDict.get(userAtHost, {}))
+
+    def getPasswordHash(self, userAtHost):
+        if userAtHost in self._userGrantDict:
+            return "*HASH"
+        return None
+
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self):
+        self._statePath = "./testStateStore"
+        self._stateStore = state_store.GrantStateStore(os.path.join(self._statePath, "state.sqlite"))
+        self._userInputHashDict = {
+            "user1@%": state_store.hashUserInputs([{'db_table': '*.*', 'privileges': ['SELECT']}]),
+            "user2@%": state_store.hashUserInputs([{'db_table': 'aDB.*', 'privileges': ['INSERT']}])}
+        self._clusterInputHash = state_store.hashClusterInputs(self._userInputHashDict, False)
+        self._snapshot = FakeGrantSnapshot("abc123", {"user1@%": {'*.*': set(['SELECT'])},
+                                                      "user2@%": {'aDB.*': set(['INSERT'])}})
+
+    def tearDown(self):
+        self._stateStore.close()
+        if os.path.exists(self._statePath):
+            shutil.rmtree(self._statePath)
+
+    def test_hashUserInputs(self):
+        # privilege order and case do not change the digest
+        self.assertEquals(state_store.hashUserInputs([{'db_table': '*.*', 'privileges': ['SELECT', 'insert']}]),
+                          state_store.hashUserInputs([{'db_table': '*.*', 'privileges': ['INSERT', 'SELECT']}]))
+        self.assertNotEquals(state_store.hashUserInputs([{'db_table': '*.*', 'privileges': ['SELECT']}]),
+                             state_store.hashUserInputs([{'db_table': 'aDB.*', 'privileges': ['SELECT']}]))
+        self.assertNotEquals(state_store.hashClusterInputs(self._userInputHashDict, False),
+                             state_store.hashClusterInputs(self._userInputHashDict, True))
+
+    def test_getChangedUsersEmptyStore(self):
+        self.assertEquals(None, self._stateStore.getClusterState("cluster1"))
+        self.assertEquals(["user1@%", "user2@%"],
+                          sorted(self._stateStore.getChangedUsers("cluster1", self._snapshot,
+                                                                  self._userInputHashDict,
+                                                                  self._clusterInputHash)))
+
+    def test_getChangedUsersUnchanged(self):
+        self._stateStore.saveClusterState("cluster1", self._snapshot,
+                                          self._userInputHashDict, self._clusterInputHash)
+        self.assertEquals((self._clusterInputHash, "abc123"), self._stateStore.getClusterState("cluster1"))
+        self.assertEquals([], self._stateStore.getChangedUsers("cluster1", self._snapshot,
+                                                               self._userInputHashDict,
+                                                               self._clusterInputHash))
+        # other clusters are tracked separately
+        self.assertEquals(2, len(self._stateStore.getChangedUsers("cluster2", self._snapshot,
+                                                                  self._userInputHashDict,
+                                                                  self._clusterInputHash)))
+
+    def test_getChangedUsersInputChanged(self):
+        self._stateStore.saveClusterState("cluster1", self._snapshot,
+                                          self._userInputHashDict, self._clusterInputHash)
+        userInputHashDict = dict(self._userInputHashDict)
+        userInputHashDict["user2@%"] = state_store.hashUserInputs([{'db_table': 'aDB.*',
+                                                                    'privileges': ['INSERT', 'UPDATE']}])
+        clusterInputHash = state_store.hashClusterInputs(userInputHashDict, False)
+        self.assertEquals(["user2@%"], self._stateStore.getChangedUsers("cluster1", self._snapshot,
+                                                                        userInputHashDict,
+                                                                        clusterInputHash))
+
+    def test_getChangedUsersServerDrift(self):
+        self._stateStore.saveClusterState("cluster1", self._snapshot,
+                                          self._userInputHashDict, self._clusterInputHash)
+        driftedSnapshot = FakeGrantSnapshot("def456", {"user1@%": {'*.*': set(['SELECT', 'DELETE'])},
+                                                       "user2@%": {'aDB.*': set(['INSERT'])}})
+        self.assertEquals(["user1@%"], self._stateStore.getChangedUsers("cluster1", driftedSnapshot,
+                                                                        self._userInputHashDict,
+                                                                        self._clusterInputHash))
+
+    def test_saveClusterStateReplaces(self):
+        self._stateStore.saveClusterState("cluster1", self._snapshot,
+                                          self._userInputHashDict, self._clusterInputHash)
+        userInputHashDict = {"user1@%": self._userInputHashDict["user1@%"]}
+        self._stateStore.saveClusterState("cluster1", self._snapshot, userInputHashDict,
+                                          state_store.hashClusterInputs(userInputHashDict, False))
+        self.assertEquals(["user1@%"], self._stateStore.getUserStates("cluster1").keys())
+
+    def test_runCheckpoint(self):
+        grantDict = {"cluster1": {"user1@%": [{'db_table': '*.*', 'privileges': ['SELECT']}]}}
+        runHash = state_store.hashRunInputs(grantDict, False, False)
+        self.assertNotEquals(runHash, state_store.hashRunInputs(grantDict, True, False))
+        checkpoint = state_store.RunCheckpoint(self._stateStore, runHash, False)
+        checkpoint.saveUsers("cluster1", ["user1@%"])
+        checkpoint.saveCluster("cluster2")
+        self.assertEquals(set(["user1@%"]), checkpoint.getDoneUsers("cluster1"))
+        resumed = state_store.RunCheckpoint(self._stateStore, runHash, True)
+        self.assertFalse(resumed.isClusterDone("cluster1"))
+        self.assertTrue(resumed.isClusterDone("cluster2"))
+        self.assertEquals(set(["user1@%"]), resumed.getDoneUsers("cluster1"))
+        # other inputs do not resume from them
+        self.assertEquals(set(), state_store.RunCheckpoint(self._stateStore, "other", True).getDoneUsers("cluster1"))
+        state_store.RunCheckpoint(self._stateStore, runHash, False).startOver()
+        self.assertEquals({}, self._stateStore.getCheckpoints(runHash))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,7 +9,12 @@ import getpass
 import jinja2
 import logging
 import os
+import Queue
+import sys
+import threading
+import time
 logger = logging.getLogger(__name__)
+_echoLock = threading.Lock()
 
 
 def renderTemplate(template, argDict):
@@ -39,3 +44,54 @@ def askQuestion(context, default=None, password=False):
 
 def askPassword(context, default=None):
     return askQuestion(context, default, True)
+
+
+def echo(line):
+    """prints a whole line to stdout so concurrent workers never interleave"""
+    with _echoLock:
+        sys.stdout.write(line + "\n")
+
+
+def runInWorkerPool(itemList, workers, func, retries=0):
+    """
+    calls func(item) for every item using at most workers threads
+    a single worker runs everything in order on the calling thread
+    an item that raises is queued again behind the others up to retries times
+    :returns: a dict of item to (result, exception, seconds) of its last attempt
+    """
+    resultDict = {}
+    attemptDict = dict((x, 0) for x in itemList)
+    workQueue = Queue.Queue()
+    for item in itemList:
+        workQueue.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = workQueue.get_nowait()
+            except Queue.Empty:
+                return
+            startTime = time.time()
+            try:
+                resultDict[item] = (func(item), None, time.time() - startTime)
+            except Exception as e:
+                logger.error("%s failed with exception:%s", item, e)
+                resultDict[item] = (None, e, time.time() - startTime)
+                if attemptDict[item] < retries:
+                    attemptDict[item] += 1
+                    logger.info("retrying %s, attempt %d of %d", item, attemptDict[item], retries)
+                    workQueue.put(item)
+    if workers <= 1 or len(itemList) <= 1:
+        worker()
+    else:
+        threads = []
+        for i in range(min(workers, len(itemList))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join with a timeout so KeyboardInterrupt still reaches us
+            while thread.isAlive():
+                thread.join(0.5)
+    return resultDict